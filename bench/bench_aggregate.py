@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# Author: Armit
+# Create Time: 2026/10/18
+
+# group-by aggregation over tasks: `query_aggregate` against crunching `query_tasks` output in python
+#   python3 bench/bench_aggregate.py [--tasks 1000000] [--hosts 32] [--users 64] [--days 180] [--repeat 3]
+# tasks are synthetic and added to the in-memory `TaskRecord`, the first aggregate pays for building
+# the columnar mirror, later ones reuse it
+
+import os
+import sys
+import tempfile
+from time import perf_counter
+from random import Random
+from argparse import ArgumentParser
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_PATH, 'sodayo'))
+os.chdir(BASE_PATH)                     # server reads 'index.html' on import
+
+import settings as hp
+hp.LOG_PATH = tempfile.mkdtemp()
+hp.DATA_PATH = tempfile.mkdtemp()
+hp.STORAGE_BACKEND = 'pickle'
+import utils
+utils.init_logger('server')
+utils.logger.setLevel('ERROR')
+import server
+
+QUERIES = {
+  # name => (group_by, metrics)
+  'gpu-hours per user x host': (['username', 'hostname'], ['count', 'sum:duration']),
+  'tasks per host x day':      (['hostname', 'ts'],       ['count', 'mean:duration']),
+  'duration per hour of day':  (['hour_of_day'],          ['count', 'mean:duration', 'max:duration']),
+}
+
+
+def make_tasks(n_tasks:int, n_hosts:int, n_users:int, n_days:int) -> list:
+  rand = Random(2333)
+  end_ts = server.now_ts()
+  start_ts = end_ts - n_days * 24 * 60 * 60
+  tasks = [ ]
+  for _ in range(n_tasks):
+    ts = rand.randrange(start_ts, end_ts)
+    tasks.append({
+      'hostname': f'server{rand.randrange(n_hosts)}',
+      'username': f'user{rand.randrange(n_users)}',
+      'gpu_id': rand.randrange(8),
+      'command': 'python train.py',
+      'start_ts': ts,
+      'end_ts': ts + rand.randint(60, 3 * 24 * 60 * 60),
+      'ts': end_ts,
+    })
+  # arrive in order as they do for real, `TaskRecord.add` is cheap then
+  tasks.sort(key=lambda task: task['start_ts'])
+  return tasks
+
+def naive(group_by:list, start_ts:int, end_ts:int) -> dict:
+  # what a client does today: pull all tasks and sum them up by dict
+  res = { }
+  for task in server.TaskRecord.query(start_ts=start_ts):
+    if task['start_ts'] > end_ts: continue
+    if 'ts' in group_by:
+      bucket = task['start_ts'] // 86400
+    elif 'hour_of_day' in group_by:
+      bucket = task['start_ts'] // 3600 % 24
+    else: bucket = None
+    key = tuple(task.get(k) for k in group_by if k in server.TaskRecord.index_keys) + (bucket,)
+    stat = res.get(key)
+    if stat is None: stat = res[key] = [0, 0, 0]
+    duration = task['end_ts'] - task['start_ts']
+    stat[0] += 1
+    stat[1] += duration
+    stat[2] = max(stat[2], duration)
+  return res
+
+def timed(fn, repeat:int) -> tuple:
+  # (first, best of the rest) in ms
+  times, res = [ ], None
+  for _ in range(max(repeat, 1)):
+    start = perf_counter()
+    res = fn()
+    times.append((perf_counter() - start) * 1000)
+  return times[0], min(times[1:] or times), res
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--tasks', type=int, default=1000000)
+  parser.add_argument('--hosts', type=int, default=32)
+  parser.add_argument('--users', type=int, default=64)
+  parser.add_argument('--days', type=int, default=180, help='days the tasks spread over')
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  start = perf_counter()
+  for task in make_tasks(args.tasks, args.hosts, args.users, args.days):
+    server.TaskRecord.add(task)
+  print(f'{args.tasks} tasks on {args.hosts} hosts by {args.users} users over {args.days} days, added in {perf_counter() - start:.1f}s')
+
+  end_ts = server.now_ts()
+  start_ts = end_ts - args.days * 24 * 60 * 60
+  print(f'{"query":<28}{"groups":>8}{"naive":>12}{"agg first":>12}{"agg warm":>12}{"speedup":>10}   (time in ms)')
+  for name, (group_by, metrics) in QUERIES.items():
+    kwargs = {'group_by': group_by, 'metrics': metrics, 'start_ts': start_ts, 'end_ts': end_ts, 'resolution': 86400}
+    _, t_naive, _ = timed(lambda: naive(group_by, start_ts, end_ts), 1)
+    t_first, t_warm, res = timed(lambda: server.query_aggregate(**kwargs), args.repeat)
+    print(f'{name:<28}{len(res.data):>8}{t_naive:>12.0f}{t_first:>12.0f}{t_warm:>12.0f}{t_naive / t_warm:>9.1f}x')
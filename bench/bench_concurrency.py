@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Author: Armit
+# Create Time: 2026/10/18
+
+# concurrency benchmark of runtime ingest against dashboard reads
+#   python3 bench/bench_concurrency.py [--hosts 16] [--frames 100] [--writers 1 2 4 8] [--readers 4]
+# writers apply `stats_runtime` for their own share of hosts, readers keep querying runtime of random hosts,
+# reports ingest throughput, read latency and lock waits
+
+import os
+import sys
+import tempfile
+from time import perf_counter
+from random import Random
+from threading import Thread, Event
+from argparse import ArgumentParser
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_PATH, 'sodayo'))
+os.chdir(BASE_PATH)                     # server reads 'index.html' on import
+
+import settings as hp
+hp.LOG_PATH = tempfile.mkdtemp()
+import utils
+utils.init_logger('server')
+utils.logger.setLevel('ERROR')
+import server
+from bench_encoding import make_frame
+
+
+def run(n_hosts:int, n_frames:int, n_writers:int, n_readers:int) -> dict:
+  # start over
+  for var in ['runtime_info', 'runtime_views', 'hardware_info', 'host_locks']:
+    getattr(server, var).clear()
+  server.lock = server.StatLock()
+  hostnames = [f'server{i}' for i in range(n_hosts)]
+  for name in hostnames: server.hardware_info[name] = { }
+
+  rand = Random(2333)
+  end_ts = server.now_ts()
+  start_ts = end_ts - n_frames * hp.COMMIT_INTERVAL
+  frames = [make_frame(rand, start_ts + k * hp.COMMIT_INTERVAL, 8) for k in range(n_frames)]
+
+  def writer(names):
+    for frame in frames:
+      for name in names:
+        server.stats_runtime(name, {'runtime': dict(frame)})
+
+  stop = Event()
+  latencies = [ ]
+  def reader(seed):
+    rand = Random(seed)
+    while not stop.is_set():
+      start = perf_counter()
+      server.query_runtime(hostname=rand.choice(hostnames), start_ts=start_ts, end_ts=end_ts, max_points=100)
+      latencies.append(perf_counter() - start)
+
+  writers = [Thread(target=writer, args=(hostnames[i::n_writers],)) for i in range(n_writers)]
+  readers = [Thread(target=reader, args=(i,)) for i in range(n_readers)]
+  for thr in readers: thr.start()
+  start = perf_counter()
+  for thr in writers: thr.start()
+  for thr in writers: thr.join()
+  elapsed = perf_counter() - start
+  stop.set()
+  for thr in readers: thr.join()
+
+  latencies.sort()
+  host_stats = [hl.stats() for hl in server.host_locks.values()]
+  return {
+    'frames/s': n_hosts * n_frames / elapsed,
+    'reads/s': len(latencies) / elapsed,
+    'read p50': latencies[len(latencies) // 2] * 1000 if latencies else 0,
+    'read p99': latencies[len(latencies) * 99 // 100] * 1000 if latencies else 0,
+    'host wait max': max([s['wait_max'] for s in host_stats] or [0]),
+    'shared wait max': server.lock.stats()['wait_max'],
+  }
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--hosts', type=int, default=16)
+  parser.add_argument('--frames', type=int, default=100, help='frames per host')
+  parser.add_argument('--writers', type=int, nargs='+', default=[1, 2, 4, 8])
+  parser.add_argument('--readers', type=int, default=4)
+  args = parser.parse_args()
+
+  cols = ['frames/s', 'reads/s', 'read p50', 'read p99', 'host wait max', 'shared wait max']
+  print(f'{args.hosts} hosts x {args.frames} frames, {args.readers} readers (latency and waits in ms)')
+  print(f'{"writers":<8}' + ''.join(f'{c:>16}' for c in cols))
+  for n_writers in args.writers:
+    res = run(args.hosts, args.frames, n_writers, args.readers)
+    print(f'{n_writers:<8}' + ''.join(f'{res[c]:>16.2f}' for c in cols))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Author: Armit
+# Create Time: 2026/10/18
+
+# micro-benchmark of wire encodings on realistic `runtime_info` frames
+#   python3 bench/bench_encoding.py [--gpus 8] [--days 7] [--repeat 5]
+
+import os
+import sys
+from time import perf_counter
+from random import Random
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sodayo'))
+
+import settings as hp
+from packets import *
+from history import RuntimeHistory
+
+
+def make_frame(rand:Random, ts:int, n_gpus:int) -> dict:
+  # struct of `client.runtime_info`
+  gpus = [ ]
+  for i in range(n_gpus):
+    busy = rand.random() < 0.7
+    gpus.append({
+      'gpu_id': i,
+      'temp': rand.randint(60, 85) if busy else rand.randint(30, 40),
+      'usage': rand.randint(40, 100) if busy else 0,
+      'mem_usage': rand.randint(2000, 11000) if busy else 0,
+      'procs': [{
+        'username': f'user{rand.randint(1, 12)}',
+        'command': f'python train.py --config configs/exp{rand.randint(1, 99)}.yaml --gpus {i}',
+        'gpu_memory_usage': rand.randint(1000, 10000),
+        'start_ts': ts - rand.randint(60, 86400),
+      } for _ in range(rand.randint(1, 2))] if busy else [ ],
+    })
+  return {
+    'gpu': gpus,
+    'loadavg': round(rand.uniform(0, 16), 2),
+    'cpu_usage': round(rand.uniform(0, 100), 1),
+    'mem_free': rand.randint(1000, 90000),
+    'ts': ts,
+  }
+
+def bench(name:str, payload:dict, repeat:int):
+  print(f'[{name}]')
+  print(f'  {"encoding":<10}{"size":>12}{"ratio":>8}{"encode":>12}{"decode":>12}')
+  base = None
+  for encoding in MIMETYPES:
+    if resolve_encoding(encoding) != encoding:
+      print(f'  {encoding:<10}  (not available)')
+      continue
+
+    t_enc, t_dec = float('inf'), float('inf')
+    for _ in range(repeat):
+      start = perf_counter()
+      data = encode_payload(payload, encoding)
+      t_enc = min(t_enc, perf_counter() - start)
+      start = perf_counter()
+      decode_payload(data, encoding)
+      t_dec = min(t_dec, perf_counter() - start)
+
+    base = base or len(data)
+    print(f'  {encoding:<10}{len(data):>12,}{len(data) / base:>8.2f}{t_enc * 1000:>10.2f}ms{t_dec * 1000:>10.2f}ms')
+  print()
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--gpus', type=int, default=8, help='GPUs per host')
+  parser.add_argument('--days', type=int, default=7, help='span of the runtime query reply')
+  parser.add_argument('--repeat', type=int, default=5, help='best of n runs')
+  args = parser.parse_args()
+
+  rand = Random(2333)
+  end_ts = 1631766896
+  start_ts = end_ts - args.days * 24 * 60 * 60
+
+  # what a client posts every `COMMIT_INTERVAL`
+  frame = make_frame(rand, end_ts, args.gpus)
+  bench('stats packet (1 frame)', packet_to_dict(StatsPacket(type='runtime', runtime=frame, ts=end_ts)), args.repeat * 100)
+
+  # what a browser gets asking for the raw frames of a host
+  rtdata = RuntimeHistory()
+  for ts in range(start_ts, end_ts, hp.COMMIT_INTERVAL):
+    rtdata.append(make_frame(rand, ts, args.gpus))
+  frames = rtdata.between(start_ts, end_ts)
+  bench(f'query reply ({len(frames)} frames)', packet_to_dict(RESPONSE.OK(data={'server1': frames})), args.repeat)
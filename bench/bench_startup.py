@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Author: Armit
+# Create Time: 2026/10/18
+
+# server startup cost of rtdata: the lzma pickle file against the memory-mapped snapshot
+#   python3 bench/bench_startup.py [--hosts 16] [--days 3] [--gpus 8] [--codec lzma|zlib:1|...]
+# each load runs in a fresh process, reports time till ready to serve, time to the first host,
+# time to all hosts, and peak RSS grown by then
+
+import os
+import sys
+import tempfile
+from time import perf_counter
+from random import Random
+from multiprocessing import get_context
+from argparse import ArgumentParser
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_PATH, 'sodayo'))
+
+import settings as hp
+from utils import load_pkl, save_pkl, MappedSnapshot, LazyDict
+from history import RuntimeHistory
+from bench_encoding import make_frame
+
+
+def make_runtime(n_hosts:int, n_days:int, n_gpus:int) -> dict:
+  rand = Random(2333)
+  end_ts = 1631766896
+  start_ts = end_ts - n_days * 24 * 60 * 60
+  runtime = { }
+  for i in range(n_hosts):
+    rtdata = RuntimeHistory(tiers=[(width, days * 24 * 60 * 60) for width, days in hp.RTDATA_ROLLUP_TIERS])
+    for ts in range(start_ts, end_ts, hp.COMMIT_INTERVAL):
+      rtdata.append(make_frame(rand, ts, n_gpus))
+    runtime[f'server{i}'] = rtdata
+  return runtime
+
+def max_rss() -> int:
+  # VmHWM starts over on exec, unlike `ru_maxrss` which a spawned child inherits from the parent
+  with open('/proc/self/status') as fh:
+    for line in fh:
+      if line.startswith('VmHWM:'): return int(line.split()[1]) * 1024
+
+def load(fmt:str, fp:str) -> dict:
+  base = max_rss()
+  start = perf_counter()
+  if fmt == 'pickle':
+    runtime = load_pkl(fp)
+    t_ready = t_first = perf_counter() - start
+    rss_first = max_rss()
+  else:
+    runtime = LazyDict(MappedSnapshot(fp))
+    t_ready = perf_counter() - start
+    runtime['server0']
+    t_first = perf_counter() - start
+    rss_first = max_rss()
+  n_frames = sum(len(rtdata) for rtdata in runtime.values())
+  t_all = perf_counter() - start
+  return {
+    'ready': t_ready * 1000,
+    'first host': t_first * 1000,
+    'all hosts': t_all * 1000,
+    'rss first': (rss_first - base) / 2**20,
+    'rss all': (max_rss() - base) / 2**20,
+    'frames': n_frames,
+  }
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--hosts', type=int, default=16)
+  parser.add_argument('--days', type=int, default=3, help='days of raw frames per host')
+  parser.add_argument('--gpus', type=int, default=8, help='GPUs per host')
+  parser.add_argument('--codec', default=':'.join(str(x) for x in hp.DUMP_CODEC if x is not None), help='<name>[:<level>] of both formats')
+  args = parser.parse_args()
+  name, _, level = args.codec.partition(':')
+  codec = (name, int(level) if level else None)
+
+  tmp_path = tempfile.mkdtemp()
+  files = {
+    'pickle':   os.path.join(tmp_path, 'server-runtime_info.pkl'),
+    'snapshot': os.path.join(tmp_path, 'server-runtime_info.snap'),
+  }
+  runtime = make_runtime(args.hosts, args.days, args.gpus)
+  start = perf_counter()
+  save_pkl(runtime, files['pickle'], codec)
+  t_pkl = perf_counter() - start
+  start = perf_counter()
+  MappedSnapshot.save(runtime, files['snapshot'], codec)
+  t_snap = perf_counter() - start
+  del runtime
+
+  cols = ['ready', 'first host', 'all hosts', 'rss first', 'rss all']
+  print(f'{args.hosts} hosts x {args.days} days x {args.gpus} GPUs, codec {args.codec} (time in ms, peak RSS grown in MB)')
+  print(f'{"format":<10}{"size MB":>10}{"dump":>10}' + ''.join(f'{c:>12}' for c in cols))
+  ctx = get_context('spawn')
+  for fmt, t_dump in [('pickle', t_pkl), ('snapshot', t_snap)]:
+    with ctx.Pool(1) as pool:
+      res = pool.apply(load, (fmt, files[fmt]))
+    size = os.path.getsize(files[fmt]) / 2**20
+    print(f'{fmt:<10}{size:>10.2f}{t_dump * 1000:>10.0f}' + ''.join(f'{res[c]:>12.2f}' for c in cols))
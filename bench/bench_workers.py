@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Author: Armit
+# Create Time: 2026/10/18
+
+# query throughput of the server against the number of worker processes
+#   python3 bench/bench_workers.py [--workers 1 2 4] [--hosts 16] [--frames 200] [--clients 8] [--duration 10]
+# starts a real server per setting on a temp data dir with sqlite backend, seeds hosts over /stats,
+# then keep-alive clients in separate processes keep querying runtime of random hosts
+# NOTE: scaling is bounded by the CPU cores of the box, clients run on it too
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import http.client
+from time import time, sleep, perf_counter
+from random import Random
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(BASE_PATH, 'sodayo'))
+
+import settings as hp
+from bench_encoding import make_frame
+
+PORT = 15201
+
+SERVER_CODE = '''
+import sys, runpy
+sys.path.insert(0, 'sodayo')
+import settings as hp
+hp.DATA_PATH, hp.LOG_PATH = {data_path!r}, {log_path!r}
+hp.STORAGE_BACKEND, hp.SERVER_WORKERS, hp.QUERY_CACHE_SIZE = 'sqlite', {n_workers}, 0
+hp.MASTER_SOCKET = ('127.0.0.1', {port})
+runpy.run_path('sodayo/server.py', run_name='__main__')
+'''
+
+
+def post(conn:http.client.HTTPConnection, path:str, data:dict) -> dict:
+  conn.request('POST', path, body=json.dumps(json.dumps(data)), headers={'Content-Type': 'application/json'})
+  return json.loads(conn.getresponse().read())
+
+def wait_ready(timeout:float=30):
+  start = perf_counter()
+  while perf_counter() - start < timeout:
+    try:
+      post(http.client.HTTPConnection('127.0.0.1', PORT), '/query', {'type': 'settings'})
+      return
+    except OSError: sleep(0.2)
+  raise TimeoutError('server not ready')
+
+def seed(n_hosts:int, n_frames:int):
+  # one source address per host, since the server tells hosts apart by it
+  rand = Random(2333)
+  end_ts = int(time())
+  start_ts = end_ts - n_frames * hp.COMMIT_INTERVAL
+  for i in range(n_hosts):
+    conn = http.client.HTTPConnection('127.0.0.1', PORT, source_address=(f'127.0.0.{i + 2}', 0))
+    post(conn, '/heartbeat', {'hostname': f'server{i}'})
+    sleep(hp.BUS_POLL_INTERVAL * 3)     # the heartbeat lands before the stats
+    batch = [{'type': 'hardware', 'hardware': {'gpu': [{'gpu_id': k, 'name': 'GeForce RTX 3090', 'mem_total': 24268} for k in range(8)]}}]
+    batch += [{'type': 'runtime', 'runtime': make_frame(rand, start_ts + k * hp.COMMIT_INTERVAL, 8)} for k in range(n_frames)]
+    post(conn, '/stats', {'type': 'batch', 'batch': batch})
+
+def client(args) -> list:
+  seed, n_hosts, duration = args
+  rand = Random(seed)
+  conn = http.client.HTTPConnection('127.0.0.1', PORT)
+  latencies = [ ]
+  start = perf_counter()
+  while perf_counter() - start < duration:
+    t = perf_counter()
+    res = post(conn, '/query', {'type': 'runtime', 'hostname': f'server{rand.randrange(n_hosts)}', 'max_points': 100})
+    if res['status_code'] != 200: raise RuntimeError(f'query not ok: {res}')
+    latencies.append(perf_counter() - t)
+  return latencies
+
+def run(n_workers:int, n_hosts:int, n_frames:int, n_clients:int, duration:float) -> dict:
+  tmp_path = tempfile.mkdtemp()
+  code = SERVER_CODE.format(data_path=os.path.join(tmp_path, 'data'), log_path=os.path.join(tmp_path, 'log'),
+                            n_workers=n_workers, port=PORT)
+  proc = subprocess.Popen([sys.executable, '-c', code], cwd=BASE_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    wait_ready()
+    seed(n_hosts, n_frames)
+    sleep(hp.BUS_POLL_INTERVAL * 5)     # workers catch up with the states
+
+    with Pool(n_clients) as pool:
+      res = pool.map(client, [(i, n_hosts, duration) for i in range(n_clients)])
+    latencies = sorted(sum(res, [ ]))
+    return {
+      'q/s': len(latencies) / duration,
+      'p50': latencies[len(latencies) // 2] * 1000 if latencies else 0,
+      'p99': latencies[len(latencies) * 99 // 100] * 1000 if latencies else 0,
+    }
+  finally:
+    proc.terminate()
+    proc.wait()
+    sleep(1)                            # workers leave once they see the primary gone
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+  parser.add_argument('--hosts', type=int, default=16)
+  parser.add_argument('--frames', type=int, default=200, help='frames per host')
+  parser.add_argument('--clients', type=int, default=8, help='client processes')
+  parser.add_argument('--duration', type=float, default=10, help='seconds of querying per setting')
+  args = parser.parse_args()
+
+  cols = ['q/s', 'p50', 'p99']
+  print(f'{args.hosts} hosts x {args.frames} frames, {args.clients} clients, {os.cpu_count()} cores (latency in ms)')
+  print(f'{"workers":<8}' + ''.join(f'{c:>12}' for c in cols))
+  for n_workers in args.workers:
+    res = run(n_workers, args.hosts, args.frames, args.clients, args.duration)
+    print(f'{n_workers:<8}' + ''.join(f'{res[c]:>12.2f}' for c in cols))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Author: Armit
+# Create Time: 2026/10/18
+
+# one-shot conversion of the pickle data files under `DATA_PATH` to the sqlite backend
+#   python3 migrate.py [--force]
+# run it where the server runs with the server stopped, then set `STORAGE_BACKEND = 'sqlite'` in settings.py
+# NOTE: pickle files are left as they are, remove them by hand once happy
+
+import os
+import re
+import sys
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sodayo'))
+
+import settings as hp
+hp.STORAGE_BACKEND = 'pickle'     # record classes read from pickle files
+import utils
+utils.init_logger('server')
+import server                     # registers the record classes
+from utils import RecordMeta, SQLiteStore, load_pkl, rtdata_db_file, stdata_db_file
+
+RTDATA_FILE_REGEX = re.compile(r'^(\w+?)-(\w+_info)\.pkl$')
+
+
+def migrate_stdata(force:bool=False):
+  store = SQLiteStore(stdata_db_file())
+  for rec in RecordMeta.objects:
+    rec.load()
+    store.create_table(rec)
+    n_rows = store.count(rec)
+    if n_rows and not force:
+      print(f'[{rec.__name__}] {store.fp} already has {n_rows} rows, skipped (use --force to overwrite)')
+      continue
+    store.delete_before(rec, float('inf'))
+    store.insert(rec, rec.objects)
+    store.commit()
+    print(f'[{rec.__name__}] {len(rec.objects)} objects => {store.fp}')
+  store.close()
+
+def migrate_rtdata(force:bool=False):
+  stores = { }
+  for fn in sorted(os.listdir(hp.DATA_PATH)):
+    m = RTDATA_FILE_REGEX.match(fn)
+    if not m: continue
+    prefix, var = m.groups()
+    if prefix not in stores: stores[prefix] = SQLiteStore(rtdata_db_file(prefix))
+    store = stores[prefix]
+    if store.get(var) is not None and not force:
+      print(f'[{prefix}-{var}] {store.fp} already has it, skipped (use --force to overwrite)')
+      continue
+    store.put(var, load_pkl(os.path.join(hp.DATA_PATH, fn)))
+    print(f'[{prefix}-{var}] => {store.fp}')
+  for store in stores.values():
+    store.commit()
+    store.close()
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--force', action='store_true', help='overwrite what is already in the sqlite dbs')
+  args = parser.parse_args()
+
+  migrate_stdata(args.force)
+  migrate_rtdata(args.force)
+  print(f"done, now set STORAGE_BACKEND = 'sqlite' in settings.py")
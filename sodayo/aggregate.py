@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Author: Armit
+# Create Time: 2026/10/18
+
+from threading import Lock
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from history import SCALAR_FIELDS, GPU_FIELDS, INT_FIELDS, RuntimeHistory, partials
+
+
+##############################################################################
+# NOTE: server side group-by aggregation for `query_aggregate`
+#       tasks and runtime history are both seen as columns of partial aggregates
+#       (mins, maxs, sums, counts of each field, frames of each row), so that raw rows
+#       and rollup buckets go through the same sort & reduceat
+#
+# [section layout]
+#
+#   query schema
+#   group-by
+#   task columns
+#   runtime columns
+#
+
+
+# query schema
+KEY_FIELDS  = ('hostname', 'username', 'gpu_id')
+TIME_FIELDS = ('ts', 'hour_of_day', 'weekday')     # bucket start of `resolution` seconds, 0~23, 0~6 from Monday; local time
+AGG_FNS     = ('sum', 'mean', 'min', 'max')
+SOURCES = {
+  # source => (groupable key fields, aggregatable fields)
+  'tasks':   (KEY_FIELDS, ('duration',)),
+  'runtime': (('hostname', 'gpu_id'), SCALAR_FIELDS + GPU_FIELDS),
+}
+
+Metric = Tuple[str, str]      # ('count', None) or (fn, field)
+
+def parse_metric(source:str, metric:str) -> Metric:
+  # 'count' or '<fn>:<field>', ValueError if not known to `source`
+  if metric == 'count': return 'count', None
+  fn, _, field = str(metric).partition(':')
+  if fn not in AGG_FNS or field not in SOURCES[source][1]:
+    raise ValueError(f'unknown metric {metric!r}, should be count or <{"|".join(AGG_FNS)}>:<{"|".join(SOURCES[source][1])}>')
+  return fn, field
+
+def check_group_by(source:str, group_by:List[str]):
+  for key in group_by:
+    if key not in SOURCES[source][0] and key not in TIME_FIELDS:
+      raise ValueError(f'cannot group {source} by {key!r}, should be in {list(SOURCES[source][0] + TIME_FIELDS)}')
+
+def utc_offset() -> int:
+  return int(datetime.now().astimezone().utcoffset().total_seconds())
+
+def time_key(key:str, ts:np.ndarray, resolution:int, offset:int) -> np.ndarray:
+  local = ts + offset
+  if key == 'ts':          return local // resolution * resolution - offset
+  if key == 'hour_of_day': return local // 3600 % 24
+  if key == 'weekday':     return (local // 86400 + 3) % 7      # 1970/01/01 is a Thursday
+
+
+# group-by
+class Columns:
+
+  # a long table to aggregate: `keys` are int64 arrays of the group fields, `frames` the rows merged
+  # into each row, and `parts[field]` its (mins, maxs, sums, counts), all of the same length
+  # NOTE: string keys are int codes into `labels`
+
+  def __init__(self, keys:Dict[str, np.ndarray], frames:np.ndarray, parts:Dict[str, tuple], labels:List[str]=None):
+    self.keys, self.frames, self.parts, self.labels = keys, frames, parts, labels
+
+  @classmethod
+  def concat(cls, tables:List['Columns'], labels:List[str]=None) -> 'Columns':
+    keys   = {k: np.concatenate([t.keys[k] for t in tables]) for k in tables[0].keys}
+    frames = np.concatenate([t.frames for t in tables])
+    parts  = {f: tuple(np.concatenate([t.parts[f][i] for t in tables]) for i in range(4)) for f in tables[0].parts}
+    return cls(keys, frames, parts, labels)
+
+  def group_by(self, group_by:List[str], metrics:List[Metric], resolution:int=3600) -> List[dict]:
+    # one row per group, ordered by the group keys
+    n = len(self.frames)
+    if not n: return [ ]
+
+    # mixed radix of the per key codes, then a single sort brings each group together
+    gid, radices, offset = np.zeros(n, dtype=np.int64), [ ], utc_offset()
+    for key in group_by:
+      col = time_key(key, self.keys['ts'], resolution, offset) if key in TIME_FIELDS else self.keys[key]
+      uniq, code = np.unique(col, return_inverse=True)
+      gid = gid * len(uniq) + code
+      radices.append(uniq)
+    order = np.argsort(gid, kind='stable')
+    gid = gid[order]
+    starts = np.flatnonzero(np.r_[True, gid[1:] != gid[:-1]])
+
+    res = {'count': np.add.reduceat(self.frames[order], starts)}
+    for fn, field in metrics:
+      if fn == 'count': continue
+      mins, maxs, sums, counts = self.parts[field]
+      if fn == 'min': res[f'{fn}:{field}'] = np.fmin.reduceat(mins[order], starts)
+      if fn == 'max': res[f'{fn}:{field}'] = np.fmax.reduceat(maxs[order], starts)
+      if fn in ['sum', 'mean']:
+        total = np.add.reduceat(sums[order], starts)
+        if fn == 'sum': res[f'{fn}:{field}'] = total
+        else:
+          with np.errstate(invalid='ignore', divide='ignore'):
+            res[f'{fn}:{field}'] = total / np.add.reduceat(counts[order], starts)
+
+    # decode the group keys back from the radix
+    group_ids, values = gid[starts], { }
+    for key, uniq in reversed(list(zip(group_by, radices))):
+      values[key] = uniq[group_ids % len(uniq)]
+      group_ids = group_ids // len(uniq)
+
+    rows = [{ } for _ in starts]
+    for key in group_by:
+      col = values[key].tolist()
+      if key in ['hostname', 'username']: col = [self.labels[c] for c in col]
+      elif key == 'gpu_id':               col = [None if c < 0 else c for c in col]
+      for row, v in zip(rows, col): row[key] = v
+    for fn, field in metrics:
+      name = 'count' if fn == 'count' else f'{fn}:{field}'
+      col = res[name].tolist()
+      for row, v in zip(rows, col): row[name] = _to_value(fn, field, v)
+    return rows
+
+def _to_value(fn:str, field:str, v:float):
+  if fn == 'count': return int(v)
+  if v != v: return None          # NaN, nothing to aggregate in the group
+  if fn != 'mean' and field in INT_FIELDS | {'duration'}: return int(v)
+  return round(float(v), 2)
+
+
+# task columns
+class TaskColumns:
+
+  # columnar mirror of tasks for aggregation, appended as tasks come and rebuilt when the record reindexes
+  # NOTE: rows keep arrival order which group-by does not care about; arrays grow by doubling so that
+  #       an `extract` taken before stays valid while rows go on appending
+
+  FIELDS = {
+    'hostname': np.int32,         # code into `labels`
+    'username': np.int32,
+    'gpu_id':   np.int32,         # -1 for None
+    'start_ts': np.int64,
+    'end_ts':   np.float64,       # NaN for None
+  }
+
+  def __init__(self, capacity:int=1024):
+    self.labels: List[str] = [None]
+    self.codes: Dict[str, int] = {None: 0}
+    self.arrays = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.FIELDS.items()}
+    self.n = 0
+    self.lock = Lock()
+
+  def code(self, label:str) -> int:
+    c = self.codes.get(label)
+    if c is None:
+      c = self.codes[label] = len(self.labels)
+      self.labels.append(label)
+    return c
+
+  def add(self, task:dict):
+    with self.lock:
+      if self.n == len(self.arrays['start_ts']):
+        self.arrays = {name: np.concatenate([arr, np.empty_like(arr)]) for name, arr in self.arrays.items()}
+      k, arrays = self.n, self.arrays
+      arrays['hostname'][k] = self.code(task.get('hostname'))
+      arrays['username'][k] = self.code(task.get('username'))
+      gpu_id = task.get('gpu_id')
+      arrays['gpu_id'][k]   = -1 if gpu_id is None else gpu_id
+      arrays['start_ts'][k] = task['start_ts']
+      end_ts = task.get('end_ts')
+      arrays['end_ts'][k]   = np.nan if end_ts is None else end_ts
+      self.n += 1
+
+  def extract(self, start_ts:int, end_ts:int, hostname:str=None, username:str=None, gpu_id:int=None) -> Columns:
+    # tasks started within `[start_ts, end_ts]` matching the filters
+    with self.lock:
+      cols = {name: arr[:self.n] for name, arr in self.arrays.items()}
+      labels = list(self.labels)
+    mask = (cols['start_ts'] >= start_ts) & (cols['start_ts'] <= end_ts)
+    for field, value in [('hostname', hostname), ('username', username)]:
+      if value is not None: mask &= cols[field] == self.codes.get(value, -1)
+    if gpu_id is not None: mask &= cols['gpu_id'] == gpu_id
+    cols = {name: arr[mask] for name, arr in cols.items()}
+
+    duration = cols['end_ts'] - cols['start_ts']
+    _, mins, maxs, sums, counts, frames = partials(cols['start_ts'], duration)
+    keys = {'hostname': cols['hostname'], 'username': cols['username'], 'gpu_id': cols['gpu_id'], 'ts': cols['start_ts']}
+    return Columns(keys, frames, {'duration': (mins, maxs, sums, counts)}, labels)
+
+
+# runtime columns
+def runtime_columns(histories:Dict[str, RuntimeHistory], start_ts:int, end_ts:int, width:int,
+                    fields:List[str], per_gpu:bool, gpu_id:int=None) -> Columns:
+  # raw frames or rollup buckets within `[start_ts, end_ts]`, whichever of no coarser than `width` reaches back furthest
+  # one row per frame (or bucket), or per frame and GPU if `per_gpu` where host fields repeat on each GPU
+  labels, tables = [None], [ ]
+  for hostname, rtdata in histories.items():
+    source = rtdata.pick_source(start_ts, width)
+    if source is rtdata:
+      i, j = rtdata.span(start_ts, end_ts)
+      k0, k1 = rtdata.head + i, rtdata.head + j
+      ts, mins, maxs, sums, counts, frames = partials(rtdata.ts[k0:k1], rtdata.values[k0:k1])
+    else:
+      ts, mins, maxs, sums, counts, frames = source.parts(start_ts, end_ts)
+    if not len(ts): continue
+
+    host = len(labels)
+    labels.append(hostname)
+    gpu_ids = [g for g in rtdata.gpu_ids if gpu_id is None or g == gpu_id] if per_gpu else [-1]
+    for g in gpu_ids:
+      parts = { }
+      for field in fields:
+        c = rtdata.col_of.get((g, field) if field in GPU_FIELDS else field)
+        if c is None: continue
+        parts[field] = (mins[:, c], maxs[:, c], sums[:, c], counts[:, c])
+      if len(parts) < len(fields): continue       # e.g. GPU fields of a host with no GPU
+      keys = {'hostname': np.full(len(ts), host, dtype=np.int32), 'gpu_id': np.full(len(ts), g, dtype=np.int32), 'ts': ts}
+      tables.append(Columns(keys, frames, parts))
+
+  if not tables: return Columns({ }, np.empty(0, dtype=np.int64), { }, labels)
+  return Columns.concat(tables, labels)
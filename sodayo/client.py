@@ -2,10 +2,12 @@
 # Author: Armit
 # Create Time: 2021/09/16 
 
-from time import sleep
+from time import sleep, perf_counter
+from copy import deepcopy
 from socket import gethostname
 from threading import Thread, Timer, RLock
 from traceback import format_exc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from flask import json
 
 from requests import session
@@ -38,6 +40,9 @@ __role__ = 'client'
 
 http = session()
 lock = RLock()      # for r/w `runtime_info`
+backlog_lock = RLock()    # for r/w `backlog_info`
+commit_lock = RLock()     # for draining `backlog_info`, one thread at a time
+wire_encoding = resolve_encoding(hp.WIRE_ENCODING)    # of posts to the server, may fall back to 'json'
 hostname = gethostname()
 
 
@@ -106,6 +111,10 @@ running_tasks_info = {
   },
 }
 
+backlog_info = [            # stats packets not yet accepted by server, oldest first
+  {'type': 'runtime', 'runtime': runtime_info, 'ts': 1631665845},
+]
+
 
 ##############################################################################
 # utils
@@ -191,7 +200,7 @@ def update_hardware_info():
   logger.debug(hardware_info)
 
 @perf_timer        # ~= 0.25s
-@with_lock(lock)
+@with_lock(lock, 'lock')
 def update_runtime_info() -> list:
   global runtime_info
 
@@ -281,15 +290,14 @@ def check_running_tasks(active_pids:list):
       dead_pids.append(pid)
   if tasks:
     for pid in dead_pids: del running_tasks_info[pid]
-    # TODO: locally keep a copy in case of long time network failure ?
-    # tasks info upload MUST be success ...
-    _post('stats', StatsPacket(type='tasks', tasks=tasks), retry_status_ok=-1)
+    # tasks info upload MUST be success, kept in backlog (and dumped) till then
+    commit_stats(StatsPacket(type='tasks', tasks=tasks))
 
 def heartbeat_task(cli):
   if hp.HERATBEAT_INTERVAL == -1: return
   logger.info('[heartbeat_task]')
 
-  _post('heartbeat', HeartbeatPacket())
+  _post('heartbeat', HeartbeatPacket(hostname=hostname))
 
   cli.heartbeat_timer = Timer(hp.HERATBEAT_INTERVAL, heartbeat_task, (cli,))
   cli.heartbeat_timer.start()
@@ -306,11 +314,11 @@ def update_task(cli):
   cli.update_timer = Timer(hp.UPDATE_INTERVAL, update_task, (cli,))
   cli.update_timer.start()
 
-@with_lock(lock)
 def commit_task(cli):
   logger.info('[commit_task]')
 
-  _post('stats', StatsPacket(type='runtime', runtime=runtime_info))
+  with lock: packet = packet_to_dict(StatsPacket(type='runtime', runtime=runtime_info))
+  commit_stats(packet)
 
   cli.commit_timer = Timer(hp.COMMIT_INTERVAL, commit_task, (cli,))
   cli.commit_timer.start()
@@ -319,42 +327,154 @@ def commit_task(cli):
 def coredump_task(cli):
   logger.info('[coredump_task]')
 
-  dump_rtdata(globals(), prefix=__role__)
+  # copied under the locks, then written by this thread or a forked child, see `DUMP_MODE`
+  with lock, backlog_lock:
+    env = {var: deepcopy(val) for var, val in globals().items() if var.endswith('_info') and isinstance(val, DUMPABLE_TYPES)}
+  run_dump(lambda: dump_rtdata(env, prefix=__role__))
 
   cli.coredump_timer = Timer(min_to_sec(hp.COREDUMP_INTERVAL), coredump_task, (cli,))
   cli.coredump_timer.start()
 
-def _post(api:str, packet:Packet, retry_http=5, retry_status_ok=1):
-  url = f'http://{sock_to_hostport(hp.MASTER_SOCKET)}/{api}'
-  jsondata = json.dumps(packet_to_dict(packet), ensure_ascii=False)
-  HEADERS =  { 'User-Agent': 'sodayo-client' }
-  
-  def _try_post():
-    for _ in range(retry_http):
-      try:
-        logger.debug(f'[post] {url} with {jsondata}')
-        return http.post(url=url, headers=HEADERS, json=jsondata, timeout=30)
-      except RequestException: logger.error(format_exc())
-      except Exception as e:   raise e
-      sleep(hp.COMMIT_INTERVAL // 2)
-
+def commit_stats(packet:Union[StatsPacket, dict]):
+  # queue after the backlog to keep order, then try to drain them all
+  # NOTE: a commit coming while another thread drains is left to it, or to the next commit
+  backlog_push(packet_to_dict(packet) if isinstance(packet, Packet) else packet)
+  if not commit_lock.acquire(blocking=False): return
+  try: backlog_drain()
+  finally: commit_lock.release()
+
+@with_lock(backlog_lock, 'backlog_lock')
+def backlog_push(item:dict):
+  backlog_info.append(item)
+  if len(backlog_info) > hp.BACKLOG_LIMIT:
+    # runtime frames are the cheapest to lose, tasks are not
+    idx = next((i for i, item in enumerate(backlog_info) if item.get('type') == 'runtime'), 0)
+    logger.warning(f'[commit_stats] backlog full, drop a {backlog_info[idx].get("type")} packet')
+    del backlog_info[idx]
+
+def backlog_drain():
+  # one try per batch, posted out of `backlog_lock` and never sleeping, what fails is kept for the next commit
+  registered = False
+  while True:
+    with backlog_lock: items = backlog_info[:hp.BACKLOG_BATCH_SIZE]
+    if not items: break
+    if len(items) == 1: packet = StatsPacket(**items[0])
+    else:               packet = StatsPacket(type='batch', batch=items)
+    status_code = _post_once('stats', packet_to_dict(packet))
+    # evicted by the server, e.g. cut off for long with heartbeat disabled, register again and retry once
+    if status_code == 401 and not registered:
+      registered = register()
+      if registered: continue
+    # unreachable, not registered or busy, try later
+    if status_code in [None, 401, 503]: break
+    # accepted, or rejected for good which would block all behind it otherwise, e.g. 400 for a malformed one
+    if status_code != 200: logger.warning(f'[commit_stats] drop {len(items)} packets rejected with {status_code}')
+    with backlog_lock:
+      # the backlog may have dropped some of them when full meanwhile
+      posted = {id(item) for item in items}
+      backlog_info[:] = [item for item in backlog_info if id(item) not in posted]
+      n_left = len(backlog_info)
+    if n_left: logger.info(f'[commit_stats] drained {len(items)}, {n_left} left in backlog')
+
+def register() -> bool:
+  # what `Client.start()` does at first, but in single tries
+  logger.warning('[register] not registered at server, register again')
+  if _post_once('heartbeat', packet_to_dict(HeartbeatPacket(hostname=hostname))) != 200: return False
+  _post_once('stats', packet_to_dict(StatsPacket(type='hardware', hardware=hardware_info)))
+  return True
+
+def _post(api:str, packet:Packet, retry_http=5, retry_status_ok=1) -> bool:
+  data = packet_to_dict(packet)
   retrial = retry_status_ok
   while retrial != 0:
     if retry_status_ok != -1: retrial -= 1
-    res = _try_post()
+    for _ in range(retry_http):
+      status_code = _post_once(api, data)
+      if status_code is not None: break
+      sleep(hp.COMMIT_INTERVAL // 2)
+    if status_code == 200: return True
+    sleep(hp.COMMIT_INTERVAL)
+  return False
+
+def _post_once(api:str, data:dict) -> Optional[int]:
+  # `status_code` of the reply packet, None if the server is not reached or replies no packet
+  global wire_encoding
+
+  url = f'http://{sock_to_hostport(hp.MASTER_SOCKET)}/{api}'
+  HEADERS =  { 'User-Agent': 'sodayo-client' }
+
+  while True:
+    encoding = wire_encoding
+    headers = {**HEADERS, 'Content-Type': MIMETYPES[encoding], 'Accept': MIMETYPES[encoding]}
+    # legacy JSON path posts a jsonstr, compact encodings the dict itself
+    if encoding == 'json': body = json.dumps(json.dumps(data, ensure_ascii=False))
+    else:                  body = encode_payload(data, encoding)
+    start = perf_counter()
     try:
-      status_code = res.json().get('status_code')
-      ok = res and (status_code == 200)
-      if ok: return res
-      logger.warning(f'[post] request not ok {status_code}: {res.json().get("reason")}')
-    except:
+      logger.debug(f'[post] {url} with {data}')
+      res = http.post(url=url, headers=headers, data=body, timeout=30)
+      metrics.observe('sodayo_post_seconds', perf_counter() - start, api=api)
+      metrics.inc('sodayo_posts_total', api=api, status=res.status_code)
+      reply = decode_payload(res.content, encoding_of(res.headers.get('Content-Type', '').split(';')[0]))
+    except RequestException:
+      metrics.inc('sodayo_posts_total', api=api, status='error')
       logger.error(format_exc())
-    sleep(hp.COMMIT_INTERVAL)
+      return None
+    except Exception:
+      logger.error(format_exc())
+      return None
+
+    status_code = isinstance(reply, dict) and reply.get('status_code') or None
+    if status_code == 415 and encoding != 'json':
+      # server cannot decode it, fall back to the default for good and retry at once
+      logger.warning(f'[post] server does not speak {encoding!r}, fall back to json')
+      wire_encoding = 'json'
+      continue
+    if status_code != 200: logger.warning(f'[post] request not ok {status_code}: {reply.get("reason")}')
+    return status_code
+
+
+def query_metrics(**kwargs) -> ReplyPacket:
+  return RESPONSE.OK(data=metrics.snapshot())
+
+@metrics.collector
+def client_metrics() -> Iterator[tuple]:
+  yield 'gauge', 'sodayo_backlog_packets', { }, len(backlog_info)
+  yield 'gauge', 'sodayo_running_tasks', { }, len(running_tasks_info)
 
 
 ##############################################################################
 # daemon
 
+class MetricsHandler(BaseHTTPRequestHandler):
+
+  # `GET /metrics` in text, `POST /query` of type 'metrics' in JSON, as the server does
+
+  def do_GET(self):
+    if self.path != '/metrics': return self.send_error(404)
+    self.reply(metrics.render(), METRICS_MIMETYPE)
+
+  def do_POST(self):
+    if self.path != '/query': return self.send_error(404)
+    try:
+      data = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+      if isinstance(data, str): data = json.loads(data)
+    except: data = None
+    if isinstance(data, dict) and data.get('type') == 'metrics': res = query_metrics()
+    else:                                                         res = RESPONSE.BAD_REQUEST()
+    self.reply(json.dumps(packet_to_dict(res)), MIMETYPES['json'])
+
+  def reply(self, body:str, content_type:str):
+    body = body.encode()
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
 class Client:
 
   def __init__(self):
@@ -363,8 +483,19 @@ class Client:
     self.update_timer     = Timer(0,                  update_task,    (self,))
     self.commit_timer     = Timer(hp.UPDATE_INTERVAL, commit_task,    (self,))
     self.coredump_timer   = Timer(hp.COMMIT_INTERVAL, coredump_task,  (self,))
+    self.metrics_server   = None
   
   def start(self):
+    if hp.CLIENT_METRICS_SOCKET:
+      try:
+        self.metrics_server = ThreadingHTTPServer(tuple(hp.CLIENT_METRICS_SOCKET), MetricsHandler)
+        self.metrics_server.daemon_threads = True
+        thr = Thread(target=self.metrics_server.serve_forever, daemon=True)
+        thr.start()
+      except OSError:
+        logger.warning(f'[metrics] cannot listen on {hp.CLIENT_METRICS_SOCKET}, /metrics disabled')
+
+
     # first heartbeat MUST be success for register
     _post('heartbeat', HeartbeatPacket(hostname=hostname), retry_status_ok=-1)
 
@@ -380,6 +511,7 @@ class Client:
           timer.start()
 
   def stop(self):
+    if self.metrics_server: self.metrics_server.shutdown()
     for var in dir(self):
       if var.endswith('_timer'):
         timer = getattr(self, var)
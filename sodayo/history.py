@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+# Author: Armit
+# Create Time: 2026/10/18
+
+from sys import intern
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+
+##############################################################################
+# NOTE: columnar storage for server side runtime history
+#       one `RuntimeHistory` per host, replacing the deque of `client.runtime_info` frames
+#       raw frames expire after `RTDATA_TRUNCATE_EXPIRE`, rollup tiers keep long-term trends
+#
+# [section layout]
+#
+#   frame schema
+#   series aggregation
+#   column window
+#   rollup tier
+#   runtime history
+#
+
+
+# frame schema
+SCALAR_FIELDS = ('loadavg', 'cpu_usage', 'mem_free')
+GPU_FIELDS    = ('temp', 'usage', 'mem_usage')
+INT_FIELDS    = {'mem_free', 'temp', 'usage', 'mem_usage'}    # stored as float32 for NaN, given back as int
+PROC_FIELDS   = ('username', 'command', 'gpu_memory_usage', 'start_ts')
+
+ColumnKey = Union[str, Tuple[int, str]]     # 'loadavg' or (gpu_id, 'temp')
+
+def _to_value(field:str, v:float) -> Union[int, float, None]:
+  if np.isnan(v): return None
+  return int(v) if field in INT_FIELDS else round(float(v), 2)
+
+def _pack_procs(gpus:List[dict]) -> tuple:
+  # side table row: ((gpu_id, username, command, gpu_memory_usage, start_ts), ...)
+  # NOTE: usernames & commands repeat in every frame, interning keeps one copy of each
+  rows = [ ]
+  for gpu in gpus or [ ]:
+    for proc in gpu.get('procs') or [ ]:
+      username, command = proc.get('username'), proc.get('command')
+      rows.append((gpu.get('gpu_id'),
+                   username and intern(username), command and intern(command),
+                   proc.get('gpu_memory_usage'), proc.get('start_ts')))
+  return tuple(rows) or None
+
+def _unpack_procs(rows:tuple, gpu_id:int) -> List[dict]:
+  return [dict(zip(PROC_FIELDS, row[1:])) for row in rows or ( ) if row[0] == gpu_id]
+
+
+# series aggregation
+def rebucket(ts:np.ndarray, mins:np.ndarray, maxs:np.ndarray, sums:np.ndarray, counts:np.ndarray,
+             frames:np.ndarray, start_ts:int, width:int) -> tuple:
+  # merge sorted partial aggregates into buckets of `width` seconds aligned to `start_ts`
+  if not len(ts): return ts, mins, maxs, sums, counts, frames
+
+  b = (ts - start_ts) // width
+  starts = np.r_[0, np.flatnonzero(np.diff(b)) + 1]
+  return (start_ts + b[starts] * width,
+          np.fmin.reduceat(mins,   starts, axis=0),
+          np.fmax.reduceat(maxs,   starts, axis=0),
+          np.add .reduceat(sums,   starts, axis=0),
+          np.add .reduceat(counts, starts, axis=0),
+          np.add .reduceat(frames, starts))
+
+def partials(ts:np.ndarray, values:np.ndarray) -> tuple:
+  # raw frames seen as one-frame partial aggregates, NaN counts for nothing
+  valid = ~np.isnan(values)
+  return (ts, values, values, np.where(valid, values, 0).astype(np.float64),
+          valid.astype(np.int64), np.ones(len(ts), dtype=np.int64))
+
+def series_to_dict(columns:List[ColumnKey], bucket_ts:np.ndarray, mins:np.ndarray, maxs:np.ndarray,
+                   sums:np.ndarray, counts:np.ndarray, frames:np.ndarray, width:int, source:str) -> dict:
+  # JSON friendly layout, gpu series are nested under their gpu_id
+  with np.errstate(invalid='ignore', divide='ignore'):
+    means = sums / counts
+
+  def stat(field:str, i:int) -> dict:
+    return {
+      'min':  [_to_value(field, v) for v in mins[:, i]],
+      'mean': [_to_value(None,  v) for v in means[:, i]],   # mean of ints is not int
+      'max':  [_to_value(field, v) for v in maxs[:, i]],
+    }
+
+  res = {'resolution': width, 'source': source, 'ts': bucket_ts.tolist(), 'count': frames.tolist(), 'gpu': { }}
+  for i, key in enumerate(columns):
+    if isinstance(key, str):
+      res[key] = stat(key, i)
+    else:
+      gpu_id, field = key
+      res['gpu'].setdefault(gpu_id, { })[field] = stat(field, i)
+  return res
+
+
+# column window
+class ColumnWindow:
+
+  # a sliding window of rows kept in fixed-dtype arrays, rows `[head, tail)` are alive
+  # appending writes at `tail`, truncating moves `head`, both O(1) amortized
+  # NOTE: row arrays are shaped (capacity,), wide arrays are shaped (capacity, n_columns)
+  # NOTE: a row is never written again once pushed, compacting and widening allocate new arrays,
+  #       hence a `view` stays consistent while the window goes on without it
+
+  ROW_ARRAYS:  Dict[str, tuple] = {'ts': (np.int64, 0)}     # name => (dtype, fill)
+  WIDE_ARRAYS: Dict[str, tuple] = { }
+
+  def __init__(self, n_columns:int, capacity:int=1024):
+    self.n_columns = n_columns
+    self._alloc(capacity)
+
+  def _alloc(self, capacity:int):
+    for name, (dtype, fill) in self.ROW_ARRAYS.items():
+      setattr(self, name, np.full(capacity, fill, dtype=dtype))
+    for name, (dtype, fill) in self.WIDE_ARRAYS.items():
+      setattr(self, name, np.full((capacity, self.n_columns), fill, dtype=dtype))
+    self.head = self.tail = 0
+
+  def _arrays(self) -> List[str]:
+    return list(self.ROW_ARRAYS) + list(self.WIDE_ARRAYS)
+
+  def __len__(self) -> int:
+    return self.tail - self.head
+
+  def view(self) -> 'ColumnWindow':
+    # shallow copy sharing the arrays, frozen at current `[head, tail)`
+    v = object.__new__(type(self))
+    v.__dict__.update(self.__dict__)
+    return v
+
+  def __getstate__(self) -> dict:
+    # only persist the alive rows
+    state = {k: v for k, v in self.__dict__.items() if k not in self._arrays() and k not in ['head', 'tail']}
+    for name in self._arrays():
+      state[name] = getattr(self, name)[self.head:self.tail].copy()
+    return state
+
+  def __setstate__(self, state:dict):
+    n = len(state['ts'])
+    self.__dict__.update({k: v for k, v in state.items() if k not in self._arrays()})
+    self._alloc(max(n * 2, 16))
+    for name in self._arrays():
+      getattr(self, name)[:n] = state[name]
+    self.tail = n
+
+  @property
+  def first_ts(self) -> int:
+    return int(self.ts[self.head]) if self.tail > self.head else None
+
+  @property
+  def last_ts(self) -> int:
+    return int(self.ts[self.tail - 1]) if self.tail > self.head else None
+
+  def _widen(self, n:int):
+    for name, (dtype, fill) in self.WIDE_ARRAYS.items():
+      arr = getattr(self, name)
+      setattr(self, name, np.concatenate([arr, np.full((len(arr), n), fill, dtype=dtype)], axis=1))
+    self.n_columns += n
+
+  def _push(self) -> int:
+    # claim a fresh row at `tail`, compacting alive rows to the front and growing if more than half full
+    if self.tail == len(self.ts):
+      n, head = len(self), self.head
+      old = {name: getattr(self, name) for name in self._arrays()}
+      self._alloc(max(len(self.ts), n * 2, 16))
+      for name, arr in old.items():
+        getattr(self, name)[:n] = arr[head:head + n]
+      self.tail = n
+    self.tail += 1
+    return self.tail - 1
+
+  def truncate(self, before_ts:int):
+    # drop rows older than `before_ts`
+    # NOTE: dropped rows are left as is for views still reading them, compacting releases them
+    self.head += int(np.searchsorted(self.ts[self.head:self.tail], before_ts, side='left'))
+
+  def span(self, start_ts:int, end_ts:int) -> Tuple[int, int]:
+    # alive indices `[i, j)` of rows with `start_ts <= ts <= end_ts`
+    ts = self.ts[self.head:self.tail]
+    return int(np.searchsorted(ts, start_ts, side='left')), int(np.searchsorted(ts, end_ts, side='right'))
+
+
+# rollup tier
+class RollupTier(ColumnWindow):
+
+  # min/max/sum/count of each column per bucket of `width` seconds, kept for `retention` seconds
+  # the newest bucket stays open in `current` while frames keep falling into it, replaced as a whole
+  # on each update, and is pushed as a row once a frame of a later bucket comes
+
+  ROW_ARRAYS = {
+    'ts':     (np.int64, 0),          # bucket start
+    'frames': (np.int64, 0),          # frames merged into the bucket
+  }
+  WIDE_ARRAYS = {
+    'mins':   (np.float32, np.nan),
+    'maxs':   (np.float32, np.nan),
+    'sums':   (np.float64, 0),
+    'counts': (np.int32,   0),        # non-NaN values merged into the bucket
+  }
+
+  current: tuple = None     # (ts, frames, mins, maxs, sums, counts) of the open bucket
+
+  def __init__(self, width:int, retention:int, n_columns:int):
+    self.width = width
+    self.retention = retention
+    super().__init__(n_columns, capacity=64)
+
+  @property
+  def name(self) -> str:
+    return f'rollup:{self.width}'
+
+  @property
+  def first_ts(self) -> int:
+    if self.tail > self.head: return int(self.ts[self.head])
+    return self.current and self.current[0]
+
+  @property
+  def last_ts(self) -> int:
+    if self.current: return self.current[0]
+    return int(self.ts[self.tail - 1]) if self.tail > self.head else None
+
+  def _widen(self, n:int):
+    super()._widen(n)
+    if self.current:
+      ts, frames, *parts = self.current
+      fills = [fill for _, fill in self.WIDE_ARRAYS.values()]
+      parts = [np.concatenate([p, np.full(n, fill, dtype=p.dtype)]) for p, fill in zip(parts, fills)]
+      self.current = (ts, frames, *parts)
+
+  def add(self, ts:int, row:np.ndarray):
+    bucket = ts - ts % self.width
+    if self.current is None and self.tail > self.head and self.ts[self.tail - 1] == bucket:
+      # dumped by older versions with the newest bucket kept as a row, open it again
+      k = self.tail - 1
+      self.current = (bucket, self.frames[k], self.mins[k].copy(), self.maxs[k].copy(), self.sums[k].copy(), self.counts[k].copy())
+      self.tail = k
+    last_ts = self.last_ts
+    if last_ts is not None and bucket < last_ts: return     # stale frame
+    if last_ts is not None and bucket > last_ts: self._close()
+
+    if self.current is None:
+      n = self.n_columns
+      self.current = (bucket, 0, np.full(n, np.nan, np.float32), np.full(n, np.nan, np.float32),
+                      np.zeros(n, np.float64), np.zeros(n, np.int32))
+    _, frames, mins, maxs, sums, counts = self.current
+    valid = ~np.isnan(row)
+    self.current = (bucket, frames + 1, np.fmin(mins, row), np.fmax(maxs, row),
+                    sums + np.where(valid, row, 0), counts + valid)
+    self.truncate(ts - self.retention)
+
+  def _close(self):
+    if self.current is None: return
+    k = self._push()
+    self.ts[k], self.frames[k], self.mins[k], self.maxs[k], self.sums[k], self.counts[k] = self.current
+    self.current = None
+
+  def parts(self, start_ts:int, end_ts:int) -> tuple:
+    # (ts, mins, maxs, sums, counts, frames) of buckets starting within `[start_ts, end_ts]`, the open one included
+    i, j = self.span(start_ts, end_ts)
+    k0, k1 = self.head + i, self.head + j
+    parts = [self.ts[k0:k1], self.mins[k0:k1], self.maxs[k0:k1], self.sums[k0:k1], self.counts[k0:k1], self.frames[k0:k1]]
+    if self.current and start_ts <= self.current[0] <= end_ts:
+      ts, frames, mins, maxs, sums, counts = self.current
+      extra = [[ts], [mins], [maxs], [sums], [counts], [frames]]
+      parts = [np.concatenate([p, np.asarray(e, dtype=p.dtype)]) for p, e in zip(parts, extra)]
+    return tuple(parts)
+
+
+# runtime history
+class RuntimeHistory(ColumnWindow):
+
+  # raw frames of one host in columns, with rollup tiers built on ingest
+
+  ROW_ARRAYS = {
+    'ts':     (np.int64, 0),
+    'procs':  (object, None),         # side table of packed proc lists
+  }
+  WIDE_ARRAYS = {
+    'values': (np.float32, np.nan),
+  }
+
+  name = 'raw'
+  width = 0
+  appended = 0        # frames ever appended, counts on across truncating, tells which frames are new since
+
+  def __init__(self, capacity:int=1024, tiers:List[Tuple[int, int]]=( )):
+    self.columns: List[ColumnKey] = list(SCALAR_FIELDS)
+    self.col_of: Dict[ColumnKey, int] = {k: i for i, k in enumerate(self.columns)}
+    self.gpu_ids: List[int] = [ ]
+    self.tiers: List[RollupTier] = [RollupTier(width, retention, len(self.columns)) for width, retention in sorted(tiers)]
+    super().__init__(len(self.columns), capacity)
+
+  def __getitem__(self, i:Union[int, slice]) -> Union[dict, List[dict]]:
+    if isinstance(i, slice):
+      return [self.frame(k) for k in range(*i.indices(len(self)))]
+    if i < 0: i += len(self)
+    if not 0 <= i < len(self): raise IndexError(i)
+    return self.frame(i)
+
+  @classmethod
+  def from_frames(cls, frames, tiers:List[Tuple[int, int]]=( )) -> 'RuntimeHistory':
+    hist = cls(capacity=max(len(frames) * 2, 1024), tiers=tiers)
+    for frame in frames: hist.append(frame)
+    return hist
+
+  def sync_tiers(self, tiers:List[Tuple[int, int]]):
+    # follow the configured tiers, a newly configured one is backfilled from raw frames
+    old = {tier.width: tier for tier in self.tiers}
+    self.tiers = [ ]
+    for width, retention in sorted(tiers):
+      tier = old.get(width)
+      if tier is None:
+        tier = RollupTier(width, retention, self.n_columns)
+        for k in range(self.head, self.tail):
+          tier.add(int(self.ts[k]), self.values[k])
+      tier.retention = retention
+      self.tiers.append(tier)
+
+  def _add_gpu(self, gpu_id:int):
+    self.gpu_ids.append(gpu_id)
+    for field in GPU_FIELDS:
+      self.col_of[(gpu_id, field)] = len(self.columns)
+      self.columns.append((gpu_id, field))
+    for window in [self] + self.tiers:
+      window._widen(len(GPU_FIELDS))
+
+  def snapshot(self) -> 'RuntimeHistory':
+    # read-only view of raw frames and tiers for readers working without lock
+    v = self.view()
+    v.columns, v.col_of, v.gpu_ids = list(self.columns), dict(self.col_of), list(self.gpu_ids)
+    v.tiers = [tier.view() for tier in self.tiers]
+    return v
+
+  def append(self, frame:dict) -> bool:
+    ts = frame.get('ts')
+    if ts is None or (self.last_ts is not None and ts < self.last_ts): return False   # stale frame
+
+    gpus = [gpu for gpu in frame.get('gpu') or [ ] if gpu.get('gpu_id') is not None]
+    for gpu in gpus:
+      if (gpu['gpu_id'], GPU_FIELDS[0]) not in self.col_of:
+        self._add_gpu(gpu['gpu_id'])
+
+    row = np.full(len(self.columns), np.nan, dtype=np.float32)
+    for field in SCALAR_FIELDS:
+      v = frame.get(field)
+      if v is not None: row[self.col_of[field]] = v
+    for gpu in gpus:
+      for field in GPU_FIELDS:
+        v = gpu.get(field)
+        if v is not None: row[self.col_of[(gpu['gpu_id'], field)]] = v
+
+    k = self._push()
+    self.ts[k]     = ts
+    self.values[k] = row
+    self.procs[k]  = _pack_procs(gpus)
+    for tier in self.tiers:
+      tier.add(ts, row)
+    self.appended += 1
+    return True
+
+  def between(self, start_ts:int, end_ts:int) -> List[dict]:
+    return self[slice(*self.span(start_ts, end_ts))]
+
+  def since(self, appended:int) -> List[dict]:
+    # frames appended after the first `appended` ones, but those truncated already
+    n = min(self.appended - appended, len(self))
+    return self[len(self) - n:] if n > 0 else [ ]
+
+  def pick_source(self, start_ts:int, width:int) -> ColumnWindow:
+    # among raw frames and tiers no coarser than `width`, prefer whoever reaches back to
+    # `start_ts` (or the furthest), then the coarsest one
+    sources = [self] + [tier for tier in self.tiers if tier.width <= width]
+    inf = float('inf')
+    return min(sources, key=lambda s: (max(inf if s.first_ts is None else s.first_ts, start_ts), -s.width))
+
+  def downsample(self, start_ts:int, end_ts:int, max_points:int=None, resolution:int=None) -> dict:
+    # bucketed min/mean/max per series, at most `max_points` buckets or `resolution` seconds each
+    width = resolution or -(-(end_ts - start_ts + 1) // max_points)
+    source = self.pick_source(start_ts, width)
+    if source is self:
+      i, j = self.span(start_ts, end_ts)
+      k0, k1 = self.head + i, self.head + j
+      parts = partials(self.ts[k0:k1], self.values[k0:k1])
+    else:
+      parts = source.parts(start_ts, end_ts)
+    return series_to_dict(self.columns, *rebucket(*parts, start_ts, width), width, source.name)
+
+  def frame(self, i:int) -> dict:
+    # rebuild the i-th alive frame in the struct of `client.runtime_info`
+    k = self.head + i
+    row, procs = self.values[k], self.procs[k]
+    gpus = [ ]
+    for gpu_id in self.gpu_ids:
+      vals = [row[self.col_of[(gpu_id, field)]] for field in GPU_FIELDS]
+      if all(np.isnan(v) for v in vals): continue     # not reported in this frame
+      gpu = {'gpu_id': gpu_id}
+      gpu.update({field: _to_value(field, v) for field, v in zip(GPU_FIELDS, vals)})
+      gpu['procs'] = _unpack_procs(procs, gpu_id)
+      gpus.append(gpu)
+
+    frame = {'gpu': gpus or None}
+    frame.update({field: _to_value(field, row[self.col_of[field]]) for field in SCALAR_FIELDS})
+    frame['ts'] = int(self.ts[k])
+    return frame
@@ -2,9 +2,15 @@
 # Author: Armit
 # Create Time: 2021/09/16 
 
+import json
+import zlib
+import base64
 from dataclasses import dataclass, asdict
 from types import FunctionType
-from typing import Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
+
+try: import msgpack
+except ImportError: msgpack = None
 
 from utils import now_ts
 
@@ -38,11 +44,16 @@ class StatsPacket(Packet):
   # NOTE: list of struct of `client.running_tasks_info.value`
   tasks: List[dict] = None
 
+  # type == 'batch'
+  # NOTE: ordered list of dict of StatsPacket typed in ['hardware', 'runtime', 'tasks']
+  batch: List[dict] = None
+
 
 @dataclass
 class QueryPacket(Packet):
 
   type: str = None
+  etag: str = None            # of the last reply got, answered with 304 Not Modified when still valid
 
   # type == 'setting'
 
@@ -55,12 +66,35 @@ class QueryPacket(Packet):
   # type == 'runtime'
   start_ts: int = None
   end_ts: int = None
+  max_points: int = None      # downsample to at most this many buckets
+  resolution: int = None      # downsample to buckets of this many seconds
 
   # type == 'task'
   username: str = None
   command: str = None
   start_ts: int = None
   end_ts: int = None
+  limit: int = None           # page size, all tasks at once if not given
+  cursor: str = None          # opaque, as returned by the previous page
+  order: str = None           # by start_ts, 'asc' (default) or 'desc'
+
+  # type == 'userstats'
+  username: str = None
+  start_ts: int = None
+  end_ts: int = None
+
+  # type == 'aggregate'
+  source: str = None          # 'tasks' (default) or 'runtime'
+  hostname: str = None
+  username: str = None        # tasks only
+  gpu_id: int = None
+  group_by: List[str] = None  # among hostname, username, gpu_id, ts, hour_of_day, weekday
+  metrics: List[str] = None   # 'count' or '<sum|mean|min|max>:<field>'
+  start_ts: int = None
+  end_ts: int = None
+  resolution: int = None      # seconds of a 'ts' bucket
+
+  # type == 'streaming'
 
 
 @dataclass
@@ -82,17 +116,23 @@ class ResponsePacket(Packet):
 class ReplyPacket(ResponsePacket):
 
   data: Union[List, Dict] = None
+  etag: str = None
+  cursor: str = None          # continuation of a paged query, None on the last page
 
 
 # short hand factory for ResponsePackets
 class RESPONSE:
 
   OK =             lambda data=None: ReplyPacket(status_code=200, reason='OK', ts=now_ts(), data=data)
+  NOT_MODIFIED =   lambda etag=None: ReplyPacket(status_code=304, reason='Not Modified', ts=now_ts(), etag=etag)
   BAD_REQUEST =           lambda: ResponsePacket(status_code=400, reason='Bad Request', ts=now_ts())
   UNAUTHORIZED =          lambda: ResponsePacket(status_code=401, reason='Unauthorized', ts=now_ts())
   NOT_ACCEPTABLE = lambda data=None: ReplyPacket(status_code=406, reason='Not Acceptable', ts=now_ts(), data=data)
+  PAYLOAD_TOO_LARGE =     lambda: ResponsePacket(status_code=413, reason='Payload Too Large', ts=now_ts())
+  UNSUPPORTED_MEDIA_TYPE = lambda: ResponsePacket(status_code=415, reason='Unsupported Media Type', ts=now_ts())
   INTERNAL_SERVER_ERROR = lambda: ResponsePacket(status_code=500, reason='Internal Server Error', ts=now_ts())
   NOT_IMPLEMENTED =       lambda: ResponsePacket(status_code=501, reason='Not Implemented', ts=now_ts())
+  SERVICE_UNAVAILABLE = lambda data=None: ReplyPacket(status_code=503, reason='Service Unavailable', ts=now_ts(), data=data)
 
 
 # packet optimize
@@ -110,5 +150,74 @@ def packet_to_dict(packet:Union[Packet, FunctionType]) -> dict:
     return wrapper
   else: raise ValueError
 
+def dict_diff(old:dict, new:dict) -> dict:
+  # field-level delta turning `old` into `new`, removed keys become None
+  # NOTE: nested dicts recurse, lists of equal length are diffed by index keyed as str,
+  #       other changed values are sent as a whole
+  d = { }
+  for k, v in new.items():
+    if k not in old:
+      d[k] = v
+      continue
+    o = old[k]
+    if o == v: continue
+    if isinstance(o, dict) and isinstance(v, dict):
+      d[k] = dict_diff(o, v)
+    elif isinstance(o, list) and isinstance(v, list) and len(o) == len(v):
+      d[k] = {str(i): dict_diff(a, b) if isinstance(a, dict) and isinstance(b, dict) else b
+              for i, (a, b) in enumerate(zip(o, v)) if a != b}
+    else:
+      d[k] = v
+  for k in old:
+    if k not in new: d[k] = None
+  return d
+
 def make_reason(reason:str) -> dict:
   return {'reason': reason}
+
+def encode_cursor(state:list) -> str:
+  # opaque to clients, only the server reads it back
+  return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode()).decode()
+
+def decode_cursor(cursor:str) -> Optional[list]:
+  try:    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+  except: return None
+
+
+# wire encoding
+# NOTE: negotiated by `Content-Type`/`Accept` on HTTP, by the `encoding` event on websocket;
+#       'json' is the default and the only one browsers are assumed to speak
+MIMETYPES = {
+  'json':    'application/json',
+  'zjson':   'application/x-zlib-json',     # zlib compressed JSON, stdlib only
+  'msgpack': 'application/msgpack',         # needs `msgpack` installed
+}
+
+def resolve_encoding(encoding:str) -> str:
+  # the nearest encoding available here, msgpack falls back to zjson
+  if encoding == 'msgpack' and msgpack is None: return 'zjson'
+  return encoding if encoding in MIMETYPES else 'json'
+
+def encoding_of(mimetype:str) -> str:
+  for encoding, mt in MIMETYPES.items():
+    if mt == mimetype: return encoding
+  return 'json'
+
+def encode_payload(obj:Any, encoding:str='json') -> bytes:
+  if encoding == 'msgpack':
+    return msgpack.packb(obj, use_bin_type=True)
+  data = json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+  return zlib.compress(data) if encoding == 'zjson' else data
+
+class PayloadTooLarge(ValueError): pass
+
+def decode_payload(data:bytes, encoding:str='json', max_size:int=None) -> Any:
+  # `max_size` bounds what compressed data inflates to, so that a small body cannot blow up the memory
+  if encoding == 'msgpack':
+    if msgpack is None: raise ValueError('msgpack not installed')
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+  if encoding == 'zjson':
+    dec = zlib.decompressobj()
+    data = dec.decompress(data, max_size or 0)
+    if dec.unconsumed_tail: raise PayloadTooLarge(f'inflates to more than {max_size} bytes')
+  return json.loads(data)
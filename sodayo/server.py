@@ -4,21 +4,35 @@
 
 import os
 import signal
+import socket
 import re
+import hashlib
+import pickle as pkl
+from collections import deque
 from itertools import islice
+from functools import lru_cache
+from operator import itemgetter
 from threading import RLock, Thread, Event
+from queue import Queue, Full, Empty
+from time import perf_counter
+from copy import deepcopy
+from contextlib import contextmanager
 from importlib import reload as reload_module
 from uuid import uuid4 as gen_uuid
 from time import sleep
 from traceback import format_exc
+from typing import Any, Container, Dict, Iterator, List, Optional, Tuple, Union
 
-from flask import Flask, jsonify, request, session
+from flask import Flask, g, json, jsonify, request, session, stream_with_context
 from flask.json import loads
-from flask_socketio import SocketIO, emit, send
+from flask_socketio import SocketIO, emit, send, join_room, leave_room
+from werkzeug.serving import make_server
 
 import settings as hp
 from packets import *
 from utils import *
+from history import RuntimeHistory, GPU_FIELDS
+from aggregate import SOURCES, TaskColumns, check_group_by, parse_metric, runtime_columns
 
 
 __version__ = '0.1'     # 2021/09/18
@@ -32,6 +46,12 @@ __version__ = '0.1'     # 2021/09/18
 #                     stdata
 #   Service Layer:    utils
 #                     tasks
+#                     ingest
+#                     query cache
+#                     streaming
+#                     liveness
+#                     persistence
+#                     workers
 #                     services
 #   Route Layer:      HTTP routes
 #                     WebSocket events
@@ -45,7 +65,27 @@ __role__ = 'server'
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'Kimi mo Sodayo!'
 socketio = SocketIO(app)
-lock = RLock()      # for r/w `runtime_info`
+lock = StatLock()   # for r/w aggregates shared by hosts: `TaskRecord`, `quota_info`, `usage_info`, `userstats_info`
+host_locks = { }    # for w `runtime_info`, a StatLock per host
+ws_lock = RLock()   # for r/w `ws_*` streaming states
+ingest_lock = RLock()     # for r/w `ingest_stats`
+wal_lock = RLock()        # for logging to `wal` and enqueuing in one go, r/w `ingest_pending`
+persist_lock = RLock()    # for dumping stdata/rtdata, one at a time
+liveness_lock = RLock()   # for r/w `liveness`, `liveness_deadlines`
+# (hostname, stats data, enqueued perf_counter, lsns in `wal`), sharded by host so a host is always applied in order
+ingest_queues = [Queue(maxsize=hp.INGEST_QUEUE_SIZE) for _ in range(max(hp.INGEST_WORKERS, 1))]
+ingest_gates = [RLock() for _ in ingest_queues]     # held while applying a shard, all taken to checkpoint
+ingest_pending = set()    # lsns logged but not applied yet, i.e. still in `ingest_queues`
+# ('tasks'/'runtime', hostname, payload), mutations logged before acked, replayed on top of last checkpoint
+wal = WriteAheadLog(os.path.join(hp.DATA_PATH, WAL_DIRNAME), hp.WAL_SYNC_INTERVAL / 1000, hp.WAL_SYNC_RECORDS)
+boot_id = gen_uuid().hex[:8]    # salt of etags, versions start over on restart
+worker_id = 0                   # 0 for the primary process, forked workers count from 1, see `SERVER_WORKERS`
+worker_pids = [ ]               # of the forked workers, known by the primary
+# between the primary and the workers: stats forwarded in, states and stream events published out
+bus = SQLiteBus(os.path.join(hp.DATA_PATH, 'bus.db'))
+bus_outbox = deque()            # (kind, hostname, payload), stream events to publish on the next tick
+bus_published = { }             # name => version or pickled value last published, to publish only changes
+bus_cursors = { }               # hostname => `RuntimeHistory.appended` published, None to publish it whole again
 with open('index.html', encoding='utf-8') as fp:
   html_page = fp.read()
 
@@ -68,8 +108,21 @@ hardware_info = {
 
 # for `stats`/`query`
 # NOTE: length truncated by `RTDATA_TRUNCATE_EXPIRE`
+# NOTE: a `LazyDict` if mapped from the snapshot, see `RTDATA_SNAPSHOT_VARS`
 runtime_info = {
-  # 'server1': deque of struct `client.runtime_info`
+  # 'server1': RuntimeHistory of struct `client.runtime_info`
+}
+
+# for `startup`, the mark of `wal` covered by the dumped data: all up to `lsn` are applied but those `pending`
+checkpoint_info = {
+  # 'lsn': 233,
+  # 'pending': [231],
+  # 'inbox': 42,      # last row of the bus inbox logged, with `SERVER_WORKERS` > 1
+}
+
+# for `query`, read-only snapshots of `runtime_info` published after each write, readers never lock
+runtime_views = {
+  # 'server1': RuntimeHistory.snapshot()
 }
 
 # for `heatrbeat`
@@ -83,11 +136,84 @@ quota_info = {
   # 'nobody': [233*60, 1500*60]    # [available, total], int in minutes
 }
 
+# for `stats`/`query`, GPU time charged against `quota_info`
+# NOTE: reset at beginning of each month
+usage_info = {
+  # 'month': '2021-09',
+  # 'used': {'nobody': 233*60*60},                        # int in seconds
+  # 'live': {('server1', 0, 'nobody', 1631766896): [accrued, last_seen_ts]},  # running procs charged so far
+}
+
+# for `query`, partial aggregates of finished tasks per user per day
+# NOTE: truncated by `STDATA_TRUNCATE_EXPIRE`
+userstats_info = {
+  # 'nobody': {'2021-09-18': [count, total_duration, [seconds_busy in each hour of day] * 24]},
+}
+
 # for (browser only) `streamming`, this is transient and need NOT be dumpable
 ws_resources = {
-  # 'uuid': ?
+  # 'uuid': {'rooms': {'runtime:server1', 'quota:*'}, 'encoding': 'json'}
+}
+
+# for (browser only) `streamming`, subscriber count of each room, aka. '<channel>:<hostname or *>'
+ws_rooms = {
+  # 'runtime:server1': 2
+}
+
+# for (browser only) `streamming`, last state pushed to each room per host, deltas are made against it
+ws_states = {
+  # ('runtime:server1', 'server1'): [state, last_keyframe_ts]
+}
+
+# for (browser only) `streamming`, updates waiting for the next broadcast tick, per room per host
+ws_pending = {
+  # 'runtime:*': {'server1': state},
+  # 'tasks:*': {'server1': [task]},
+}
+
+# for (browser only) `streamming`, broadcast counters
+ws_counters = {
+  'ticks': 0,
+  'frames_sent': 0,
+  'frames_coalesced': 0,      # frames replaced by a newer one from the same host within a tick
+  'bytes_saved': 0,           # JSON size of the messages coalesced frames would have made, estimated at flush
+}
+
+# for (browser only) `streamming`, frames coalesced per room per host within this tick
+ws_coalesced = {
+  # ('runtime:*', 'server1'): 2
+}
+
+# for `query`/`streamming`, [state, host(ip)] of each host, rebuilt from `last_ACK_info` on startup, this is transient
+# NOTE: state goes 'alive' => 'stale' => 'dead' (fixed slaves) or evicted (dynamic registered), back to 'alive' on ACK
+liveness = {
+  # 'server1': ['alive', '127.0.0.1'],
+}
+# for `liveness`, when the next state transition of each host is due
+liveness_deadlines = ExpiryHeap()
+
+# for `stats` ingest, counters and latencies (count, total, max in seconds) of the worker, this is transient
+ingest_stats = {
+  'enqueued': 0,
+  'rejected': 0,              # queue full, answered 503
+  'applied': 0,
+  'failed': 0,                # raised or not answered 200 when applied, dropped
+  'batches': 0,
+  'enqueue_latency': [0, 0.0, 0.0],     # inline check & enqueue in the request handler
+  'queue_latency': [0, 0.0, 0.0],       # waiting in queue
+  'apply_latency': [0, 0.0, 0.0],       # applying a batch by the worker
 }
 
+# for `query` caching, versions of the data replies are made from, this is transient
+data_versions = {
+  'settings': 0,    # bumped by `reload_settings`
+  'all': 0,         # bumped by any change
+  'hosts': { },     # bumped by changes of each host, e.g. 'server1': 42
+}
+
+# for `query` caching, replies keyed by normalized query, validated by etag made from `data_versions`
+query_cache = SizedLRU(hp.QUERY_CACHE_SIZE)
+
 ##############################################################################
 # stdata: 持久存档数据
 # NOTE: record class SHOULD named `xxRecord`, MUST subclassing from `Record` and **metaclassing** from `RecordMeta`
@@ -107,24 +233,158 @@ class TaskRecord(Record, metaclass=RecordMeta):
   #   ts: int
   # }
 
+  order_key = 'start_ts'
+  index_keys = ('hostname', 'username', 'gpu_id')
+  column_keys = ('end_ts', 'command')
+
+  # inverted index over command line tokens (script names, argv), token => [(key, Task)]
+  # _postings: Dict[str, List[Tuple[tuple, dict]]]
+  # columnar mirror for `query_aggregate`, built on first use and dropped on reindex
+  # _columns: Optional[TaskColumns]
+  # tasks added while the mirror is being built, caught up at last
+  # _columns_backlog: Optional[List[dict]]
+  _columns_lock = RLock()     # one build at a time
+
+  @classmethod
+  def index(cls, key:tuple, obj:dict):
+    super().index(key, obj)
+    for token in set((obj.get('command') or '').split()):
+      posting = cls._postings.get(token)
+      if posting is None: posting = cls._postings[token] = [ ]
+      posting.append((key, obj))
+    if cls._columns is not None:           cls._columns.add(obj)
+    elif cls._columns_backlog is not None: cls._columns_backlog.append(obj)
+
+  @classmethod
+  def reindex(cls):
+    cls._postings = { }
+    cls._columns = None
+    cls._columns_backlog = None
+    super().reindex()
+
+  @classmethod
+  def columns(cls, start_ts:int, end_ts:int) -> TaskColumns:
+    # the mirror covering at least tasks started within `[start_ts, end_ts]`
+    if cls.store:
+      # other workers add tasks too, so no mirror is kept here; extract the range on each query
+      cols = TaskColumns()
+      for task in cls.store.iter_select(cls, lo=start_ts, hi=end_ts): cols.add(task)
+      return cols
+    cols = cls._columns
+    if cols is None:
+      with cls._columns_lock:
+        cols = cls._columns or cls.build_columns()
+    return cols
+
+  @classmethod
+  def build_columns(cls) -> TaskColumns:
+    # built out of `lock` from a copy, so that ingest goes on meanwhile
+    with lock:
+      objects = list(cls.objects)
+      cls._columns_backlog = [ ]
+    cols = TaskColumns(capacity=max(len(objects) * 2, 1024))
+    for obj in objects: cols.add(obj)
+    with lock:
+      # kept unless reindexed meanwhile, e.g. truncated, then it only serves this query
+      if cls._columns_backlog is not None:
+        for obj in cls._columns_backlog: cols.add(obj)
+        cls._columns = cols
+      cls._columns_backlog = None
+    return cols
+
+  @classmethod
+  def search_command(cls, command:str) -> Optional[Dict[int, Tuple[tuple, dict]]]:
+    # superset of tasks `command` may match, None if the pattern cannot be narrowed down
+    # NOTE: a literal hit contains each word of `command` inside some token,
+    #       a regex hit starts with the literal prefix of the pattern
+    words = command.split()
+    if not words: return None
+
+    hits = None
+    for word in words:
+      found = cls._postings_where(lambda token: word in token)
+      hits = found if hits is None else {k: v for k, v in hits.items() if k in found}
+    if COMMAND_META_REGEX.search(command):
+      prefix = literal_prefix(command).split()
+      if not prefix: return None
+      hits.update(cls._postings_where(lambda token: token.startswith(prefix[0])))
+    return hits
+
+  @classmethod
+  def _postings_where(cls, pred) -> Dict[int, Tuple[tuple, dict]]:
+    # the vocabulary is far smaller than the tasks, scanning it beats matching every command line
+    return {id(obj): (key, obj) for token, posting in cls._postings.items() if pred(token) for key, obj in posting}
+
   @classmethod
   @perf_timer
   def query(cls, hostname:str=None, gpu_id:int=None, username:str=None, 
-                 start_ts:int=None, end_ts:int=None, command:str=None):
-    rs = [ ]
-    for t in cls.objects:
-      try:
-        if hostname and hostname != t['hostname']: continue
-        if gpu_id   and gpu_id   != t['gpu_id']:   continue
-        if username and username != t['username']: continue
-        if start_ts and t['start_ts'] < start_ts:  continue
-        if end_ts   and end_ts < t['end_ts']:      continue
-        if command  and (command not in t['command']) \
-                    and (not re.match(command, t['command'])): continue
-        rs.append(t)
-      except: pass
-    rs.sort(key=lambda t: t['start_ts'])
-    return rs
+                 start_ts:int=None, end_ts:int=None, command:str=None) -> List[dict]:
+    return list(cls.iter_query(hostname, gpu_id, username, start_ts, end_ts, command))
+
+  @classmethod
+  def iter_query(cls, hostname:str=None, gpu_id:int=None, username:str=None, start_ts:int=None, end_ts:int=None,
+                      command:str=None, reverse:bool=False, after:Tuple[int, int]=None) -> Iterator[dict]:
+    # lazy `query()`, by `start_ts` descending if `reverse`
+    # `after` is `(start_ts, n)` to resume past the first n tasks at that `start_ts`, which were seen already
+    eq = {k: v for k, v in [('hostname', hostname), ('gpu_id', gpu_id), ('username', username)] if v is not None}
+    # NOTE: a task always ends after it starts, so `end_ts` also bounds `start_ts`
+    lo, hi = start_ts, end_ts
+    if after:
+      if not reverse: lo = after[0] if lo is None else max(lo, after[0])
+      else:           hi = after[0] if hi is None else min(hi, after[0])
+
+    # postings are kept in memory only, sqlite gets the filters pushed down instead
+    hits = cls.search_command(command) if command and not cls.store else None
+    if hits is not None:
+      # only touch the matching postings
+      rs = [obj for key, obj in sorted(hits.values(), key=itemgetter(0), reverse=reverse)
+            if (lo is None or lo <= key[0]) and (hi is None or key[0] <= hi) and all(obj.get(k) == v for k, v in eq.items())]
+      if end_ts:
+        rs = [t for t in rs if t.get('end_ts') is not None and t['end_ts'] <= end_ts]
+    else:
+      # a literal command must be contained in the hits, while a regex one only has a prefix
+      rs = cls.iter_select(eq, lo=lo, hi=hi,
+                           upto=end_ts and {'end_ts': end_ts},
+                           contains=command and not COMMAND_META_REGEX.search(command) and {'command': command} or None,
+                           reverse=reverse)
+    if command:
+      pattern = compile_command(command)
+      rs = (t for t in rs if match_command(command, pattern, t.get('command')))
+    if after:
+      rs = skip_seen(rs, cls.order_key, *after)
+    return iter(rs)
+
+def skip_seen(rs:Iterator[dict], key:str, value:Any, n:int) -> Iterator[dict]:
+  # drop the leading `n` objects whose `key` is `value`
+  for obj in rs:
+    if n > 0 and obj[key] == value:
+      n -= 1
+      continue
+    n = 0
+    yield obj
+
+COMMAND_META_REGEX = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+@lru_cache(maxsize=256)
+def compile_command(command:str) -> Optional[re.Pattern]:
+  # compile once per pattern, None for a bad one and thus matches literally only
+  try:    return re.compile(command)
+  except re.error: return None
+
+def match_command(command:str, pattern:Optional[re.Pattern], s:str) -> bool:
+  if not s: return False
+  if command in s: return True
+  return pattern is not None and pattern.match(s) is not None
+
+def literal_prefix(pattern:str) -> str:
+  # the leading chars any `re.match` hit must start with
+  if '|' in pattern: return ''
+  if pattern.startswith('^'): pattern = pattern[1:]
+  m = COMMAND_META_REGEX.search(pattern)
+  if not m: return pattern
+  prefix = pattern[:m.start()]
+  if m.group() in '*?{': prefix = prefix[:-1]    # the last char is optional
+  return prefix
 
 
 ##############################################################################
@@ -134,20 +394,62 @@ class TaskRecord(Record, metaclass=RecordMeta):
 def startup():
   logger.info(f'[startup]')
 
+  # workers only mirror what the primary publishes, tasks are read from the sqlite it commits to
+  if worker_id:
+    load_stdata()
+    socketio.start_background_task(stream_ticker)
+    Thread(target=bus_follower, daemon=True).start()
+    return
+
   # prewatch for fixed slaves
-  reload_quota_rule()
   for sock in hp.SLAVES_SOCKET:
     registry_info[sock] = 'unknown'
 
   load_stdata()
   load_rtdata(globals(), prefix=__role__)
+  reload_quota_rule()       # rules on disk win over the dumped totals
+  if not userstats_info:
+    for task in TaskRecord.select():
+      try:    tally_task(task)
+      except: pass
+
+  # runtime history mapped from a snapshot is restored host by host on first access, otherwise all at once
+  if isinstance(runtime_info, LazyDict):
+    runtime_info.hook = restore_runtime
+  else:
+    for name, rtdata in list(runtime_info.items()):
+      runtime_info[name] = restore_runtime(name, rtdata)
+
+  wal_replay()
+  wal.open()
+  socketio.start_background_task(stream_ticker)
+  for queue, gate in zip(ingest_queues, ingest_gates):
+    Thread(target=ingest_worker, args=(queue, gate), daemon=True).start()
+  if multi_worker(): bus_take()     # acked before the restart
+  Thread(target=persist_worker, daemon=True).start()
+  Thread(target=wal_syncer, daemon=True).start()
+
+  now_ts_freeze = now_ts()
+  for host, hostname in registry_info.items():
+    if hostname in hardware_info or hostname in last_ACK_info:
+      liveness_touch(host, hostname, last_ACK_info.get(hostname, now_ts_freeze), notify=False)
+  Thread(target=liveness_ticker, daemon=True).start()
+  if multi_worker(): Thread(target=bus_leader, daemon=True).start()
 
 @perf_timer
 def cleanup():
   logger.info(f'[cleanup]')
+  if worker_id: return
+
+  for pid in worker_pids:
+    try: os.kill(pid, signal.SIGTERM)
+    except OSError: pass
+  ingest_drain()
+  checkpoint()
+  wal.close()
 
-  dump_stdata()
-  dump_rtdata(globals(), prefix=__role__)
+def rollup_tiers() -> List[Tuple[int, int]]:
+  return [(width, day_to_sec(days)) for width, days in hp.RTDATA_ROLLUP_TIERS]
 
 def reload_quota_rule():
   if not os.path.exists(hp.QUOTA_RULE_FILE):
@@ -162,9 +464,87 @@ def reload_quota_rule():
         quota = int(quota)
         if username in quota_info: quota_info[username][1] = quota * 60
         else:                      quota_info[username] = [quota * 60, quota * 60]
+        _refresh_quota(username)
       except:
         logger.warning(f'[parse_quota_rule] cannot parse line {line:!r}, ignored')
 
+def roll_usage_month(ts:int):
+  # start over at the beginning of each month
+  month = ts_to_month(ts)
+  if usage_info.get('month') == month: return
+
+  logger.info(f'[roll_usage_month] {usage_info.get("month")} => {month}')
+  usage_info['month'] = month
+  usage_info['used'] = { }
+  # procs still running are charged for the new month only
+  for live in usage_info.setdefault('live', { }).values(): live[0] = 0
+  for username in quota_info: _refresh_quota(username)
+
+def charge_runtime(hostname:str, runtime:dict):
+  # accrue GPU time of running procs since they were last seen
+  ts = runtime['ts']
+  roll_usage_month(ts)
+  month_start = month_start_ts(ts)
+  lives = usage_info['live']
+  for gpu in runtime.get('gpu') or [ ]:
+    for proc in gpu.get('procs') or [ ]:
+      if proc.get('start_ts') is None: continue
+      key = (hostname, gpu.get('gpu_id'), proc.get('username'), proc['start_ts'])
+      live = lives.get(key)
+      if live is None: live = lives[key] = [0, proc['start_ts']]
+      delta = max(ts - max(live[1], month_start), 0)
+      live[0] += delta
+      live[1] = max(live[1], ts)
+      _charge(proc.get('username'), delta)
+
+  # forget procs of this host gone for long without a finished task reported
+  expired = [key for key, live in lives.items() if key[0] == hostname and live[1] + day_to_sec(1) < ts]
+  for key in expired: del lives[key]
+
+def charge_task(hostname:str, task:dict):
+  # settle a finished task, minus what has been accrued while it was running
+  now_ts_freeze = now_ts()
+  roll_usage_month(now_ts_freeze)
+  key = (hostname, task.get('gpu_id'), task.get('username'), task.get('start_ts'))
+  live = usage_info['live'].pop(key, None)
+  total = max(task['end_ts'] - max(task['start_ts'], month_start_ts(now_ts_freeze)), 0)
+  _charge(task.get('username'), total - (live[0] if live else 0))
+
+def tally_task(task:dict):
+  # count the task to the day it starts, spread its busy time over the hours it spans
+  username, start_ts, end_ts = task['username'], task['start_ts'], task['end_ts']
+  days = userstats_info.get(username)
+  if days is None: days = userstats_info[username] = { }
+
+  def bucket_of(day:str) -> list:
+    if day not in days:
+      days[day] = [0, 0, [0] * 24]
+      # a new day comes, forget the expired ones
+      expire = (date.fromisoformat(day) - timedelta(days=hp.STDATA_TRUNCATE_EXPIRE)).isoformat()
+      for k in [k for k in days if k < expire]: del days[k]
+    return days[day]
+
+  bucket = bucket_of(datetime.fromtimestamp(start_ts).date().isoformat())
+  bucket[0] += 1
+  bucket[1] += max(end_ts - start_ts, 0)
+
+  ts = start_ts
+  while ts < end_ts:
+    dt = datetime.fromtimestamp(ts)
+    hour_end = min(int(datetime.timestamp(dt.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1))), end_ts)
+    bucket_of(dt.date().isoformat())[2][dt.hour] += hour_end - ts
+    ts = hour_end
+
+def _charge(username:str, seconds:int):
+  if not username or not seconds: return
+  used = usage_info['used']
+  used[username] = max(used.get(username, 0) + seconds, 0)
+  _refresh_quota(username)
+
+def _refresh_quota(username:str):
+  if username not in quota_info: return
+  quota_info[username][0] = quota_info[username][1] - usage_info.get('used', { }).get(username, 0) // 60
+
 def reload_settings(signum, frame):
   logger.info('[reload_settings]')
 
@@ -175,6 +555,9 @@ def reload_settings(signum, frame):
   from utils import _reload_settings
   _reload_settings()
 
+  query_cache.capacity = hp.QUERY_CACHE_SIZE
+  bump_version(None, settings=True)
+
 
 ##############################################################################
 # tasks
@@ -189,10 +572,10 @@ def heartbeat(host:str, hostname:str) -> ResponsePacket:
     # host replaced, clear old data
     if hostname_old != hostname:
       registry_info[host] = hostname
-      del hardware_info[hostname_old]
-      del runtime_info[hostname_old]
-      del last_ACK_info[hostname_old]
+      forget_host(hostname_old)
+    else: return RESPONSE.OK()
 
+  bump_version(hostname)
   return RESPONSE.OK()
 
 def stats_hardware(hostname:str, data:dict=None) -> ResponsePacket:
@@ -202,31 +585,72 @@ def stats_hardware(hostname:str, data:dict=None) -> ResponsePacket:
   hardware_info[hostname] = hardware
   return RESPONSE.OK()
 
-@with_lock(lock)
 def stats_runtime(hostname:str, data:dict=None) -> ResponsePacket:
   runtime = data.get('runtime')
   if None is runtime: return RESPONSE.BAD_REQUEST()
 
-  # sanitize history
-  if hostname not in runtime_info: runtime_info[hostname] = deque()
-  now_ts_freeze = now_ts()
-  if 'ts' not in runtime: runtime['ts'] = now_ts_freeze    # sigil if absent
-  runtime_info[hostname].append(runtime)
-  while runtime_info[hostname][0]['ts'] + day_to_sec(hp.RTDATA_TRUNCATE_EXPIRE) < now_ts_freeze:
-    runtime_info[hostname].popleft()
+  if 'ts' not in runtime: runtime['ts'] = now_ts()    # sigil if absent
+  with host_lock(hostname):
+    fresh = apply_runtime(hostname, runtime)
+
+  if not fresh:
+    logger.warning(f'[stats_runtime] drop stale frame from {hostname} at {runtime["ts"]}')
+  else:
+    with lock: charge_runtime(hostname, runtime)
 
   return RESPONSE.OK()
 
+@with_lock(lock)
 def stats_tasks(hostname:str, data:dict=None) -> ResponsePacket:
   tasks = data.get('tasks')
   if None is tasks: return RESPONSE.BAD_REQUEST()
 
-  now_ts_freeze = now_ts()
+  apply_tasks(hostname, tasks)        # sigil ts stamped by `wal_log`
+  return RESPONSE.OK()
+
+def restore_runtime(hostname:str, rtdata:Union[RuntimeHistory, deque]) -> RuntimeHistory:
+  # convert runtime history dumped as deque of frames by older versions
+  if not isinstance(rtdata, RuntimeHistory):
+    rtdata = RuntimeHistory.from_frames(rtdata)
+  rtdata.sync_tiers(rollup_tiers())
+  runtime_views[hostname] = rtdata.snapshot()
+  return rtdata
+
+def apply_runtime(hostname:str, runtime:dict) -> bool:
+  # under host lock, returns False if the frame is stale
+  rtdata = runtime_info.get(hostname)
+  if rtdata is None: rtdata = runtime_info[hostname] = RuntimeHistory(tiers=rollup_tiers())
+  fresh = rtdata.append(runtime)
+  rtdata.truncate(now_ts() - day_to_sec(hp.RTDATA_TRUNCATE_EXPIRE))
+  runtime_views[hostname] = rtdata.snapshot()
+  return fresh
+
+def apply_tasks(hostname:str, tasks:List[dict], record:bool=True):
+  # under `lock`, `record=False` if the stdata already has them
   for task in tasks:
-    task['ts'] = now_ts_freeze          # sigil ts
-    try:    TaskRecord.add(task)
+    try:
+      if record: TaskRecord.add(task)
+      charge_task(hostname, task)
+      tally_task(task)
     except: logger.warning(format_exc())
-  return RESPONSE.OK()
+
+def stats_batch(hostname:str, data:dict=None) -> ReplyPacket:
+  # sub-packets applied in order, each gets its own status
+  batch = data.get('batch')
+  if not isinstance(batch, list): return RESPONSE.BAD_REQUEST()
+
+  res = [ ]
+  for item in batch:
+    fn = isinstance(item, dict) and item.get('type') != 'batch' and globals().get(f'stats_{item.get("type")}')
+    if not fn:
+      r = RESPONSE.BAD_REQUEST()
+    else:
+      try: r = fn(hostname, item)
+      except:
+        logger.error(format_exc())
+        r = RESPONSE.INTERNAL_SERVER_ERROR()
+    res.append({'status_code': r.status_code, 'reason': r.reason})
+  return RESPONSE.OK(data=res)
 
 def query_settings(**kwargs) -> ReplyPacket:
   kv = {k: getattr(hp, k) for k in dir(hp) if not k.startswith('__')}
@@ -234,14 +658,130 @@ def query_settings(**kwargs) -> ReplyPacket:
 
 def query_quota(**kwargs) -> ReplyPacket:
   username = kwargs.get('username')
-  
+  # racing with `charge_*` at the month boundary otherwise, and copied for the same
+  with lock:
+    roll_usage_month(now_ts())
+    if None is username:
+      data = {name: list(quota) for name, quota in quota_info.items()}
+    elif username in quota_info:
+      data = {username: list(quota_info[username])}
+    else: data = None
+
+  if None is data:
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason('requested user not found'))
+  return RESPONSE.OK(data=data)
+
+def query_userstats(**kwargs) -> ReplyPacket:
+  username = kwargs.get('username')
+  now_ts_freeze = now_ts()
+  start_ts = kwargs.get('start_ts') or month_start_ts(now_ts_freeze)
+  end_ts = kwargs.get('end_ts') or now_ts_freeze
+  if start_ts >= end_ts:
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason('start_ts should before end_ts'))
+
   if None is username:
-    return RESPONSE.OK(data=quota_info)
-  elif username in quota_info:
-    return RESPONSE.OK(data={username: quota_info[username]})
+    usernames = list(userstats_info)
+  elif username in userstats_info:
+    usernames = [username]
   else:
     return RESPONSE.NOT_ACCEPTABLE(data=make_reason('requested user not found'))
 
+  # sum up day buckets in range, never touch the tasks
+  start_day = datetime.fromtimestamp(start_ts).date()
+  n_days = (datetime.fromtimestamp(end_ts).date() - start_day).days + 1
+  day_keys = [(start_day + timedelta(days=i)).isoformat() for i in range(n_days)]
+
+  res = { }
+  for name in usernames:
+    days = userstats_info[name]
+    count, duration, hist = 0, 0, [0] * 24
+    for day in day_keys:
+      bucket = days.get(day)
+      if not bucket: continue
+      count += bucket[0]
+      duration += bucket[1]
+      hist = [a + b for a, b in zip(hist, bucket[2])]
+
+    # most busy hours that make up half of the busy time
+    active_hours, busy = [ ], 0
+    for hour in sorted(range(24), key=lambda h: -hist[h]):
+      if not hist[hour] or busy * 2 >= sum(hist): break
+      active_hours.append(hour)
+      busy += hist[hour]
+
+    res[name] = {
+      'count': count,
+      'total_duration': duration,
+      'avg_duration': count and duration // count,
+      'hist': hist,
+      'active_hours': sorted(active_hours),
+      'quota': quota_info.get(name),
+    }
+  return RESPONSE.OK(data=res)
+
+def query_streaming(**kwargs) -> ReplyPacket:
+  with ws_lock:
+    return RESPONSE.OK(data={**ws_counters, 'rooms': dict(ws_rooms)})
+
+def query_ingest(**kwargs) -> ReplyPacket:
+  with ingest_lock:
+    res = { }
+    for k, v in ingest_stats.items():
+      if k.endswith('_latency'):
+        count, total, max_ = v
+        res[k] = {'avg': count and round(total / count * 1000, 3), 'max': round(max_ * 1000, 3)}    # in ms
+      else:
+        res[k] = v
+  depths = [queue.qsize() for queue in ingest_queues]
+  return RESPONSE.OK(data={'queue_depth': sum(depths), 'queue_depths': depths, 'queue_size': hp.INGEST_QUEUE_SIZE, **res})
+
+def query_locks(**kwargs) -> ReplyPacket:
+  # wait stats of the shared lock '*' and of each host lock
+  res = {'*': lock.stats()}
+  res.update({hostname: hl.stats() for hostname, hl in list(host_locks.items())})
+  return RESPONSE.OK(data=res)
+
+def query_metrics(**kwargs) -> ReplyPacket:
+  # of this process only, see `metrics`
+  return RESPONSE.OK(data=metrics.snapshot())
+
+@metrics.collector
+def server_metrics() -> Iterator[tuple]:
+  with ingest_lock:
+    counts = {k: v for k, v in ingest_stats.items() if not k.endswith('_latency')}
+  for k, v in counts.items():
+    yield 'counter', f'sodayo_ingest_{k}_total', { }, v
+  for i, queue in enumerate(ingest_queues):
+    yield 'gauge', 'sodayo_ingest_queue_depth', {'queue': i}, queue.qsize()
+  yield 'gauge',   'sodayo_query_cache_bytes', { }, query_cache.size
+  yield 'counter', 'sodayo_query_cache_hits_total', { }, query_cache.hits
+  yield 'counter', 'sodayo_query_cache_misses_total', { }, query_cache.misses
+  with liveness_lock:
+    states = [state for state, _ in liveness.values()]
+  for state in sorted(set(states)):
+    yield 'gauge', 'sodayo_hosts', {'state': state}, states.count(state)
+  with ws_lock:
+    n_clients = len(ws_resources)
+    counters = dict(ws_counters)
+  yield 'gauge', 'sodayo_ws_clients', { }, n_clients
+  for k, v in counters.items():
+    yield 'counter', f'sodayo_ws_{k}_total', { }, v
+
+def query_liveness(**kwargs) -> ReplyPacket:
+  hostname = kwargs.get('hostname')
+
+  now_ts_freeze = now_ts()
+  with liveness_lock:
+    states = {name: list(state) for name, state in liveness.items() if not hostname or name == hostname}
+  if hostname and not states:
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason('requested host not found'))
+
+  res = { }
+  for name, (state, host) in states.items():
+    last_ACK = last_ACK_info.get(name)
+    res[name] = {'state': state, 'host': host, 'last_ACK': last_ACK, 'idle': last_ACK and now_ts_freeze - last_ACK}
+  return RESPONSE.OK(data=res)
+
 def query_hardware(**kwargs) -> ReplyPacket:
   hostname = kwargs.get('hostname')
 
@@ -252,11 +792,12 @@ def query_hardware(**kwargs) -> ReplyPacket:
   else:
     return RESPONSE.NOT_ACCEPTABLE(data=make_reason('requested host not found'))
 
-@with_lock(lock)
 def query_runtime(**kwargs) -> ReplyPacket:
   hostname = kwargs.get('hostname')
   start_ts = kwargs.get('start_ts')
   end_ts = kwargs.get('end_ts')
+  max_points = kwargs.get('max_points')
+  resolution = kwargs.get('resolution')
   
   if hostname and hostname not in hardware_info:
     return RESPONSE.NOT_ACCEPTABLE(data=make_reason('requested host not found'))
@@ -266,48 +807,117 @@ def query_runtime(**kwargs) -> ReplyPacket:
   end_ts = end_ts or now_ts_freeze
   if start_ts >= end_ts:
     return RESPONSE.NOT_ACCEPTABLE(data=make_reason('start_ts should before end_ts'))
+  for v in [max_points, resolution]:
+    if v is not None and (not isinstance(v, int) or v <= 0):
+      return RESPONSE.NOT_ACCEPTABLE(data=make_reason('max_points and resolution should be positive int'))
+  downsample = max_points or resolution
 
   hostnames = hostname and [hostname] or registry_info.values()
   res = { }
   for name in hostnames:
-    rtdata = runtime_info.get(name)    # type(rtdata) == Deque
-    if not rtdata:
-      res[name] = [ ]
-      continue
-
-    # FIXME: binary search gets wrong when len(rtdata)==1, IGNORED due to not frequent
-    L, R,  = 0, len(rtdata) - 1
-    i = -1
-    while L < R:
-      i = (L + R) // 2
-      if start_ts <= rtdata[i]['ts']:
-        R = i
-      else:
-        L = i + 1
-
-    L, R,  = 0, len(rtdata) - 1
-    j = -1
-    while L < R:
-      j = (L + R) // 2
-      if j == L: break      # NOTE: a wired fixup
-      if rtdata[j]['ts'] <= end_ts:
-        L = j
-      else:
-        R = j - 1
-    
-    #logger.debug(f'slice rtdata[{i}, {j}]')
-    res[name] = -1 < i < j and list(islice(rtdata, i, j)) or [ ]
+    rtdata = runtime_view(name)
+    if downsample: res[name] = rtdata.downsample(start_ts, end_ts, max_points, resolution)
+    else:          res[name] = rtdata.between(start_ts, end_ts)
   return RESPONSE.OK(data=res)
 
-def query_tasks(**kwargs) -> ReplyPacket:
-  res = TaskRecord.query(hostname=kwargs.get('hostname'),
-                         gpu_id=kwargs.get('gpu_id'),
-                         username=kwargs.get('username'),
-                         start_ts=kwargs.get('start_ts'),
-                         end_ts=kwargs.get('end_ts'),
-                         command=kwargs.get('command'))
+def runtime_view(hostname:str) -> RuntimeHistory:
+  # read-only snapshot to query without lock
+  if hostname not in runtime_views and hostname in runtime_info:
+    runtime_info.get(hostname)           # not restored yet, publishes the view
+  return runtime_views.get(hostname) or RuntimeHistory(capacity=0)
 
-  return RESPONSE.OK(data=res)
+def query_aggregate(**kwargs) -> ReplyPacket:
+  source = kwargs.get('source') or 'tasks'
+  hostname = kwargs.get('hostname')
+  username = kwargs.get('username')
+  gpu_id = kwargs.get('gpu_id')
+  group_by = kwargs.get('group_by') or [ ]
+  metrics = kwargs.get('metrics') or ['count']
+  resolution = kwargs.get('resolution') or 60*60
+
+  if source not in SOURCES:
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason(f'source should be one of {list(SOURCES)}'))
+  if hostname and hostname not in hardware_info:
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason('requested host not found'))
+  if source == 'runtime' and username:
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason('username only filters tasks'))
+  now_ts_freeze = now_ts()
+  start_ts = kwargs.get('start_ts') or (now_ts_freeze - 7*24*60*60)
+  end_ts = kwargs.get('end_ts') or now_ts_freeze
+  if start_ts >= end_ts:
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason('start_ts should before end_ts'))
+  if not isinstance(resolution, int) or resolution <= 0:
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason('resolution should be positive int'))
+  if isinstance(group_by, str): group_by = [group_by]
+  if isinstance(metrics, str): metrics = [metrics]
+  try:
+    check_group_by(source, group_by)
+    metrics = [parse_metric(source, metric) for metric in metrics]
+  except ValueError as e:
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason(str(e)))
+
+  if source == 'tasks':
+    cols = TaskRecord.columns(start_ts, end_ts).extract(start_ts, end_ts, hostname, username, gpu_id)
+  else:
+    # rollup tiers no coarser than the time key may stand in for raw frames
+    widths = {'ts': resolution, 'hour_of_day': 60*60, 'weekday': 24*60*60}
+    width = min([widths[key] for key in group_by if key in widths] or [end_ts - start_ts + 1])
+    fields = list(dict.fromkeys(field for _, field in metrics if field))
+    per_gpu = 'gpu_id' in group_by or gpu_id is not None or any(field in GPU_FIELDS for field in fields)
+    views = {name: runtime_view(name) for name in (hostname and [hostname] or registry_info.values())}
+    cols = runtime_columns(views, start_ts, end_ts, width, fields, per_gpu, gpu_id)
+  return RESPONSE.OK(data=cols.group_by(group_by, metrics, resolution))
+
+def query_tasks(**kwargs) -> ReplyPacket:
+  rs = iter_tasks(kwargs)
+  if isinstance(rs, ReplyPacket): return rs
+
+  limit = kwargs.get('limit')
+  if limit is None: return RESPONSE.OK(data=list(rs))
+  # one more to tell whether there is a next page
+  page = list(islice(rs, limit + 1))
+  res = RESPONSE.OK(data=page[:limit])
+  if len(page) > limit: res.cursor = next_cursor(kwargs, page[:limit])
+  return res
+
+TASK_ORDERS = ['asc', 'desc']
+
+def iter_tasks(kwargs:dict) -> Union[ReplyPacket, Iterator[dict]]:
+  # tasks in the asked order, resumed from `cursor` if given; a reply instead if the paging params are bad
+  order = kwargs.get('order') or 'asc'
+  if order not in TASK_ORDERS:
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason(f'order should be one of {TASK_ORDERS}'))
+  limit = kwargs.get('limit')
+  if limit is not None and (not isinstance(limit, int) or limit <= 0):
+    return RESPONSE.NOT_ACCEPTABLE(data=make_reason('limit should be positive int'))
+  after = None
+  if kwargs.get('cursor'):
+    # cursor state is `[order, start_ts, n]`, i.e. n tasks at that start_ts were already returned
+    state = decode_cursor(kwargs['cursor'])
+    if not (isinstance(state, list) and len(state) == 3 and state[0] == order):
+      return RESPONSE.NOT_ACCEPTABLE(data=make_reason('bad cursor'))
+    after = tuple(state[1:])
+
+  return TaskRecord.iter_query(hostname=kwargs.get('hostname'),
+                               gpu_id=kwargs.get('gpu_id'),
+                               username=kwargs.get('username'),
+                               start_ts=kwargs.get('start_ts'),
+                               end_ts=kwargs.get('end_ts'),
+                               command=kwargs.get('command'),
+                               reverse=order == 'desc',
+                               after=after)
+
+def next_cursor(kwargs:dict, page:List[dict]) -> str:
+  # resume past the tasks of this page sharing the last start_ts, plus those skipped before if the whole page shares it
+  key = TaskRecord.order_key
+  order, value = kwargs.get('order') or 'asc', page[-1][key]
+  n = 0
+  for task in reversed(page):
+    if task[key] != value: break
+    n += 1
+  state = kwargs.get('cursor') and decode_cursor(kwargs['cursor'])
+  if n == len(page) and state and state[1] == value: n += state[2]
+  return encode_cursor([order, value, n])
 
 def realloc(**kwargs) -> ReplyPacket:
   username = kwargs.get('username')
@@ -320,10 +930,602 @@ def realloc(**kwargs) -> ReplyPacket:
   # TODO:
   return RESPONSE.NOT_IMPLEMENTED()
 
-def _refresh_last_ACK(hostname:str):
+def _refresh_last_ACK(host:str, hostname:str):
   # NOTE: this should been called at beginning of `stats` or `heartbeat` at server layer
   # but we move them to route layer to reduce code lines
+  if not hostname: return
   last_ACK_info[hostname] = now_ts()
+  liveness_touch(host, hostname, last_ACK_info[hostname])
+
+
+##############################################################################
+# ingest
+
+STATS_TYPES = ['hardware', 'runtime', 'tasks']
+
+def check_stats(data:dict, nested:bool=False) -> ResponsePacket:
+  # cheap field check done inline, the rest is up to `stats_*` in the worker
+  s_type = isinstance(data, dict) and data.get('type')
+  if s_type == 'batch' and not nested:
+    batch = data.get('batch')
+    if not isinstance(batch, list): return RESPONSE.BAD_REQUEST()
+    res = [check_stats(item, nested=True) for item in batch]
+    return RESPONSE.OK(data=[{'status_code': r.status_code, 'reason': r.reason} for r in res])
+  if s_type not in STATS_TYPES or data.get(s_type) is None: return RESPONSE.BAD_REQUEST()
+  return RESPONSE.OK()
+
+def host_lock(hostname:str) -> StatLock:
+  return host_locks.get(hostname) or host_locks.setdefault(hostname, StatLock(hostname))
+
+def ingest(hostname:str, data:dict) -> bool:
+  # logged to `wal` before acked, then applied by the worker
+  start = perf_counter()
+  queue = ingest_queues[hash(hostname) % len(ingest_queues)]
+  with wal_lock:
+    # only we put, the queue never fills up behind our back
+    if queue.full():
+      with ingest_lock: ingest_stats['rejected'] += 1
+      return False
+    lsns = wal_log(hostname, data)
+    ingest_pending.update(lsns)
+    queue.put_nowait((hostname, data, start, lsns))
+  with ingest_lock: ingest_stats['enqueued'] += 1
+  _observe('enqueue_latency', perf_counter() - start)
+  return True
+
+def wal_log(hostname:str, data:dict) -> List[int]:
+  # under `wal_lock`: stamp the sigil ts and log the mutations a checked packet makes, returns their lsns
+  now_ts_freeze = now_ts()
+  lsns = [ ]
+  for item in (data['batch'] if data['type'] == 'batch' else [data]):
+    if not isinstance(item, dict): continue
+    runtime, tasks = item.get('runtime'), item.get('tasks')
+    if item.get('type') == 'runtime' and isinstance(runtime, dict):
+      if 'ts' not in runtime: runtime['ts'] = now_ts_freeze      # sigil if absent
+      lsns.append(wal.append(('runtime', hostname, runtime)))
+    elif item.get('type') == 'tasks' and isinstance(tasks, list) and all(isinstance(task, dict) for task in tasks):
+      for task in tasks:
+        task['ts'] = now_ts_freeze        # sigil ts
+      lsns.append(wal.append(('tasks', hostname, tasks)))
+  return [lsn for lsn in lsns if lsn]     # 0 if `wal` is not open
+
+def wal_mark() -> Tuple[int, List[int]]:
+  # with `ingest_paused()`: the last lsn logged and those up to it not applied yet, what the state is made of
+  with wal_lock: return wal.lsn, sorted(ingest_pending)
+
+def wal_applied(lsn:int, mark:Tuple[int, List[int]]) -> bool:
+  return lsn <= mark[0] and lsn not in mark[1]
+
+@contextmanager
+def ingest_paused():
+  # wait for the batches being applied, and hold the workers off
+  for gate in ingest_gates: gate.acquire()
+  try: yield
+  finally:
+    for gate in reversed(ingest_gates): gate.release()
+
+def ingest_worker(queue:Queue, gate:RLock):
+  while True:
+    items = [queue.get()]
+    while len(items) < hp.INGEST_BATCH_SIZE:
+      try: items.append(queue.get_nowait())
+      except Empty: break
+    try:
+      with gate: ingest_apply(items)
+    except: logger.error(format_exc())
+    finally:
+      for _ in items: queue.task_done()
+
+def ingest_drain():
+  # apply what is left in queues right away, e.g. before dumping
+  for queue, gate in zip(ingest_queues, ingest_gates):
+    items = [ ]
+    while True:
+      try: items.append(queue.get_nowait())
+      except Empty: break
+    if items:
+      with gate: ingest_apply(items)
+    for _ in items: queue.task_done()
+
+def ingest_apply(items:List[tuple]):
+  # a batch of packets grouped by host, the host lock and the shared lock are taken once per group
+  # (`stats_*` re-enter them for free), then the side effects outside of them
+  start = perf_counter()
+  groups = { }
+  for item in items: groups.setdefault(item[0], [ ]).append(item)
+  done = [ ]
+  for hostname, group in groups.items():
+    with host_lock(hostname), lock:
+      for _, data, enqueued, _ in group:
+        _observe('queue_latency', start - enqueued)
+        t = perf_counter()
+        try: res = globals()[f'stats_{data["type"]}'](hostname, data)
+        except:
+          logger.error(format_exc())
+          continue
+        finally: metrics.observe('sodayo_stats_seconds', perf_counter() - t, type=data['type'])
+        if res.status_code != 200:
+          logger.warning(f'[ingest_apply] {data["type"]} packet from {hostname} not applied: {res.reason}')
+          continue
+        done.append((hostname, data, res))
+  with wal_lock:
+    for _, _, _, lsns in items: ingest_pending.difference_update(lsns)
+  _observe('apply_latency', perf_counter() - start)
+  with ingest_lock:
+    ingest_stats['applied'] += len(done)
+    ingest_stats['failed'] += len(items) - len(done)
+    ingest_stats['batches'] += 1
+
+  for hostname, data, res in done:
+    bump_version(hostname)
+    if data['type'] == 'batch':
+      subs = [item for item, r in zip(data['batch'], res.data) if r['status_code'] == 200]
+    else:
+      subs = [data]
+    for item in subs:
+      try: stream_stats(hostname, item)
+      except: logger.error(format_exc())
+      bus_emit('stats', hostname, item)
+
+def _observe(name:str, seconds:float):
+  metrics.observe(f'sodayo_ingest_{name}_seconds', seconds)
+  with ingest_lock:
+    stat = ingest_stats[name]
+    stat[0] += 1
+    stat[1] += seconds
+    stat[2] = max(stat[2], seconds)
+
+
+##############################################################################
+# query cache
+
+QUERY_CACHE_TYPES = ['settings', 'hardware', 'quota', 'runtime', 'tasks', 'userstats', 'aggregate']
+QUERY_HOST_TYPES  = ['hardware', 'runtime', 'tasks', 'aggregate']    # replies only depend on the host asked if any
+
+def bump_version(hostname:Optional[str], settings:bool=False):
+  # data of `hostname` changed, or of everything if None
+  data_versions['all'] += 1
+  if settings: data_versions['settings'] += 1
+  if hostname:
+    data_versions['hosts'][hostname] = data_versions['hosts'].get(hostname, 0) + 1
+    query_cache.invalidate(lambda key: key[0] not in QUERY_HOST_TYPES or key[1] in [None, hostname])
+  else:
+    query_cache.invalidate()
+
+def query_key(data:dict) -> Tuple[str, Optional[str], str]:
+  # (type, hostname, normalized params)
+  params = {k: v for k, v in data.items() if v is not None and k not in ['type', 'etag', 'ts']}
+  return data.get('type'), params.get('hostname'), json.dumps(params, sort_keys=True)
+
+def query_etag(key:Tuple[str, Optional[str], str]) -> str:
+  q_type, hostname, _ = key
+  if q_type == 'settings':
+    version = data_versions['settings']
+  elif q_type in QUERY_HOST_TYPES and hostname:
+    version = data_versions['hosts'].get(hostname, 0)
+  else:
+    version = data_versions['all']
+  # quota and userstats roll over by month even if nothing comes in
+  month = ts_to_month(now_ts()) if q_type in ['quota', 'userstats'] else ''
+  return hashlib.sha1(f'{boot_id}:{key}:{version}:{month}'.encode()).hexdigest()[:20]
+
+
+##############################################################################
+# streaming
+
+STREAM_CHANNELS = ['runtime', 'tasks', 'quota', 'liveness']
+STREAM_STATEFUL = ['runtime', 'quota']
+
+def stream_stats(hostname:str, data:dict):
+  # queue what a stats packet changed for the browsers subscribed
+  if data.get('type') == 'runtime':
+    stream_state('runtime', hostname, data['runtime'])
+  elif data.get('type') == 'tasks':
+    stream_event('tasks', hostname, data['tasks'])
+  else: return
+  stream_state('quota', '*', {k: list(v) for k, v in quota_info.items()})
+
+def stream_state(channel:str, hostname:str, state:dict):
+  # stateful channels only keep the latest state of a host till the next tick
+  with ws_lock:
+    for room in {f'{channel}:{hostname}', f'{channel}:*'}:
+      if not ws_rooms.get(room): continue
+      pending = ws_pending.setdefault(room, { })
+      if hostname in pending:
+        ws_counters['frames_coalesced'] += 1
+        ws_coalesced[(room, hostname)] = ws_coalesced.get((room, hostname), 0) + 1
+      pending[hostname] = state
+
+def stream_event(channel:str, hostname:str, events:list):
+  # stateless channels pile up new events till the next tick
+  with ws_lock:
+    for room in {f'{channel}:{hostname}', f'{channel}:*'}:
+      if not ws_rooms.get(room): continue
+      ws_pending.setdefault(room, { }).setdefault(hostname, [ ]).extend(events)
+
+def stream_flush():
+  # one merged frame per room per tick
+  now_ts_freeze = now_ts()
+  frames, saved = [ ], [ ]
+  with ws_lock:
+    pending = dict(ws_pending)
+    ws_pending.clear()
+    coalesced = dict(ws_coalesced)
+    ws_coalesced.clear()
+    for room, hosts in pending.items():
+      if not ws_rooms.get(room): continue
+      channel = room.split(':')[0]
+      frame = { }
+      for hostname, payload in hosts.items():
+        if channel in STREAM_STATEFUL:
+          msg = _stream_state_msg(room, hostname, payload, now_ts_freeze)
+          if msg: frame[hostname] = msg
+          if msg and (room, hostname) in coalesced: saved.append((coalesced[(room, hostname)], msg))
+        else:
+          frame[hostname] = {'data': payload}
+      if frame: frames.append((channel, room, {'ts': now_ts_freeze, 'hosts': frame}))
+    ws_counters['ticks'] += 1
+    ws_counters['frames_sent'] += len(frames)
+
+  # each coalesced frame is taken as large as the message sent in place of them, sized out of `ws_lock`
+  if saved:
+    n_bytes = sum(n * len(json.dumps(msg)) for n, msg in saved)
+    with ws_lock: ws_counters['bytes_saved'] += n_bytes
+
+  for channel, room, frame in frames:
+    socketio.emit(f'streaming:{channel}', frame, to=room)
+
+def stream_ticker():
+  while True:
+    socketio.sleep(hp.STREAM_TICK_INTERVAL)
+    try: stream_flush()
+    except: logger.error(format_exc())
+
+def _stream_state_msg(room:str, hostname:str, state:dict, ts:int, commit:bool=True) -> Optional[dict]:
+  # delta against what the room saw last, or a keyframe once in a while
+  last = ws_states.get((room, hostname))
+  if last is None or last[1] + hp.STREAM_KEYFRAME_INTERVAL <= ts:
+    if commit: ws_states[(room, hostname)] = [state, ts]
+    return {'keyframe': True, 'data': state}
+  delta = dict_diff(last[0], state)
+  if not delta: return None
+  if commit: last[0] = state
+  return {'keyframe': False, 'data': delta}
+
+def _stream_rooms(data:dict) -> List[str]:
+  channels = data.get('channels') or STREAM_CHANNELS
+  hostnames = data.get('hostnames') or ['*']
+  return [f'{channel}:{hostname}' for channel in channels if channel in STREAM_CHANNELS
+                                  for hostname in (['*'] if channel == 'quota' else hostnames)]
+
+def _release_room(room:str):
+  with ws_lock:
+    ws_rooms[room] -= 1
+    if not ws_rooms[room]:
+      # nobody listening, next subscriber starts from a keyframe
+      del ws_rooms[room]
+      ws_pending.pop(room, None)
+      for key in [key for key in ws_states if key[0] == room]: del ws_states[key]
+
+
+##############################################################################
+# liveness
+
+def ack_period() -> int:
+  # hosts ACK on each heartbeat, or on each commit if heartbeat is disabled
+  return hp.HERATBEAT_INTERVAL if hp.HERATBEAT_INTERVAL > 0 else hp.COMMIT_INTERVAL
+
+def liveness_touch(host:str, hostname:str, ts:int, notify:bool=True):
+  # an ACK comes, alive till `LIVENESS_STALE_PERIODS` later
+  with liveness_lock:
+    state = liveness.get(hostname)
+    liveness[hostname] = ['alive', host]
+    liveness_deadlines.push(hostname, ts + hp.LIVENESS_STALE_PERIODS * ack_period())
+  if notify and (not state or state[0] != 'alive'):
+    liveness_event(hostname, 'alive', ts, ts)
+
+def liveness_tick(now_ts_freeze:int):
+  # move on hosts whose deadline passed, O(expired)
+  events = [ ]
+  with liveness_lock:
+    for hostname in liveness_deadlines.pop_expired(now_ts_freeze):
+      state = liveness[hostname]
+      last_ACK = last_ACK_info.get(hostname)
+      if state[0] == 'alive':
+        state[0] = 'stale'
+        liveness_deadlines.push(hostname, (last_ACK or now_ts_freeze) + hp.LIVENESS_EVICT_PERIODS * ack_period())
+      elif state[1] in hp.SLAVES_SOCKET:
+        state[0] = 'dead'
+      else:
+        if registry_info.get(state[1]) == hostname: del registry_info[state[1]]
+        forget_host(hostname)
+        state[0] = 'evicted'
+      events.append((hostname, state[0], last_ACK))
+
+  for hostname, state, last_ACK in events:
+    logger.info(f'[liveness_tick] {hostname} is {state}')
+    liveness_event(hostname, state, now_ts_freeze, last_ACK)
+
+def liveness_ticker():
+  while True:
+    sleep(ack_period())
+    try: liveness_tick(now_ts())
+    except: logger.error(format_exc())
+
+def liveness_event(hostname:str, state:str, ts:int, last_ACK:Optional[int]):
+  events = [{'state': state, 'ts': ts, 'last_ACK': last_ACK}]
+  stream_event('liveness', hostname, events)
+  bus_emit('liveness', hostname, events)
+
+def forget_host(hostname:str):
+  # drop all of a host gone, but not the tasks it reported
+  hardware_info.pop(hostname, None)
+  with host_lock(hostname):
+    runtime_info.pop(hostname, None)
+    runtime_views.pop(hostname, None)
+  host_locks.pop(hostname, None)
+  if hostname in bus_cursors: bus_cursors[hostname] = None      # whole again to the workers, if it comes back
+  last_ACK_info.pop(hostname, None)
+  with lock:
+    lives = usage_info.get('live', { })
+    for key in [key for key in lives if key[0] == hostname]: del lives[key]
+  with liveness_lock:
+    liveness.pop(hostname, None)
+    liveness_deadlines.discard(hostname)
+  bump_version(hostname)
+
+
+##############################################################################
+# persistence
+
+PERSIST_TICK = 10     # in seconds, how often the scheduler looks around
+
+def persist_worker():
+  # checkpoint in background on `FLUSH_INTERVAL`/`COREDUMP_INTERVAL`/`BACKUP_INTERVAL`, flush early if dirty enough
+  # NOTE: stdata and rtdata are always dumped together, so that `wal` replays on top of a consistent state
+  last_flush = last_dump = now_ts()
+  while True:
+    sleep(PERSIST_TICK)
+    try:
+      now_ts_freeze = now_ts()
+      dirty = sum(rec._dirty for rec in RecordMeta.objects)
+      backups = list_backups()
+      if not backups or now_ts_freeze - backup_ts(backups[-1]) >= day_to_sec(hp.BACKUP_INTERVAL):
+        with persist_lock:
+          checkpoint()
+          backup_data(hp.BACKUP_KEEP)
+        last_flush = last_dump = now_ts_freeze
+      elif (dirty and (dirty >= hp.FLUSH_DIRTY_SIZE or now_ts_freeze - last_flush >= min_to_sec(hp.FLUSH_INTERVAL))) \
+          or now_ts_freeze - last_dump >= min_to_sec(hp.COREDUMP_INTERVAL):
+        checkpoint()
+        last_flush = last_dump = now_ts_freeze
+    except: logger.error(format_exc())
+
+def wal_syncer():
+  # group commit: nothing waits longer than `WAL_SYNC_INTERVAL` to be fsync'ed, or for `WAL_SYNC_RECORDS` to pile up
+  # NOTE: stats are acked once logged, not once fsync'ed, see `WAL_SYNC_INTERVAL`
+  while True:
+    wal.wait_due(hp.WAL_SYNC_INTERVAL / 1000)
+    try: wal.sync()
+    except: logger.error(format_exc())
+
+@perf_timer
+def wal_replay():
+  # re-apply mutations logged after the last checkpoint, at startup before any ingest
+  # stdata keeps the lsn it is written up to, which may be ahead of the checkpoint, e.g. committed by `bus_leader`,
+  # or rtdata failed to dump after it, tasks it has already are only charged again
+  n_replayed = 0
+  ckpt_mark = checkpoint_info.get('lsn', 0), checkpoint_info.get('pending', [ ])
+  stdata_mark = TaskRecord.mark or ckpt_mark
+  for lsn, (kind, hostname, payload) in wal.replay(after=wal_floor(ckpt_mark)):
+    if wal_applied(lsn, ckpt_mark): continue
+    try:
+      if kind == 'tasks':
+        with lock: apply_tasks(hostname, payload, record=not wal_applied(lsn, stdata_mark))
+      elif kind == 'runtime':
+        with host_lock(hostname): fresh = apply_runtime(hostname, payload)
+        if fresh:
+          with lock: charge_runtime(hostname, payload)
+      elif kind == 'inbox':
+        checkpoint_info['inbox'] = payload
+      n_replayed += 1
+    except: logger.warning(format_exc())
+  if n_replayed: logger.info(f'[wal_replay] {n_replayed} entries replayed up to lsn {wal.lsn}')
+
+def wal_floor(mark:Tuple[int, List[int]]) -> int:
+  # lsn up to which all are applied
+  return min(mark[1], default=mark[0] + 1) - 1
+
+@perf_timer
+def checkpoint():
+  # ingest paused: seal the log, stage stdata and copy rtdata, then write both and drop the sealed log
+  # up to what is still queued, which goes to the checkpoint after
+  # runtime goes from the published snapshots, the rest are copied under `lock` and written without it,
+  # by this thread or a forked child, see `DUMP_MODE`
+  # stdata goes first with the mark, rtdata is not dumped if it failed, so that the checkpoint is never ahead of stdata
+  with persist_lock:
+    with ingest_paused():
+      wal.rotate()
+      mark = wal_mark()
+      with lock:
+        staged = stage_stdata(mark)
+        checkpoint_info['lsn'], checkpoint_info['pending'] = mark
+        env = {var: deepcopy(val) for var, val in globals().items()
+               if var.endswith('_info') and var != 'runtime_info' and isinstance(val, DUMPABLE_TYPES)}
+      # hosts never touched since mapped in are copied from the old snapshot as they are
+      runtime = runtime_info.unloaded() if isinstance(runtime_info, LazyDict) else { }
+      if f'{__role__}-runtime_info' not in hp.RTDATA_SNAPSHOT_VARS:
+        runtime = {name: block.load() for name, block in runtime.items()}
+      runtime.update(runtime_views)
+      env['runtime_info'] = runtime
+    def write() -> bool:
+      return write_stdata(staged) and dump_rtdata(env, prefix=__role__)
+    if run_dump(write):
+      with lock: settle_stdata(staged)
+      wal.truncate(wal_floor(mark))
+    else:
+      logger.error(f'[checkpoint] dump failed, wal kept from lsn {wal_floor(mark)}')
+
+
+##############################################################################
+# workers
+
+BUS_SHARED_VARS = ['quota_info', 'usage_info', 'userstats_info']           # copied under `lock`, if any data changed
+BUS_LIVE_VARS = ['registry_info', 'last_ACK_info', 'liveness', 'data_versions', 'boot_id']   # small, checked every tick
+BUS_HOST_VARS = ['hardware_info']                                          # per host, if the host changed
+
+def multi_worker() -> bool:
+  return hp.SERVER_WORKERS > 1 and hp.STORAGE_BACKEND == 'sqlite'
+
+def fork_workers(host:str, port:int) -> socket.socket:
+  # prefork: all processes accept on the same listening socket, the primary stays as the one writing
+  global worker_id
+
+  sock = socket.create_server((host, port), backlog=128)
+  bus.clear()         # the inbox is left to `bus_take`, what is in there has been acked
+  for i in range(1, hp.SERVER_WORKERS):
+    pid = os.fork()
+    if pid == 0:
+      worker_id = i
+      worker_pids.clear()
+      break
+    worker_pids.append(pid)
+  return sock
+
+def serve(sock:socket.socket):
+  # what `socketio.run()` does in threading mode, on the socket shared with the forked workers
+  make_server(*sock.getsockname()[:2], app, threaded=True, fd=sock.fileno()).serve_forever()
+
+def bus_emit(kind:str, hostname:str, payload:Any):
+  # stream events for the browsers connected to the workers
+  if multi_worker() and not worker_id: bus_outbox.append((kind, hostname, payload))
+
+def bus_forward(kind:str, data:dict) -> ResponsePacket:
+  # stats and heartbeats go through the inbox even at the primary, so that they are applied in order they came,
+  # checked against the registry mirrored beforehand, `bus_leader` can only log those rejected after all
+  bus.push((kind, request.remote_addr, data))
+  return RESPONSE.OK()
+
+def bus_leader():
+  # at the primary: take in what the workers got, then let them see what changed
+  last_mark = None
+  while True:
+    sleep(hp.BUS_POLL_INTERVAL)
+    try:
+      bus_take()
+
+      # commit tasks ahead of the checkpoint, stdata remembers which of `wal` it has got
+      if (wal.lsn, len(ingest_pending)) != last_mark:
+        with ingest_paused(), lock:
+          mark = wal_mark()
+          for rec in RecordMeta.objects: rec.commit(mark)
+        last_mark = mark[0], len(mark[1])
+
+      bus_publish()
+    except: logger.error(format_exc())
+
+def bus_take():
+  # rows are dropped from the inbox only once what they make is in `wal`, along with the last row id,
+  # so that rows logged but not dropped before a crash are not taken twice
+  # acked already, a full ingest queue is waited out rather than dropping what is left
+  taken = 0
+  for row_id, (kind, host, data) in bus.take():
+    if row_id > checkpoint_info.get('inbox', 0):
+      res = (accept_heartbeat if kind == 'heartbeat' else accept_stats)(host, data)
+      if res.status_code == 503: break
+      if res.status_code != 200: logger.warning(f'[bus_take] {kind} from {host} not accepted: {res.reason}')
+    taken = row_id
+  if taken:
+    with wal_lock, lock:
+      wal.append(('inbox', None, taken))
+      checkpoint_info['inbox'] = taken
+    wal.sync()
+    bus.ack(taken)
+
+def bus_publish():
+  events = [ ]
+  while bus_outbox: events.append(bus_outbox.popleft())
+
+  blobs = { }
+  for hostname, version in list(data_versions['hosts'].items()):
+    if bus_published.get(f'/{hostname}') == version: continue
+    bus_published[f'/{hostname}'] = version
+    for var in BUS_HOST_VARS:
+      blobs[f'{var}/{hostname}'] = pkl.dumps(globals()[var].get(hostname), protocol=pkl.HIGHEST_PROTOCOL)
+    events.extend(bus_runtime(hostname))
+  if events: bus.publish(events)
+
+  shared = { }
+  if bus_published.get('/') != data_versions['all']:
+    bus_published['/'] = data_versions['all']
+    with lock:
+      shared = {var: pkl.dumps(globals()[var], protocol=pkl.HIGHEST_PROTOCOL) for var in BUS_SHARED_VARS}
+  with liveness_lock:
+    live = {var: pkl.dumps(globals()[var], protocol=pkl.HIGHEST_PROTOCOL) for var in BUS_LIVE_VARS}
+  for var, blob in {**shared, **live}.items():
+    if bus_published.get(var) == blob: continue
+    bus_published[var] = blob
+    blobs[var] = blob
+  bus.put_states(blobs)
+
+def bus_runtime(hostname:str) -> List[tuple]:
+  # runtime history goes as the frames appended since last published, whole only when new to the workers
+  # NOTE: as events rather than states, a state may be put over again before a worker reads it, deltas must not
+  view, cursor = runtime_views.get(hostname), bus_cursors.get(hostname)
+  if view is None:
+    if hostname not in bus_cursors: return [ ]
+    del bus_cursors[hostname]
+    return [('runtime', hostname, None)]
+  if cursor is None or view.appended < cursor:
+    bus_cursors[hostname] = view.appended
+    return [('runtime', hostname, view)]
+  if view.appended == cursor: return [ ]
+  bus_cursors[hostname] = view.appended
+  return [('runtime', hostname, (view.appended, view.since(cursor)))]
+
+def mirror_runtime(hostname:str, payload:Union[RuntimeHistory, Tuple[int, List[dict]], None]):
+  # at a worker: a copy of the runtime history, taken whole then appended the frames published since
+  if payload is None:
+    runtime_info.pop(hostname, None)
+    runtime_views.pop(hostname, None)
+    return
+  if isinstance(payload, RuntimeHistory):
+    rtdata = runtime_info[hostname] = payload
+  else:
+    rtdata = runtime_info.get(hostname)
+    if rtdata is None: return           # the whole one always comes first
+    appended, frames = payload
+    n = min(appended - rtdata.appended, len(frames))
+    for frame in frames[len(frames) - n:] if n > 0 else [ ]: rtdata.append(frame)
+    rtdata.appended = appended
+    rtdata.truncate(now_ts() - day_to_sec(hp.RTDATA_TRUNCATE_EXPIRE))
+  runtime_views[hostname] = rtdata.snapshot()
+
+def bus_follower():
+  # at a worker: mirror the states published, and stream the events to the browsers connected here
+  # NOTE: events are followed from the start, the bus is cleared before forking, runtime history comes whole first
+  seq, last = 0, 0
+  ppid = os.getppid()
+  while True:
+    sleep(hp.BUS_POLL_INTERVAL)
+    if os.getppid() != ppid: os._exit(0)    # the primary is gone
+    try:
+      seq, states = bus.get_states(seq)
+      for name, value in states.items():
+        var, _, hostname = name.partition('/')
+        if not hostname:
+          globals()[var] = value
+        elif value is None:
+          globals()[var].pop(hostname, None)
+        else:
+          globals()[var][hostname] = value
+
+      last, events = bus.follow(last)
+      for kind, hostname, payload in events:
+        if   kind == 'runtime': mirror_runtime(hostname, payload)
+        elif kind == 'stats':   stream_stats(hostname, payload)
+        else:                   stream_event(kind, hostname, payload)
+    except: logger.error(format_exc())
 
 
 ##############################################################################
@@ -338,10 +1540,13 @@ def impl_heartbeat(jsondata:Union[str, dict]):
   except:
     return RESPONSE.BAD_REQUEST()
 
+  if multi_worker(): return bus_forward('heartbeat', data)
+  return accept_heartbeat(request.remote_addr, data)
+
+def accept_heartbeat(host:str, data:dict) -> ResponsePacket:
   # check data field integrity
-  host = request.remote_addr
   hostname = data.get('hostname')
-  _refresh_last_ACK(hostname)
+  _refresh_last_ACK(host, hostname)
 
   try: return heartbeat(host, hostname)
   except:
@@ -357,33 +1562,63 @@ def impl_stats(jsondata:Union[str, dict]):
   except:
     return RESPONSE.BAD_REQUEST()
   
+  if multi_worker():
+    if request.remote_addr not in registry_info: return RESPONSE.UNAUTHORIZED()
+    res = check_stats(data)
+    if res.status_code == 200: bus_forward('stats', data)
+    return res
+  return accept_stats(request.remote_addr, data)
+
+def accept_stats(host:str, data:dict) -> ResponsePacket:
   # assure registered
-  host = request.remote_addr
   if host not in registry_info: return RESPONSE.UNAUTHORIZED()
   hostname = registry_info[host]
-  _refresh_last_ACK(hostname)
+  _refresh_last_ACK(host, hostname)
 
-  # check data field integrity
-  fn = globals().get(f'stats_{data.get("type")}')
-  if not fn: return RESPONSE.BAD_REQUEST()
-  try:
-    return fn(hostname, data)
-  except:
-    logger.error(format_exc())
-    return RESPONSE.INTERNAL_SERVER_ERROR()
+  # check data field integrity, then leave it to the ingest worker
+  res = check_stats(data)
+  if res.status_code != 200: return res
+  if not ingest(hostname, data):
+    return RESPONSE.SERVICE_UNAVAILABLE(data={'retry_after': hp.INGEST_RETRY_AFTER})
+  return res
 
-@packet_to_dict
-def impl_query(jsondata:Union[str, dict]):
+def impl_query(jsondata:Union[str, dict], etags:Container[str]=None) -> dict:
   # check post data existentiality
   try:
     data = isinstance(jsondata, str) and loads(jsondata) or jsondata
     logger.debug(f'/query with {data}')
   except:
-    return RESPONSE.BAD_REQUEST()
+    return packet_to_dict(RESPONSE.BAD_REQUEST())
 
   # check data field integrity
   fn = globals().get(f'query_{data.get("type")}')
-  if not fn: return RESPONSE.BAD_REQUEST()
+  if not fn: return packet_to_dict(RESPONSE.BAD_REQUEST())
+  start = perf_counter()
+  res = _query_cached(fn, data, etags)
+  metrics.observe('sodayo_query_seconds', perf_counter() - start, type=data['type'])
+  return res
+
+def _query_cached(fn, data:dict, etags:Container[str]=None) -> dict:
+  if data.get('type') not in QUERY_CACHE_TYPES or not hp.QUERY_CACHE_SIZE:
+    return _query(fn, data)
+
+  # etag is taken before querying, data changed meanwhile only makes the next one miss
+  key = query_key(data)
+  etag = query_etag(key)
+  if etag in (etags or [data.get('etag')]):
+    return packet_to_dict(RESPONSE.NOT_MODIFIED(etag))
+  cached = query_cache.get(key)
+  if cached and cached['etag'] == etag:
+    return {**cached, 'ts': now_ts()}
+
+  res = _query(fn, data)
+  if res.get('status_code') == 200:
+    res['etag'] = etag
+    query_cache.put(key, res, len(json.dumps(res)))
+  return res
+
+@packet_to_dict
+def _query(fn, data:dict):
   try:
     return fn(**data)
   except:
@@ -407,57 +1642,172 @@ def impl_realloc(jsondata:Union[str, dict]):
 
 
 ##############################################################################
-# HTTP routes: jsonstr in, jsonstr out
+# HTTP routes: jsonstr (or negotiated encoding) in, jsonstr (or negotiated encoding) out
+
+def request_payload() -> Union[str, dict]:
+  # legacy JSON posts are a jsonstr, compact encodings carry the dict itself
+  encoding = encoding_of(request.mimetype)
+  if encoding == 'json': return request.json
+  return decode_payload(request.get_data(), encoding, hp.PAYLOAD_MAX_SIZE << 20)
+
+def make_reply(res:dict):
+  g.status_code = res.get('status_code')     # what the packet says, HTTP status is 200 anyway
+  mimetypes = [MIMETYPES[e] for e in MIMETYPES if resolve_encoding(e) == e]
+  encoding = encoding_of(request.accept_mimetypes.best_match(mimetypes, default=MIMETYPES['json']))
+  if encoding == 'json': return jsonify(res)
+  return app.response_class(encode_payload(res, encoding), mimetype=MIMETYPES[encoding])
+
+def api_endpoint(fn):
+  # also times the handler by route, a streamed body is not included, and counts by the status of the reply packet
+  def wrapper(*args, **kwargs):
+    start = perf_counter()
+    try: data = request_payload()
+    except PayloadTooLarge as e:
+      logger.warning(f'[{fn.__name__}] payload rejected: {e}')
+      resp = make_reply(packet_to_dict(RESPONSE.PAYLOAD_TOO_LARGE()))
+    except:
+      logger.warning(f'[{fn.__name__}] cannot decode payload of {request.mimetype!r}')
+      resp = make_reply(packet_to_dict(RESPONSE.UNSUPPORTED_MEDIA_TYPE()))
+    else:
+      resp = fn(data, *args, **kwargs)
+    route = request.url_rule.rule
+    metrics.observe('sodayo_request_seconds', perf_counter() - start, route=route)
+    metrics.inc('sodayo_requests_total', route=route, status=g.get('status_code', resp.status_code))
+    return resp
+  wrapper.__name__ = fn.__name__
+  return wrapper
 
 @app.route('/', methods=['GET'])
 def root():
   return html_page
 
+@app.route('/metrics', methods=['GET'])
+def api_metrics():
+  return app.response_class(metrics.render(), content_type=METRICS_MIMETYPE)
+
 @app.route('/heartbeat', methods=['POST'])
-def api_heartbeat():
-  return jsonify(impl_heartbeat(request.json))
+@api_endpoint
+def api_heartbeat(data):
+  return make_reply(impl_heartbeat(data))
 
 @app.route('/stats', methods=['POST'])
-def api_stats():
-  return jsonify(impl_stats(request.json))
+@api_endpoint
+def api_stats(data):
+  res = impl_stats(data)
+  resp = make_reply(res)
+  if res.get('status_code') == 503: resp.headers['Retry-After'] = str(res['data']['retry_after'])
+  return resp
 
 @app.route('/query', methods=['POST'])
-def api_query():
-  return jsonify(impl_query(request.json))
+@api_endpoint
+def api_query(data):
+  res = impl_query(data, request.if_none_match)
+  if res.get('status_code') == 304:
+    resp = app.response_class(status=304)
+  else:
+    resp = make_reply(res)
+  if res.get('etag'): resp.set_etag(res['etag'])
+  return resp
+
+@app.route('/query/stream', methods=['POST'])
+@api_endpoint
+def api_query_stream(data):
+  # tasks only, as NDJSON in chunked transfer, rows are pulled from the generator while writing
+  # NOTE: always JSON lines, no etag nor cache; `limit` caps the rows, and no cursor comes back
+  try:
+    data = isinstance(data, str) and loads(data) or data
+    logger.debug(f'/query/stream with {data}')
+  except:
+    return make_reply(packet_to_dict(RESPONSE.BAD_REQUEST()))
+  if data.get('type') != 'tasks': return make_reply(packet_to_dict(RESPONSE.BAD_REQUEST()))
+  rs = iter_tasks(data)
+  if isinstance(rs, ReplyPacket): return make_reply(packet_to_dict(rs))
+  if data.get('limit'): rs = islice(rs, data['limit'])
+
+  def generate():
+    try:
+      lines = [ ]
+      for task in rs:
+        lines.append(json.dumps(task))
+        if len(lines) >= hp.QUERY_STREAM_CHUNK:
+          yield '\n'.join(lines) + '\n'
+          lines.clear()
+      if lines: yield '\n'.join(lines) + '\n'
+    except:
+      # too late for a status code, the client sees a truncated body
+      logger.error(format_exc())
+  return app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 @app.route('/realloc', methods=['POST'])
-def api_realloc():
-  return jsonify(impl_realloc(request.json))
+@api_endpoint
+def api_realloc(data):
+  return make_reply(impl_realloc(data))
 
 
 ##############################################################################
-# websocket events: dict in, dict out
+# websocket events: dict (or bytes in negotiated encoding) in, dict (or bytes in negotiated encoding) out
+
+def ws_payload(data:Union[dict, bytes]) -> dict:
+  if isinstance(data, bytes):
+    return decode_payload(data, ws_resources[session['uuid']]['encoding'], hp.PAYLOAD_MAX_SIZE << 20)
+  return data
+
+def ws_reply(event:str, res:dict):
+  encoding = ws_resources[session['uuid']]['encoding']
+  emit(event, res if encoding == 'json' else encode_payload(res, encoding))
+
+@socketio.on('encoding')
+def ws_encoding(data:str):
+  # switch encoding of request/reply events for this connection, streaming stays JSON
+  encoding = resolve_encoding(data)
+  ws_resources[session['uuid']]['encoding'] = encoding
+  emit('encoding', encoding)
 
 @socketio.on('heartbeat')
 def ws_heartbeat(data:dict):
-  emit('heartbeat', impl_heartbeat(data))
+  ws_reply('heartbeat', impl_heartbeat(ws_payload(data)))
 
 @socketio.on('stats')
 def ws_stats(data:dict):
-  # reply for clients
-  emit('stat', impl_stats(data))
-
-  # reply for browsers
-  # NOTE: push differetial updates to browsers!
-  emit('streaming:runtime', data, broadcast=True)
-  emit('streaming:tasks',   data, broadcast=True)
-  emit('streaming:quota',   data, broadcast=True)
+  # reply for clients, browsers subscribed get streamed by `impl_stats`
+  ws_reply('stat', impl_stats(ws_payload(data)))
 
 @socketio.on('query')
 def ws_query(data:dict):
+  data = ws_payload(data)
   q_type = data.get('type')
-  if not q_type: emit(f'error', packet_to_dict(RESPONSE.BAD_REQUEST()))
+  if not q_type: ws_reply(f'error', packet_to_dict(RESPONSE.BAD_REQUEST()))
   
-  emit(f'query:{q_type}', impl_query(data))
+  ws_reply(f'query:{q_type}', impl_query(data))
 
 @socketio.on('realloc')
 def ws_realloc(data:dict):
-  emit('realloc', impl_realloc(data))
+  ws_reply('realloc', impl_realloc(ws_payload(data)))
+
+@socketio.on('subscribe')
+def ws_subscribe(data:dict):
+  # data: {'channels': ['runtime', 'tasks', 'quota'], 'hostnames': ['server1']}, default all
+  rooms = ws_resources[session['uuid']]['rooms']
+  for room in _stream_rooms(data or { }):
+    if room in rooms: continue
+    join_room(room)
+    rooms.add(room)
+    with ws_lock:
+      ws_rooms[room] = ws_rooms.get(room, 0) + 1
+      # catch up with the states the room has seen, deltas to come are made against them
+      frame = {hostname: {'keyframe': True, 'data': state} for (room_, hostname), (state, _) in ws_states.items() if room_ == room}
+    if frame: emit(f'streaming:{room.split(":")[0]}', {'ts': now_ts(), 'hosts': frame})
+  emit('subscribe', sorted(rooms))
+
+@socketio.on('unsubscribe')
+def ws_unsubscribe(data:dict):
+  rooms = ws_resources[session['uuid']]['rooms']
+  for room in _stream_rooms(data or { }):
+    if room not in rooms: continue
+    leave_room(room)
+    rooms.discard(room)
+    _release_room(room)
+  emit('unsubscribe', sorted(rooms))
 
 @socketio.on('connect')
 def ws_connect():
@@ -465,14 +1815,14 @@ def ws_connect():
 
   uuid = gen_uuid()
   session['uuid'] = uuid
-  ws_resources[uuid] = 'some stuff'
+  ws_resources[uuid] = {'rooms': set(), 'encoding': 'json'}
 
 @socketio.on('disconnect')
-def ws_disconnect():
+def ws_disconnect(reason=None):
   logger.debug('[ws_disconnect]')
 
   uuid = session['uuid']
-  _ = ws_resources[uuid]
+  for room in ws_resources[uuid]['rooms']: _release_room(room)
   del ws_resources[uuid]
 
 @socketio.on_error_default
@@ -491,11 +1841,15 @@ if __name__ == '__main__':
   from utils import logger    # import again to fix non-init problem
 
   try:
-    startup()
-    logger.info(f'[server] running at {sock_to_hostport(hp.MASTER_SOCKET)}')
     host, port = '0.0.0.0', hp.MASTER_SOCKET[1]
+    if hp.SERVER_WORKERS > 1 and not multi_worker():
+      logger.warning(f"[server] SERVER_WORKERS > 1 needs STORAGE_BACKEND = 'sqlite', run as a single process")
+    sock = multi_worker() and fork_workers(host, port)
+    startup()
+    logger.info(f'[server] {worker_id and f"worker {worker_id}" or "primary"} running at {sock_to_hostport(hp.MASTER_SOCKET)}')
     # app.run(host=host, port=port, debug=False)
-    socketio.run(app, host=host, port=port, debug=False)
+    if sock: serve(sock)
+    else: socketio.run(app, host=host, port=port, debug=False)
   except KeyboardInterrupt:
     logger.info('exit by Ctrl+C')
   except Exception:
@@ -41,32 +41,160 @@ COMMIT_INTERVAL = 20
 DEAD_REVIVE_INTERVAL = 60
 
 
-# 主/从节点dump一次 运行时数据rtdata 的时间间隔，也是查找清理失效动态注册的节点的间隔
+# 主/从节点dump一次 运行时数据rtdata 的时间间隔
 # int (in minutes), default: 20
 COREDUMP_INTERVAL = 20
 
 
+# 主/从节点dump数据文件时的压缩编码与级别，编码写在文件头中，读取时按文件头解码，改动后旧文件照常载入
+# Tuple[str, int], codec in ['none', 'zlib', 'bz2', 'lzma'], level None for default of the codec
+# default: ('zlib', 1)
+# NOTE: 对pkl文件整体压缩，对快照snap文件按节点分块压缩；lzma压缩率最高但远慢于zlib
+DUMP_CODEC = ('zlib', 1)
+
+
+# 主/从节点dump数据的方式，'thread' 或 'fork'
+# str, default: 'thread'
+# NOTE: 两者都先在锁内冻结一份副本，写入期间接收数据照常进行；thread在后台线程中序列化，与服务争抢GIL，
+#       fork则在写时复制的子进程中序列化；fork仅支持pickle后端与类Unix系统，其余情况按thread处理
+DUMP_MODE = 'thread'
+
+
+# 主节点将多久未收到ACK的从节点标记为失联stale，以ACK周期计 (启用心跳时为HERATBEAT_INTERVAL，否则为COMMIT_INTERVAL)
+# int (in ACK periods), default: 3
+LIVENESS_STALE_PERIODS = 3
+
+
+# 主节点清除多久未收到ACK的动态注册从节点及其数据，以ACK周期计，静态注册的从节点只标记为dead
+# int (in ACK periods), default: 30
+LIVENESS_EVICT_PERIODS = 30
+
+
+# 主节点向浏览器推送流式数据的广播节拍，每个节拍内各订阅房间合并为一帧发送，同一节点的多帧只发最新的
+# float (in seconds), default: 1
+STREAM_TICK_INTERVAL = 1
+
+
+# 主节点向浏览器推送流式数据时，每个订阅房间发送一次完整关键帧keyframe 的时间间隔，其余时候只推送差量
+# int (in seconds), default: 60
+STREAM_KEYFRAME_INTERVAL = 60
+
+
 # 主节点强制flush一次 存档数据stdata 的时间间隔
 # int (in minutes), default: 15
 # NOTE: 这是下限，数据量多时实际flush可能比这个值频繁
 FLUSH_INTERVAL = 15
 
 
+# 主节点 存档数据stdata 未flush的数据量超过该值时提前flush
+# int (in bytes, approx.), default: 4 * 1024 * 1024
+FLUSH_DIRTY_SIZE = 4 * 1024 * 1024
+
+
+# 主节点 预写日志WAL 的组提交间隔，两次flush之间的任务与运行时数据先追加到 DATA_PATH/wal 并按组fsync
+# int (in milliseconds), default: 200
+# NOTE: stats写入日志即应答而不等fsync，宕机最多丢失该时长内已应答的数据，重启时日志在最近一次存档之上重放，存档成功后截断
+WAL_SYNC_INTERVAL = 200
+
+
+# 主节点 预写日志WAL 积攒多少条记录时立即fsync，不必等到 WAL_SYNC_INTERVAL
+# int, default: 256
+WAL_SYNC_RECORDS = 256
+
+
 # 主节点备份一次 存档数据stdata 的时间间隔
 # int (in days), default: 7
+# NOTE: 备份为 DATA_PATH/backup/<时间> 下的硬链接快照，包含stdata与rtdata
 BACKUP_INTERVAL = 7
 
 
+# 主节点保留最近多少份备份
+# int, default: 4
+BACKUP_KEEP = 4
+
+
 # 主节点只滚动记录最近多少天的 持久存档数据stdata
 # int (in days), default: 180
 STDATA_TRUNCATE_EXPIRE = 30 * 6
 
 
+# 主节点 存档数据stdata 每个封存分段文件覆盖的天数
+# int (in days), default: 1
+# NOTE: 过期清理以分段为单位，7即按周分段
+STDATA_SEGMENT_SPAN = 1
+
+
 # 主节点只滚动记录最近多少天的 运行时数据rtdata
 # int (in days), default: 3
 RTDATA_TRUNCATE_EXPIRE = 3
 
 
+# 主节点 运行时数据rtdata 的多级汇总层级，原始帧过期后仍保留各级的 min/mean/max 供长期趋势查询
+# [(bucket_width:int in seconds, retention:int in days)], default: [(60, 7), (15*60, 30), (60*60, 180)]
+# NOTE: 随rtdata一同dump; 查询降采样时自动选取满足分辨率的最粗层级
+RTDATA_ROLLUP_TIERS = [(60, 7), (15*60, 30), (60*60, 180)]
+
+
+# 从节点积压待补交的 统计数据包stats 的个数上限，超出时优先丢弃最旧的runtime包
+# int, default: 4320
+# NOTE: 积压随rtdata一同dump; 以COMMIT_INTERVAL=20计，4320约为一天的runtime包
+BACKLOG_LIMIT = 4320
+
+
+# 从节点补交积压的 统计数据包stats 时，每个batch包打包的个数
+# int, default: 500
+BACKLOG_BATCH_SIZE = 500
+
+
+# 从节点向主节点提交数据使用的编码
+# str, 'json' | 'zjson' | 'msgpack', default: 'json'
+# NOTE: 'zjson'为zlib压缩的JSON(仅需标准库); 'msgpack'需安装msgpack，未安装时退化为'zjson'; 主节点不支持时回退到'json'
+WIRE_ENCODING = 'json'
+
+
+# 主节点解码压缩请求体时解压后的大小上限，超出则拒绝(413)，防止解压炸弹
+# int in MB, default: 64
+PAYLOAD_MAX_SIZE = 64
+
+
+# 从节点暴露 /metrics 与 metrics查询 的监听位置，如 ('127.0.0.1', 5102)
+# ('host':str, port:int) or None, default: None
+# NOTE: None表示不监听，多用户的节点上注意端口冲突; 主节点的指标在其自身端口的 /metrics
+CLIENT_METRICS_SOCKET = None
+
+
+# 主节点 统计数据包stats 每个接收队列(每个处理线程一个)的长度上限，处理线程按批从队列取出处理
+# int, default: 1024
+# NOTE: 队列满时回复 503 Service Unavailable 并带上 Retry-After
+INGEST_QUEUE_SIZE = 1024
+
+
+# 主节点处理 统计数据包stats 的线程数，按节点分片，同一节点的包总是由同一线程按序处理
+# int, default: 2
+INGEST_WORKERS = 2
+
+
+# 主节点处理线程每批最多处理的 统计数据包stats 个数，一批内同一节点的包只获取一次锁
+# int, default: 64
+INGEST_BATCH_SIZE = 64
+
+
+# 主节点接收队列满时，建议从节点重试的等待时间
+# int (in seconds), default: 5
+INGEST_RETRY_AFTER = 5
+
+
+# 主节点查询结果缓存的容量上限，按JSON字节数以LRU淘汰
+# int (in bytes), default: 32 * 1024 * 1024
+# NOTE: 0表示禁用缓存; 节点提交stats或重载配置时相关缓存失效
+QUERY_CACHE_SIZE = 32 * 1024 * 1024
+
+
+# 主节点流式查询 /query/stream 每次写出的任务task 行数，以NDJSON分块传输
+# int, default: 500
+QUERY_STREAM_CHUNK = 500
+
+
 # 配额规则quota_rule 所在文件路径
 # str (relpath or abspath), default: 'quota_rule.txt'
 QUOTA_RULE_FILE = 'quota_rule.txt'
@@ -77,6 +205,39 @@ QUOTA_RULE_FILE = 'quota_rule.txt'
 DATA_PATH = 'data'
 
 
+# 以快照格式dump的 运行时数据rtdata 变量，按节点分块并以mmap映射，启动时不整体载入
+# List[str] (in '<角色>-<变量>'), default: ['server-runtime_info']
+# NOTE: 仅对pickle后端下按节点索引的dict生效，存为 DATA_PATH 下的 <角色>-<变量>.snap；
+#       某节点的数据在首次被查询或写入时才反序列化，未载入过的节点再次dump时原样拷贝；
+#       快照按 DUMP_CODEC 逐块压缩；置空则改回pkl
+RTDATA_SNAPSHOT_VARS = ['server-runtime_info']
+
+
+# 存档数据stdata 与 运行时数据rtdata 的存储后端
+# str, 'pickle' or 'sqlite', default: 'pickle'
+# NOTE: sqlite后端存于 DATA_PATH 下的 stdata.db 与 <角色>-rtdata.db，任务查询的过滤条件下推为SQL，
+#       不再将全部任务载入内存；已有的pkl数据文件可用 migrate.py 一次性转换
+STORAGE_BACKEND = 'pickle'
+
+
+# 主节点服务进程数，>1时以预先fork的方式共享监听端口
+# int, default: 1
+# NOTE: 需要 STORAGE_BACKEND = 'sqlite'；仅首个进程写入数据，其余进程转发stats并经 DATA_PATH 下的 bus.db 同步状态，
+#       查询与推送由各进程分担；此模式下浏览器的socket.io只能使用websocket传输
+SERVER_WORKERS = 1
+
+
+# 多进程模式下各进程经 bus.db 同步状态与推送事件的轮询间隔
+# float (in seconds), default: 0.1
+BUS_POLL_INTERVAL = 0.1
+
+
+# 进程内耗时直方图 (路由、查询种类、stats种类、锁等待、`perf_timer`函数) 的桶上界
+# List[float] (in seconds), default: [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# NOTE: 改动后需重启生效; 多进程模式下各进程分别计数
+METRICS_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
 # 日志log 文件存放的目录
 # str (relpath or abspath), default: 'log'
 LOG_PATH = 'log'
@@ -6,12 +6,14 @@
 # tests are leaving for you to confirm of. 
 
 
-from json import dumps
+import zlib
+from json import dumps, loads
+from time import time, sleep
 from requests import session
 
 import settings as hp
 from packets import *
-from sodayo.utils import sock_to_hostport
+from utils import sock_to_hostport
 
 
 API_BASE = f'http://{sock_to_hostport(hp.MASTER_SOCKET)}'
@@ -24,6 +26,62 @@ def assert_recode(resp, retcode=200):
   except:
     print('<< failed')
 
+def assert_fields(resp, *keys, retcode=200, under=None):
+  # status and the key fields of `data` (or of `data[under]`), of its first row if a list
+  try:
+    res = resp.json()
+    assert res.get('status_code') == retcode
+    data = res.get('data')
+    if under is not None: data = data[under]
+    row = data[0] if isinstance(data, list) else data
+    assert all(key in row for key in keys)
+    print('>> ok')
+  except:
+    print('<< failed')
+
+def assert_decoded(resp, encoding, retcode=200):
+  # replied in the negotiated encoding
+  try:
+    assert resp.headers.get('Content-Type') == MIMETYPES[encoding]
+    assert decode_payload(resp.content, encoding).get('status_code') == retcode
+    print('>> ok')
+  except:
+    print('<< failed')
+
+def assert_cursor(resp, more=True):
+  # a page of tasks, with a cursor to the next one if `more`
+  try:
+    res = resp.json()
+    assert res.get('status_code') == 200 and res.get('data')
+    assert ('cursor' in res) == more
+    print('>> ok')
+  except:
+    print('<< failed')
+
+def assert_ndjson(resp, *keys):
+  # streamed rows, one JSON object per line
+  try:
+    assert resp.status_code == 200 and resp.headers.get('Content-Type') == 'application/x-ndjson'
+    rows = [loads(line) for line in resp.text.splitlines()]
+    assert rows and all(key in row for row in rows for key in keys)
+    print('>> ok')
+  except:
+    print('<< failed')
+
+def assert_text(resp, *words):
+  # plain text reply holding all `words`
+  try:
+    assert resp.status_code == 200 and resp.headers.get('Content-Type', '').startswith('text/plain')
+    assert all(word in resp.text for word in words)
+    print('>> ok')
+  except:
+    print('<< failed')
+
+def assert_status(resp, status=200):
+  # HTTP status, for what does not reply a packet
+  if resp.status_code == status: print('>> ok')
+  else:                          print('<< failed')
+
 
 def test_server():
   http = session()
@@ -31,7 +89,7 @@ def test_server():
   data = {
     'hostname': 'nohost',
   }
-  r = http.post('/heartbeat', json=dumps(data))
+  r = http.post(f'{API_BASE}/heartbeat', json=dumps(data))
   assert_recode(r)
 
   data = {
@@ -42,7 +100,7 @@ def test_server():
       ]
     }
   }
-  r = http.post('/stats', json=dumps(data))
+  r = http.post(f'{API_BASE}/stats', json=dumps(data))
   assert_recode(r)
 
   data = {
@@ -51,7 +109,7 @@ def test_server():
       
     }
   }
-  r = http.post('/stats', json=dumps(data))
+  r = http.post(f'{API_BASE}/stats', json=dumps(data))
   assert_recode(r)
 
   data = {
@@ -62,37 +120,59 @@ def test_server():
       }
     ]
   }
-  r = http.post('/stats', json=dumps(data))
+  r = http.post(f'{API_BASE}/stats', json=dumps(data))
+  assert_recode(r)
+
+  data = {
+    'type': 'batch',
+    'batch': [
+      {
+        'type': 'runtime',
+        'runtime': { }
+      },
+      {
+        'type': 'tasks',
+        'tasks': [ ]
+      }
+    ]
+  }
+  r = http.post(f'{API_BASE}/stats', json=dumps(data))
   assert_recode(r)
 
   data = {
     'type': 'settings',
   }
-  r = http.post('/query', json=dumps(data))
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
   assert_recode(r)
 
   data = {
     'type': 'quota',
   }
-  r = http.post('/query', json=dumps(data))
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
   assert_recode(r)
 
   data = {
     'type': 'hardware',
   }
-  r = http.post('/query', json=dumps(data))
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
   assert_recode(r)
 
   data = {
     'type': 'runtime',
   }
-  r = http.post('/query', json=dumps(data))
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
   assert_recode(r)
 
   data = {
     'type': 'tasks',
   }
-  r = http.post('/query', json=dumps(data))
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_recode(r)
+
+  data = {
+    'type': 'userstats',
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
   assert_recode(r)
 
   data = {
@@ -100,9 +180,151 @@ def test_server():
     'password': 'nopwd',
     'gpu_count': 1,
   }
-  r = http.post('/realloc', json=dumps(data))
+  r = http.post(f'{API_BASE}/realloc', json=dumps(data))
   assert_recode(r)
 
+  now = int(time())
+  data = {
+    'type': 'tasks',
+    'tasks': [
+      {
+        'username': 'nobody',
+        'gpu_id': 0,
+        'command': 'python nocode.py',
+        'start_ts': now - 7200,
+        'end_ts': now - 3600,
+      },
+      {
+        'username': 'nobody',
+        'gpu_id': 1,
+        'command': 'python yescode.py',
+        'start_ts': now - 3600,
+        'end_ts': now - 1800,
+      },
+      {
+        'username': 'somebody',
+        'gpu_id': 0,
+        'command': 'python nocode.py',
+        'start_ts': now - 1800,
+        'end_ts': now - 60,
+      },
+    ]
+  }
+  r = http.post(f'{API_BASE}/stats', json=dumps(data))
+  assert_recode(r)
+  sleep(0.5)    # applied by the ingest worker later
+
+  data = {
+    'type': 'tasks',
+    'command': 'python yes.*',
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_fields(r, 'command', 'start_ts')
+
+  data = {
+    'type': 'runtime',
+    'hostname': 'nohost',
+    'max_points': 10,
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_fields(r, 'ts', 'count', 'resolution', 'source', under='nohost')
+
+  data = {
+    'type': 'userstats',
+    'username': 'nobody',
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_fields(r, 'count', 'total_duration', 'avg_duration', 'hist', 'active_hours', under='nobody')
+
+  data = {
+    'type': 'streaming',
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_fields(r, 'ticks', 'frames_sent', 'frames_coalesced', 'bytes_saved', 'rooms')
+
+  data = {
+    'type': 'tasks',
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_recode(r)
+  r = http.post(f'{API_BASE}/query', json=dumps(data), headers={'If-None-Match': r.headers.get('ETag', '')})
+  assert_status(r, 304)
+
+  for encoding in ['msgpack', 'zjson']:
+    encoding = resolve_encoding(encoding)     # msgpack falls back to zjson if not installed
+    headers = {'Content-Type': MIMETYPES[encoding], 'Accept': MIMETYPES[encoding]}
+    data = {
+      'type': 'runtime',
+      'runtime': { },
+    }
+    r = http.post(f'{API_BASE}/stats', data=encode_payload(data, encoding), headers=headers)
+    assert_decoded(r, encoding)
+
+    data = {
+      'type': 'quota',
+    }
+    r = http.post(f'{API_BASE}/query', data=encode_payload(data, encoding), headers=headers)
+    assert_decoded(r, encoding)
+
+  # inflates past PAYLOAD_MAX_SIZE
+  bomb = zlib.compress(b' ' * ((hp.PAYLOAD_MAX_SIZE << 20) + 1))
+  r = http.post(f'{API_BASE}/query', data=bomb, headers={'Content-Type': MIMETYPES['zjson']})
+  assert_recode(r, 413)
+
+  data = {
+    'type': 'ingest',
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_fields(r, 'queue_depth', 'enqueued', 'rejected', 'applied', 'failed', 'apply_latency')
+
+  data = {
+    'type': 'locks',
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_fields(r, 'acquired', 'contended', under='*')
+
+  data = {
+    'type': 'liveness',
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_fields(r, 'state', 'host', 'last_ACK', 'idle', under='nohost')
+
+  data = {
+    'type': 'tasks',
+    'limit': 2,
+    'order': 'desc',
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_cursor(r)
+  data['cursor'] = r.json().get('cursor')
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_cursor(r, more=False)
+
+  data = {
+    'type': 'tasks',
+    'username': 'nobody',
+  }
+  r = http.post(f'{API_BASE}/query/stream', json=dumps(data))
+  assert_ndjson(r, 'username', 'start_ts')
+
+  data = {
+    'type': 'aggregate',
+    'source': 'tasks',
+    'group_by': ['username'],
+    'metrics': ['count', 'sum:duration'],
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_fields(r, 'username', 'count', 'sum:duration')
+
+  data = {
+    'type': 'metrics',
+  }
+  r = http.post(f'{API_BASE}/query', json=dumps(data))
+  assert_fields(r, 'counters', 'gauges', 'histograms')
+
+  r = http.get(f'{API_BASE}/metrics')
+  assert_text(r, 'sodayo_requests_total', 'sodayo_request_seconds_bucket')
+
 
 if __name__ == '__main__':
   test_server()
@@ -5,16 +5,28 @@
 import os
 import re
 import logging
-from shutil import copy2
+from shutil import copy2, copytree, ignore_patterns, rmtree
 from logging.handlers import TimedRotatingFileHandler
-from time import time
-from datetime import datetime
-from threading import RLock
-from collections import deque
+from time import perf_counter
+from datetime import datetime, date, time as dt_time, timedelta
+from threading import Lock, RLock, Event
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
+from itertools import islice
+from contextlib import closing
+from io import BytesIO
+from heapq import heapify, heappush, heappop
+from bisect import bisect_left, bisect_right
+import mmap
+import bz2
+import gzip
 import lzma
+import zlib
+import sqlite3
+import struct
 import pickle as pkl
 from importlib import reload as reload_module
-from typing import List, Tuple
+from typing import Any, Callable, Dict, Hashable, Iterator, List, NamedTuple, Optional, Tuple
 from traceback import format_exc
 
 import settings as hp
@@ -32,7 +44,11 @@ import settings as hp
 #   socket
 #   data file read/write
 #   shell execute            (general purpose)
+#   metrics                  (general purpose)
 #   decorators               (general purpose)
+#   locks                    (general purpose)
+#   cache                    (general purpose)
+#   timers                   (general purpose)
 #   private callback         (special)
 #
 
@@ -88,6 +104,13 @@ def iso_to_ts(time_iso:str) -> int:
 def ts_to_iso(time_ts:int) -> str:
   return datetime.fromtimestamp(time_ts).strftime(TIME_FORMAT_STR)
 
+def ts_to_month(time_ts:int) -> str:
+  return datetime.fromtimestamp(time_ts).strftime('%Y-%m')
+
+def month_start_ts(time_ts:int) -> int:
+  dt = datetime.fromtimestamp(time_ts)
+  return int(datetime.timestamp(datetime(dt.year, dt.month, 1)))
+
 
 # string
 WHITESPACE_REGEX = re.compile(r'\s+')
@@ -102,33 +125,269 @@ def sock_to_hostport(sock:Tuple[str, int]) -> str:
 
 
 # data file read/write
-DUMPABLE_TYPES = (list, dict, set, deque)
+DUMPABLE_TYPES = (list, dict, set, deque, MutableMapping)
 
 class Record:                 # interface for stdata record classes
 
-  # db_file:str = None        # auto set by metaclass
-  objects: List[dict] = [ ]   # NOTE: length truncated by `STDATA_TRUNCATE_EXPIRE`
-  
+  # db_file:str = None        # auto set by metaclass, legacy single-file storage
+  # db_path:str = None        # auto set by metaclass, folder of segment files
+  # store:SQLiteStore = None  # auto set by metaclass if `STORAGE_BACKEND` is 'sqlite', else pickle files are used
+  objects: List[dict] = [ ]   # NOTE: length truncated by `STDATA_TRUNCATE_EXPIRE`, kept sorted by `order_key`
+                              # NOTE: stays empty with sqlite, go through `select()` instead
+  order_key: str = 'ts'       # field which `objects` are sorted by, MUST be present in every object
+  index_keys: Tuple[str] = ( )  # fields to keep secondary indexes on
+  column_keys: Tuple[str] = ( ) # extra fields kept as columns in sqlite, so that filters on them are pushed down
+  partition_key: str = 'ts'   # field which segments are partitioned by, stamped on add if absent
+  mark: Any = None            # what the caller says the saved objects are up to, e.g. a log position, saved along with them
+
+  # auto set by metaclass, all kept in the same order as `objects`
+  # _keys: List[tuple]        # sort keys `(obj[order_key], seq)`, seq breaks ties by insertion order
+  # _indexes: Dict[str, Dict[Any, Tuple[List[tuple], List[dict]]]]   # field => value => (keys, objects)
+  # _seq: int                 # next seq to assign
+  # _tail: List[dict]         # objects not yet sealed into a segment, aka. the active tail
+  # _dirty: int               # approx. bytes added since last `save()`
+
+  # on-disk layout under `db_path`:
+  #   seg-<date>[.n].pkl      sealed immutable segments, one per `STDATA_SEGMENT_SPAN` days
+  #   tail.pkl                the active tail and `mark`, the only file rewritten by `save()`
+  # or with sqlite, a table named after the class in `DATA_PATH/stdata.db` and `mark` in its meta table,
+  # nothing is held in memory
+
+  @classmethod
+  def load(cls, since_ts:int=None):
+    if cls.store:
+      cls.store.create_table(cls)
+      mark = cls.store.get_meta(f'mark:{cls.__name__}')
+      cls.mark = mark and pkl.loads(mark)
+      cls._dirty = 0
+      return
+
+    # segments ending before `since_ts` are skipped, default to the retention window
+    since_ts = since_ts or now_ts() - day_to_sec(hp.STDATA_TRUNCATE_EXPIRE)
+    since_seg = segment_of(since_ts)
+
+    objects, sealed = [ ], set()
+    for seg, fp in list_segments(cls.db_path):
+      sealed.add(seg)
+      if seg < since_seg: continue
+      try:
+        objects.extend(load_pkl(fp))
+        logger.debug(f'   load {fp}')
+      except Exception:
+        logger.error(format_exc())
+
+    tail, mark = [ ], None
+    for fp in [cls.db_file, os.path.join(cls.db_path, 'tail.pkl')]:
+      if not os.path.exists(fp): continue
+      try:
+        # the legacy file and tails of older versions are bare lists
+        objs = load_pkl(fp)
+        if isinstance(objs, dict): objs, mark = objs['objects'], objs['mark']
+        # NOTE: a crash between sealing a segment and rewriting the tail leaves duplicates in the tail
+        tail.extend(obj for obj in objs if segment_of(obj.setdefault(cls.partition_key, now_ts())) not in sealed)
+        logger.debug(f'   load {fp}')
+      except Exception:
+        logger.error(format_exc())
+
+    cls.objects = objects + tail
+    cls._tail = tail
+    cls.mark = mark
+    cls._dirty = 0
+    cls.reindex()
+
   @classmethod
-  def load(cls):
+  def save(cls, mark:Any=None) -> bool:
+    staged = cls.stage(mark)
+    ok = cls.write(staged)
+    if ok: cls.settle(staged)
+    return ok
+
+  @classmethod
+  def stage(cls, mark:Any=None) -> tuple:
+    # the in-memory part of `save()`, to be done under the lock of the record
+    # returns what `write()` puts to files, which may be done later out of the lock, or in a forked child
+    # NOTE: the tail is left as it is till `settle()`, a failed write is staged again next time
+    if cls.store:
+      # rows are written in place already, commit is all it takes
+      try:
+        cls.truncate(now_ts() - day_to_sec(hp.STDATA_TRUNCATE_EXPIRE))
+        cls.commit(mark)
+        cls._dirty = 0
+        logger.debug(f'   commit {cls.__name__} to {cls.store.fp}')
+      except Exception:
+        logger.error(format_exc())
+      return None
+
+    # seal whatever in the tail belongs to a past segment
+    now_seg = segment_of(now_ts())
+    sealing, tail = { }, [ ]
+    for obj in cls._tail:
+      seg = segment_of(obj[cls.partition_key])
+      if seg < now_seg: sealing.setdefault(seg, [ ]).append(obj)
+      else:             tail.append(obj)
+    cls.truncate(now_ts() - day_to_sec(hp.STDATA_TRUNCATE_EXPIRE))
+    return sealing, tail, cls._dirty, mark
+
+  @classmethod
+  def write(cls, staged:tuple) -> bool:
+    if staged is None: return True
+    sealed = [ ]
     try:
+      sealing, tail, _, mark = staged
+      os.makedirs(cls.db_path, exist_ok=True)
+      fp = os.path.join(cls.db_path, 'tail.pkl')
+      # the tail with `mark` goes first still holding the sealing ones, so that it never claims objects
+      # not on the disk, those already in sealed segments are dropped on load
+      if sealing:
+        save_pkl({'mark': mark, 'objects': [obj for objs in sealing.values() for obj in objs] + tail}, fp)
+      for seg, objs in sealing.items():
+        fp = new_segment_file(cls.db_path, seg)
+        save_pkl(objs, fp)
+        sealed.append(fp)
+        logger.debug(f'   seal {fp}')
+
+      fp = os.path.join(cls.db_path, 'tail.pkl')
+      save_pkl({'mark': mark, 'objects': tail}, fp)
+      logger.debug(f'   dump {fp}')
+
+      # the legacy file has been fully taken over by segments and tail
       if os.path.exists(cls.db_file):
-        cls.objects = load_pkl(cls.db_file)
-        logger.debug(f'   load {cls.db_file}')
+        os.replace(cls.db_file, f'{cls.db_file}.migrated')
+      return True
     except Exception:
       logger.error(format_exc())
+      # the tail on disk still has them, segments sealed this time would be duplicates of the next try
+      for fp in sealed: os.unlink(fp)
+      return False
 
   @classmethod
-  def save(cls):
-    try:
-      save_pkl(cls.objects, cls.db_file)
-      logger.debug(f'   dump {cls.db_file}')
-    except Exception:
-      logger.error(format_exc())
+  def settle(cls, staged:tuple):
+    # after `write()` of what `stage()` returned succeeded, under the lock of the record:
+    # the sealed go off the tail, bytes added since are left dirty
+    if staged is None: return
+    sealing, _, dirty, mark = staged
+    sealed = {id(obj) for objs in sealing.values() for obj in objs}
+    if sealed: cls._tail = [obj for obj in cls._tail if id(obj) not in sealed]
+    cls._dirty = max(cls._dirty - dirty, 0)
+    cls.mark = mark
+
+  @classmethod
+  def commit(cls, mark:Any=None):
+    # sqlite only: rows added so far go durable along with `mark`, in between of `save()`
+    cls.store.set_meta(f'mark:{cls.__name__}', pkl.dumps(mark, protocol=pkl.HIGHEST_PROTOCOL))
+    cls.store.commit()
+    cls.mark = mark
+
+  @classmethod
+  def truncate(cls, before_ts:int):
+    # retention works on whole segments: unlink the expired ones and forget their objects
+    before_seg = segment_of(before_ts)
+    if cls.store:
+      cls.store.delete_before(cls, datetime.combine(before_seg, dt_time()).timestamp())
+      return
+    expired = [fp for seg, fp in list_segments(cls.db_path) if seg < before_seg]
+    for fp in expired:
+      os.unlink(fp)
+      logger.debug(f'   unlink {fp}')
+    if expired:
+      cls.objects = [obj for obj in cls.objects if segment_of(obj[cls.partition_key]) >= before_seg]
+      cls.reindex()
 
   @classmethod
   def add(cls, obj:dict):
-    cls.objects.append(obj)
+    key = (obj[cls.order_key], cls._seq)
+    cls._seq += 1
+    if cls.partition_key not in obj: obj[cls.partition_key] = now_ts()
+    cls._dirty += len(repr(obj))
+    if cls.store:
+      cls.store.insert(cls, [obj])
+      return
+    cls._tail.append(obj)
+
+    _sorted_insert(cls._keys, cls.objects, key, obj)
+    cls.index(key, obj)
+
+  @classmethod
+  def index(cls, key:tuple, obj:dict):
+    # subclasses may extend this to maintain extra indexes
+    for field, index in cls._indexes.items():
+      bucket = index.get(obj.get(field))
+      if bucket is None: bucket = index[obj.get(field)] = ([ ], [ ])
+      _sorted_insert(*bucket, key, obj)
+
+  @classmethod
+  def reindex(cls):
+    n_objects = len(cls.objects)
+    cls.objects = [obj for obj in cls.objects if obj.get(cls.order_key) is not None]
+    cls._tail = [obj for obj in cls._tail if obj.get(cls.order_key) is not None]
+    if len(cls.objects) != n_objects:
+      logger.warning(f'[{cls.__name__}] dropped {n_objects - len(cls.objects)} objects without {cls.order_key!r}')
+    cls.objects.sort(key=lambda obj: obj[cls.order_key])
+    cls._keys = [(obj[cls.order_key], seq) for seq, obj in enumerate(cls.objects)]
+    cls._seq = len(cls.objects)
+    cls._indexes = {field: { } for field in cls.index_keys}
+    for key, obj in zip(cls._keys, cls.objects):
+      cls.index(key, obj)
+
+  @classmethod
+  def select(cls, eq:Dict[str, Any]=None, lo=None, hi=None,
+                  upto:Dict[str, Any]=None, contains:Dict[str, str]=None) -> List[dict]:
+    # objects matching all `eq` fields with `lo <= obj[order_key] <= hi`, in order
+    # also `obj[field] <= upto[field]` and `contains[field] in obj[field]` if given
+    if cls.store: return cls.store.select(cls, eq, lo, hi, upto, contains)
+
+    eq, upto, contains = eq or { }, upto or { }, contains or { }
+    # pick the narrowest candidate range among the indexed fields
+    keys, objs = cls._keys, cls.objects
+    for field in eq:
+      if field not in cls._indexes: continue
+      bucket = cls._indexes[field].get(eq[field])
+      if bucket is None: return [ ]
+      if len(bucket[0]) < len(keys): keys, objs = bucket
+
+    i = 0         if lo is None else bisect_left(keys, (lo,))
+    j = len(keys) if hi is None else bisect_right(keys, (hi, float('inf')))
+    if not (eq or upto or contains): return objs[i:j]
+    return [obj for obj in islice(objs, i, j) if _match(obj, eq, upto, contains)]
+
+  @classmethod
+  def iter_select(cls, eq:Dict[str, Any]=None, lo=None, hi=None, upto:Dict[str, Any]=None,
+                       contains:Dict[str, str]=None, reverse:bool=False) -> Iterator[dict]:
+    # lazy `select()`, descending if `reverse`; objects are taken `SQLiteStore.PAGE_SIZE` at a time,
+    # so a consumer that stops early never pays for the rest of the range
+    # NOTE: objects added while iterating may or may not show up, none is repeated nor skipped
+    if cls.store:
+      yield from cls.store.iter_select(cls, eq, lo, hi, upto, contains, reverse)
+      return
+
+    eq, upto, contains = eq or { }, upto or { }, contains or { }
+    keys, objs = cls._keys, cls.objects
+    for field in eq:
+      if field not in cls._indexes: continue
+      bucket = cls._indexes[field].get(eq[field])
+      if bucket is None: return
+      if len(bucket[0]) < len(keys): keys, objs = bucket
+
+    def locate(obj:dict) -> int:
+      # where `obj` is now, inserts before it move it to the right
+      k = bisect_left(keys, (obj[cls.order_key],))
+      while k < len(objs) and objs[k] is not obj: k += 1
+      return k
+
+    size = SQLiteStore.PAGE_SIZE
+    i = 0         if lo is None else bisect_left(keys, (lo,))
+    j = len(keys) if hi is None else bisect_right(keys, (hi, float('inf')))
+    while True:
+      page = objs[i:min(j, i + size)] if not reverse else objs[max(i, j - size):j]
+      if not page: return
+      for obj in (reversed(page) if reverse else page):
+        if _match(obj, eq, upto, contains): yield obj
+      if not reverse:
+        i = locate(page[-1]) + 1
+        j = len(keys) if hi is None else bisect_right(keys, (hi, float('inf')))
+      else:
+        j = locate(page[0])
+        i = 0 if lo is None else bisect_left(keys, (lo,))
 
 class RecordMeta(type):       # metaclass for stdata record classes
   
@@ -138,48 +397,637 @@ class RecordMeta(type):       # metaclass for stdata record classes
     super().__init__(name, bases, _dict)
     RecordMeta.objects.add(cls)
 
+    # each record class owns its storage, do not share with the base
+    cls.objects = [ ]
+    cls._tail = [ ]
+    cls._dirty = 0
+    cls.reindex()
+
     # FIXME: currently we only consider persist stdata at server side, so filename without prefix
     os.makedirs(hp.DATA_PATH, exist_ok=True)
     setattr(cls, 'db_file', os.path.join(hp.DATA_PATH, f'{name}.pkl'))
+    setattr(cls, 'db_path', os.path.join(hp.DATA_PATH, name))
+    setattr(cls, 'store', hp.STORAGE_BACKEND == 'sqlite' and sqlite_store(stdata_db_file()) or None)
+
+def _match(obj:dict, eq:Dict[str, Any], upto:Dict[str, Any], contains:Dict[str, str]) -> bool:
+  return all(obj.get(k) == v for k, v in eq.items()) \
+     and all(obj.get(k) is not None and obj[k] <= v for k, v in upto.items()) \
+     and all(v in (obj.get(k) or '') for k, v in contains.items())
+
+def _sorted_insert(keys:List[tuple], objs:List[dict], key:tuple, obj:dict):
+  # NOTE: records mostly arrive in order, so appending is the common case
+  if not keys or keys[-1] <= key:
+    keys.append(key)
+    objs.append(obj)
+  else:
+    i = bisect_right(keys, key)
+    keys.insert(i, key)
+    objs.insert(i, obj)
+
+SEGMENT_FILE_REGEX = re.compile(r'^seg-(\d{4}-\d{2}-\d{2})(\.\d+)?\.pkl$')
+
+def segment_of(ts:int) -> date:
+  # first day of the segment which `ts` falls in, segments are aligned to local date
+  n = datetime.fromtimestamp(ts).toordinal()
+  return date.fromordinal(n - (n - 1) % hp.STDATA_SEGMENT_SPAN)
+
+def list_segments(dp:str) -> List[Tuple[date, str]]:
+  if not os.path.isdir(dp): return [ ]
+  segs = [ ]
+  for fn in sorted(os.listdir(dp)):
+    m = SEGMENT_FILE_REGEX.match(fn)
+    if m: segs.append((date.fromisoformat(m.group(1)), os.path.join(dp, fn)))
+  return segs
+
+def new_segment_file(dp:str, seg:date) -> str:
+  # sealed segments are never rewritten, late comers go to a numbered sibling
+  fp = os.path.join(dp, f'seg-{seg.isoformat()}.pkl')
+  n = 0
+  while os.path.exists(fp):
+    n += 1
+    fp = os.path.join(dp, f'seg-{seg.isoformat()}.{n}.pkl')
+  return fp
+
+class SQLiteStore:
+
+  # stdata records (a table per record class) and rtdata (table `rtdata`) in a sqlite db in WAL mode
+  # NOTE: one connection shared by threads, writes stay in the open transaction till `commit()`,
+  #       so the db holds exactly what the last dump did, just like the pickle files
+
+  PAGE_SIZE = 1000      # rows fetched per keyset page by `select()`
+  SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS rtdata (name TEXT PRIMARY KEY, value BLOB NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)',
+  ]
+
+  def __init__(self, fp:str):
+    self.fp = fp
+    self.lock = RLock()
+    self._conn = None
+    self._pid = None
+
+  @property
+  def conn(self) -> sqlite3.Connection:
+    # connected on first use, and again in a forked child, a connection never crosses `fork()`
+    if self._pid != os.getpid():
+      self._conn = sqlite3.connect(self.fp, check_same_thread=False)
+      self._conn.execute('PRAGMA journal_mode=WAL')
+      self._conn.execute('PRAGMA synchronous=NORMAL')
+      for sql in self.SCHEMA: self._conn.execute(sql)
+      self._conn.commit()
+      self._pid = os.getpid()
+    return self._conn
+
+  @staticmethod
+  def columns(rec:type) -> List[str]:
+    return list(dict.fromkeys([rec.order_key, rec.partition_key, *rec.index_keys, *rec.column_keys]))
+
+  def create_table(self, rec:type):
+    table, order = rec.__name__, rec.order_key
+    with self.lock:
+      cols = ', '.join(f'"{col}"' for col in self.columns(rec))
+      self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (seq INTEGER PRIMARY KEY, {cols}, obj BLOB NOT NULL)')
+      self.conn.execute(f'CREATE INDEX IF NOT EXISTS "{table}_{order}" ON "{table}" ("{order}", seq)')
+      if rec.partition_key != order:
+        self.conn.execute(f'CREATE INDEX IF NOT EXISTS "{table}_{rec.partition_key}" ON "{table}" ("{rec.partition_key}")')
+      for field in rec.index_keys:
+        self.conn.execute(f'CREATE INDEX IF NOT EXISTS "{table}_{field}" ON "{table}" ("{field}", "{order}", seq)')
+      self.conn.commit()
+
+  def insert(self, rec:type, objs:List[dict]):
+    cols = self.columns(rec)
+    names = ', '.join(f'"{col}"' for col in cols)
+    sql = f'INSERT INTO "{rec.__name__}" ({names}, obj) VALUES ({", ".join("?" * (len(cols) + 1))})'
+    rows = [[_sql_value(obj.get(col)) for col in cols] + [pkl.dumps(obj, protocol=pkl.HIGHEST_PROTOCOL)] for obj in objs]
+    with self.lock:
+      self.conn.executemany(sql, rows)
+
+  def select(self, rec:type, eq:Dict[str, Any]=None, lo=None, hi=None,
+                   upto:Dict[str, Any]=None, contains:Dict[str, str]=None) -> List[dict]:
+    return list(self.iter_select(rec, eq, lo, hi, upto, contains))
+
+  def iter_select(self, rec:type, eq:Dict[str, Any]=None, lo=None, hi=None, upto:Dict[str, Any]=None,
+                        contains:Dict[str, str]=None, reverse:bool=False) -> Iterator[dict]:
+    # filters on columns go to sql, the rest are done on the objects; pages are walked by `(order_key, seq)`,
+    # the lock is held per page only
+    cols, order = self.columns(rec), rec.order_key
+    conds, args = [ ], [ ]
+    post_eq, post_upto, post_contains = { }, { }, { }
+    for field, value in (eq or { }).items():
+      if field in cols: conds.append(f'"{field}" = ?'); args.append(value)
+      else: post_eq[field] = value
+    for field, value in (upto or { }).items():
+      if field in cols: conds.append(f'"{field}" <= ?'); args.append(value)
+      else: post_upto[field] = value
+    for field, value in (contains or { }).items():
+      if field in cols: conds.append(f'instr("{field}", ?) > 0'); args.append(value)
+      else: post_contains[field] = value
+    if lo is not None: conds.append(f'"{order}" >= ?'); args.append(lo)
+    if hi is not None: conds.append(f'"{order}" <= ?'); args.append(hi)
+
+    sql = f'SELECT "{order}", seq, obj FROM "{rec.__name__}" WHERE {" AND ".join(conds + ["1"])}'
+    cmp, direction = ('<', 'DESC') if reverse else ('>', 'ASC')
+    last = None
+    while True:
+      with self.lock:
+        if last is None: rows = self.conn.execute(f'{sql} ORDER BY "{order}" {direction}, seq {direction} LIMIT {self.PAGE_SIZE}', args).fetchall()
+        else: rows = self.conn.execute(f'{sql} AND ("{order}", seq) {cmp} (?, ?) ORDER BY "{order}" {direction}, seq {direction} LIMIT {self.PAGE_SIZE}', args + list(last)).fetchall()
+      for _, _, blob in rows:
+        obj = pkl.loads(blob)
+        if _match(obj, post_eq, post_upto, post_contains): yield obj
+      if len(rows) < self.PAGE_SIZE: return
+      last = rows[-1][:2]
+
+  def count(self, rec:type) -> int:
+    with self.lock:
+      return self.conn.execute(f'SELECT COUNT(*) FROM "{rec.__name__}"').fetchone()[0]
+
+  def delete_before(self, rec:type, ts:float):
+    with self.lock:
+      self.conn.execute(f'DELETE FROM "{rec.__name__}" WHERE "{rec.partition_key}" < ?', (ts,))
+
+  def get_meta(self, name:str) -> Any:
+    with self.lock:
+      row = self.conn.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+    return row and row[0]
+
+  def set_meta(self, name:str, value:Any):
+    # goes with the open transaction
+    with self.lock:
+      self.conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+
+  def get(self, name:str) -> object:
+    with self.lock:
+      row = self.conn.execute('SELECT value FROM rtdata WHERE name = ?', (name,)).fetchone()
+    return row and pkl.loads(row[0])
+
+  def put(self, name:str, obj:object):
+    blob = pkl.dumps(obj, protocol=pkl.HIGHEST_PROTOCOL)
+    with self.lock:
+      self.conn.execute('INSERT OR REPLACE INTO rtdata (name, value) VALUES (?, ?)', (name, blob))
+
+  def commit(self):
+    with self.lock:
+      self.conn.commit()
+
+  def close(self):
+    with self.lock:
+      if self._pid == os.getpid(): self._conn.close()
+      self._conn = self._pid = None
+
+class SQLiteBus(SQLiteStore):
+
+  # a local stand-in for a message queue between the processes on one box
+  #   inbox:   many producers => one consumer, rows are deleted once the consumer acks them
+  #   events:  one producer => many consumers, each follows by the last id seen, old ones are trimmed
+  #   states:  one producer => many consumers, the latest value by name, followed by the seq it was put at
+  # NOTE: every call commits by itself
+
+  SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS inbox (id INTEGER PRIMARY KEY AUTOINCREMENT, item BLOB NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, item BLOB NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS states (name TEXT PRIMARY KEY, seq INTEGER NOT NULL, value BLOB NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS states_seq ON states (seq)',
+  ]
+
+  def push(self, item:Any):
+    with self.lock:
+      self.conn.execute('INSERT INTO inbox (item) VALUES (?)', (pkl.dumps(item, protocol=pkl.HIGHEST_PROTOCOL),))
+      self.conn.commit()
+
+  def take(self) -> List[Tuple[int, Any]]:
+    # (id, item) of all in the inbox, they stay till `ack()`
+    with self.lock:
+      rows = self.conn.execute('SELECT id, item FROM inbox ORDER BY id').fetchall()
+    return [(row_id, pkl.loads(item)) for row_id, item in rows]
+
+  def ack(self, upto:int):
+    with self.lock:
+      self.conn.execute('DELETE FROM inbox WHERE id <= ?', (upto,))
+      self.conn.commit()
+
+  def publish(self, items:List[Any], keep:int=10000):
+    with self.lock:
+      self.conn.executemany('INSERT INTO events (item) VALUES (?)', [(pkl.dumps(item, protocol=pkl.HIGHEST_PROTOCOL),) for item in items])
+      last = self.conn.execute('SELECT MAX(id) FROM events').fetchone()[0] or 0
+      self.conn.execute('DELETE FROM events WHERE id <= ?', (last - keep,))
+      self.conn.commit()
+
+  def follow(self, after:int) -> Tuple[int, List[Any]]:
+    # events after id `after`, and the id to follow from next time
+    with self.lock:
+      rows = self.conn.execute('SELECT id, item FROM events WHERE id > ? ORDER BY id', (after,)).fetchall()
+    return (rows[-1][0] if rows else after), [pkl.loads(item) for _, item in rows]
+
+  def put_states(self, blobs:Dict[str, bytes]):
+    # values come pickled, so that the producer decides when to take the copy
+    if not blobs: return
+    with self.lock:
+      seq = (self.conn.execute('SELECT MAX(seq) FROM states').fetchone()[0] or 0) + 1
+      self.conn.executemany('INSERT OR REPLACE INTO states (name, seq, value) VALUES (?, ?, ?)',
+                            [(name, seq, blob) for name, blob in blobs.items()])
+      self.conn.commit()
+
+  def get_states(self, after:int) -> Tuple[int, Dict[str, Any]]:
+    # states put after seq `after`, and the seq to follow from next time
+    with self.lock:
+      rows = self.conn.execute('SELECT name, seq, value FROM states WHERE seq > ? ORDER BY seq', (after,)).fetchall()
+    return (rows[-1][1] if rows else after), {name: pkl.loads(value) for name, _, value in rows}
+
+  def clear(self):
+    # what is published, the inbox is kept for the consumer to take
+    with self.lock:
+      for table in ['events', 'states']: self.conn.execute(f'DELETE FROM {table}')
+      self.conn.commit()
+
+sqlite_stores = { }     # db file => SQLiteStore, one connection per db per process
+
+def sqlite_store(fp:str) -> SQLiteStore:
+  if fp not in sqlite_stores:
+    os.makedirs(os.path.dirname(fp) or '.', exist_ok=True)
+    sqlite_stores[fp] = SQLiteStore(fp)
+  return sqlite_stores[fp]
+
+def stdata_db_file() -> str:
+  return os.path.join(hp.DATA_PATH, 'stdata.db')
+
+def rtdata_db_file(prefix:str) -> str:
+  return os.path.join(hp.DATA_PATH, f'{prefix}-rtdata.db')
+
+def _sql_value(v:Any) -> Any:
+  # columns are for filtering only, the object itself is pickled aside
+  return v if v is None or isinstance(v, (int, float, str, bytes)) else repr(v)
+
+# codecs of the dumped files, named in the file header, so a file loads whatever `DUMP_CODEC` is now
+# NOTE: 'zlib' is deflate in gzip framing; files without header are of older versions, always lzma
+DUMP_CODECS = ['none', 'zlib', 'bz2', 'lzma']
+PKL_MAGIC = b'SODAYO\x00\x02'
+PKL_HEADER = struct.Struct('<8s8s')     # magic, codec
+
+def resolve_codec(codec:Tuple[str, int]=None) -> Tuple[str, int]:
+  name, level = codec or hp.DUMP_CODEC
+  if name not in DUMP_CODECS: raise ValueError(f'unknown codec {name!r}, should be one of {DUMP_CODECS}')
+  return name, level
+
+def open_codec(fh, mode:str, codec:str, level:int=None):
+  # (de)compressing stream over the binary file object `fh`
+  if codec == 'zlib': return gzip.GzipFile(fileobj=fh, mode=mode, compresslevel=9 if level is None else level, mtime=0)
+  if codec == 'bz2':  return bz2.BZ2File(fh, mode, compresslevel=9 if level is None else level)
+  if codec == 'lzma': return lzma.LZMAFile(fh, mode, preset=level if 'w' in mode else None)
+  return fh
+
+def encode_block(blob:bytes, codec:str, level:int=None) -> bytes:
+  if codec == 'none': return blob
+  buf = BytesIO()
+  with open_codec(buf, 'wb', codec, level) as fh:
+    fh.write(blob)
+  return buf.getvalue()
+
+def decode_block(raw:memoryview, codec:str) -> memoryview:
+  if codec == 'none': return raw
+  with open_codec(BytesIO(raw), 'rb', codec) as fh:
+    return memoryview(fh.read())
 
 def load_pkl(fp:str) -> object:
   try:
-    with lzma.open(fp, 'rb') as fh:
-      return pkl.load(fh)
+    with open(fp, 'rb') as fh:
+      head = fh.read(PKL_HEADER.size)
+      if head[:len(PKL_MAGIC)] == PKL_MAGIC:
+        codec = PKL_HEADER.unpack(head)[1].rstrip(b'\x00').decode()
+      else:
+        codec = 'lzma'
+        fh.seek(0)
+      with open_codec(fh, 'rb', codec) as cf:
+        return pkl.load(cf)
   except Exception as e:
     copy2(fp, f'{fp}.corrupted-{now_iso()}')
     raise e
 
-def save_pkl(obj:object, fp:str):
-  with lzma.open(fp, 'wb') as fh:
-    pkl.dump(obj, fh)
+def save_pkl(obj:object, fp:str, codec:Tuple[str, int]=None):
+  # write aside then rename, a crash never leaves a half-written file behind
+  name, level = resolve_codec(codec)
+  tmp_fp = f'{fp}.tmp'
+  with open(tmp_fp, 'wb') as fh:
+    fh.write(PKL_HEADER.pack(PKL_MAGIC, name.encode()))
+    with open_codec(fh, 'wb', name, level) as cf:
+      pkl.dump(obj, cf, protocol=pkl.HIGHEST_PROTOCOL)
+  os.replace(tmp_fp, fp)
+
+class RawBlock(NamedTuple):
+  # a block as it is in a `MappedSnapshot`, saved again without being unpickled if the codec stays
+  codec: str
+  data: memoryview
+
+  def load(self) -> Any:
+    return pkl.loads(decode_block(self.data, self.codec))
+
+class MappedSnapshot:
+  # a file of pickled blocks by key, memory-mapped, so that a block is only read and unpickled when asked for
+  #   magic | index offset | codec | block ... | pickle({key: (offset, size)})
+  # each block is compressed on its own, the index is not
+  # NOTE: written aside then renamed, a mapping still open reads the replaced file till closed
+
+  MAGIC = b'SODAYO\x00\x03'
+  HEADER = struct.Struct('<8sQ8s')
+  V1_MAGIC = b'SODAYO\x00\x01'        # no codec, blocks are plain pickles
+  V1_HEADER = struct.Struct('<8sQ')
+
+  def __init__(self, fp:str):
+    self.fp = fp
+    with open(fp, 'rb') as fh:
+      self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    magic = self.mm[:len(self.MAGIC)]
+    if magic == self.MAGIC:
+      _, index_offset, codec = self.HEADER.unpack_from(self.mm)
+      self.codec = codec.rstrip(b'\x00').decode()
+    elif magic == self.V1_MAGIC:
+      _, index_offset = self.V1_HEADER.unpack_from(self.mm)
+      self.codec = 'none'
+    else:
+      raise ValueError(f'not a snapshot file: {fp}')
+    self.index: Dict[Hashable, Tuple[int, int]] = pkl.loads(self.mm[index_offset:])
+
+  def raw(self, key:Hashable) -> RawBlock:
+    offset, size = self.index[key]
+    return RawBlock(self.codec, memoryview(self.mm)[offset:offset + size])
+
+  def load(self, key:Hashable) -> Any:
+    return self.raw(key).load()
+
+  @classmethod
+  def save(cls, blocks:Dict[Hashable, Any], fp:str, codec:Tuple[str, int]=None):
+    # values of `RawBlock` are copied as they are if of the same codec, only recompressed if not
+    name, level = resolve_codec(codec)
+    tmp_fp = f'{fp}.tmp'
+    index = { }
+    with open(tmp_fp, 'wb') as fh:
+      fh.write(cls.HEADER.pack(cls.MAGIC, 0, name.encode()))
+      for key, value in blocks.items():
+        if isinstance(value, RawBlock) and value.codec == name:
+          blob = value.data
+        else:
+          blob = decode_block(value.data, value.codec) if isinstance(value, RawBlock) else pkl.dumps(value, protocol=pkl.HIGHEST_PROTOCOL)
+          blob = encode_block(blob, name, level)
+        index[key] = (fh.tell(), len(blob))
+        fh.write(blob)
+      index_offset = fh.tell()
+      fh.write(pkl.dumps(index, protocol=pkl.HIGHEST_PROTOCOL))
+      fh.seek(0)
+      fh.write(cls.HEADER.pack(cls.MAGIC, index_offset, name.encode()))
+    os.replace(tmp_fp, fp)
+
+class LazyDict(MutableMapping):
+  # dict over a `MappedSnapshot`, a key is loaded on first access and kept in memory from then on
+  # `hook(key, value) -> value` is applied to what is loaded, under the lock of the dict
+  # NOTE: iterating keys, `in` and `len()` load nothing, `items()` and `values()` load all
+
+  def __init__(self, snapshot:MappedSnapshot, hook:Callable[[Hashable, Any], Any]=None):
+    self.snapshot = snapshot
+    self.hook = hook
+    self.data = { }
+    self.pending = set(snapshot.index)
+    self.lock = RLock()
+
+  def _load(self, key:Hashable):
+    with self.lock:
+      if key not in self.pending: return
+      value = self.snapshot.load(key)
+      if self.hook: value = self.hook(key, value)
+      self.data[key] = value
+      self.pending.discard(key)
+
+  def __getitem__(self, key:Hashable) -> Any:
+    if key in self.pending: self._load(key)
+    return self.data[key]
+
+  def __setitem__(self, key:Hashable, value:Any):
+    with self.lock:
+      self.pending.discard(key)
+      self.data[key] = value
+
+  def __delitem__(self, key:Hashable):
+    with self.lock:
+      if key in self.pending: self.pending.discard(key)
+      else: del self.data[key]
+
+  def __contains__(self, key:Hashable) -> bool:
+    return key in self.data or key in self.pending
+
+  def __iter__(self) -> Iterator[Hashable]:
+    with self.lock:
+      return iter(list(self.data) + list(self.pending))
+
+  def __len__(self) -> int:
+    return len(self.data) + len(self.pending)
+
+  def unloaded(self) -> Dict[Hashable, RawBlock]:
+    # raw blocks of the keys not loaded yet, to be saved again without unpickling
+    with self.lock:
+      return {key: self.snapshot.raw(key) for key in self.pending}
+
+  def __reduce__(self):
+    return dict, (dict(self.items()),)
+
+BACKUP_DIRNAME = 'backup'
+BACKUP_TIMEFMT = '%Y%m%d-%H%M%S'    # backups are named by when they are taken
+WAL_DIRNAME = 'wal'
+
+def list_backups() -> List[str]:
+  dp = os.path.join(hp.DATA_PATH, BACKUP_DIRNAME)
+  if not os.path.isdir(dp): return [ ]
+  return [os.path.join(dp, fn) for fn in sorted(os.listdir(dp))]
+
+def backup_ts(dp:str) -> int:
+  # by the name, the mtime of a backup is copied from `DATA_PATH`, 0 if not one of ours
+  try: return int(datetime.strptime(os.path.basename(dp), BACKUP_TIMEFMT).timestamp())
+  except ValueError: return 0
+
+def backup_data(keep:int):
+  # point-in-time copy of `DATA_PATH` by hard links, keeping the newest `keep` ones
+  # NOTE: data files are only ever replaced by rename, so a linked file never changes under the backup
+  logger.debug('[backup_data]')
+
+  try:
+    dst = os.path.join(hp.DATA_PATH, BACKUP_DIRNAME, datetime.now().strftime(BACKUP_TIMEFMT))
+    copytree(hp.DATA_PATH, dst, copy_function=_link_or_copy,
+             ignore=ignore_patterns(BACKUP_DIRNAME, WAL_DIRNAME, '*.tmp', '*.corrupted-*', '*.db-wal', '*.db-shm'))
+    logger.debug(f'   backup {dst}')
+    for dp in list_backups()[:-keep]:
+      rmtree(dp)
+      logger.debug(f'   remove {dp}')
+  except:
+    logger.error(format_exc())
+
+def _link_or_copy(src:str, dst:str):
+  # sqlite dbs are written in place, take a consistent copy of what is committed instead
+  if src.endswith('.db'):
+    with closing(sqlite3.connect(src)) as src_conn, closing(sqlite3.connect(dst)) as dst_conn:
+      src_conn.backup(dst_conn)
+    return
+  try: os.link(src, dst)
+  except OSError: copy2(src, dst)
+
+class WriteAheadLog:
+  # append-only log of mutations, in segment files named by the first lsn they hold: `<lsn>.wal`
+  # each record is `size | crc32 | pickle((lsn, entry))`, a torn tail is dropped on replay
+  # group commit: a ticker calling `sync()` every `sync_interval` seconds, woken up early once `sync_records` are pending
+  #               or `sync_interval` passed on appending, the fsync runs out of the lock and appending goes on meanwhile
+  # NOTE: nothing is logged before `open()`, so entries being replayed are not logged again
+
+  HEADER = struct.Struct('<II')
+
+  def __init__(self, dp:str, sync_interval:float, sync_records:int):
+    self.dp = dp
+    self.sync_interval = sync_interval
+    self.sync_records = sync_records
+    self.lsn = 0              # last lsn assigned
+    self.fh = None
+    self.pending = 0          # records written but not fsync'ed
+    self.synced = 0           # last lsn on disk
+    self.last_sync = perf_counter()
+    self.lock = RLock()
+    self.due = Event()        # thresholds hit, for the ticker
+
+  def segments(self) -> List[Tuple[int, str]]:
+    if not os.path.isdir(self.dp): return [ ]
+    return sorted((int(fn[:-len('.wal')]), os.path.join(self.dp, fn)) for fn in os.listdir(self.dp) if fn.endswith('.wal'))
+
+  def replay(self, after:int=0) -> Iterator[Tuple[int, Any]]:
+    # entries logged later than lsn `after`, lsn counting goes on from the last one seen
+    self.lsn = max(self.lsn, after)
+    for _, fp in self.segments():
+      with open(fp, 'rb') as fh:
+        while True:
+          head = fh.read(self.HEADER.size)
+          if not head: break
+          if len(head) == self.HEADER.size:
+            size, crc = self.HEADER.unpack(head)
+            blob = fh.read(size)
+            if len(blob) == size and zlib.crc32(blob) == crc:
+              lsn, entry = pkl.loads(blob)
+              self.lsn = max(self.lsn, lsn)
+              if lsn > after: yield lsn, entry
+              continue
+          logger.warning(f'[WriteAheadLog] torn record in {fp} at {fh.tell()}, drop the rest')
+          break
+
+  def open(self):
+    # start a new segment, the previous one is sealed
+    with self.lock:
+      self.close()
+      os.makedirs(self.dp, exist_ok=True)
+      # an existing file of the same name holds nothing valid after `self.lsn`, overwrite it
+      self.fh = open(os.path.join(self.dp, f'{self.lsn + 1:016d}.wal'), 'wb')
+      self.synced = self.lsn
+
+  def close(self):
+    with self.lock:
+      if self.fh is None: return
+      self.sync()
+      self.fh.close()
+      self.fh = None
+
+  def append(self, entry:Any) -> int:
+    with self.lock:
+      if self.fh is None: return 0
+      self.lsn += 1
+      blob = pkl.dumps((self.lsn, entry), protocol=pkl.HIGHEST_PROTOCOL)
+      self.fh.write(self.HEADER.pack(len(blob), zlib.crc32(blob)))
+      self.fh.write(blob)
+      self.pending += 1
+      if self.pending >= self.sync_records or perf_counter() - self.last_sync >= self.sync_interval:
+        self.due.set()
+      return self.lsn
+
+  def wait_due(self, timeout:float):
+    # for the ticker: sleep `timeout` seconds, or till the thresholds are hit
+    self.due.wait(timeout)
+    self.due.clear()
+
+  def sync(self):
+    # flushed under the lock and fsync'ed out of it, returns once all logged before the call are on disk
+    # NOTE: a dup of the fd, the segment may be sealed and closed meanwhile
+    with self.lock:
+      self.last_sync = perf_counter()
+      if self.fh is None or self.synced >= self.lsn: return
+      self.fh.flush()
+      lsn, fd, self.pending = self.lsn, os.dup(self.fh.fileno()), 0
+    try:     os.fsync(fd)
+    finally: os.close(fd)
+    with self.lock: self.synced = max(self.synced, lsn)
+
+  def rotate(self) -> int:
+    # seal the current segment, returns the last lsn in sealed ones
+    self.sync()           # the bulk out of the lock, `close()` syncs the rest under it
+    with self.lock:
+      if self.fh is not None: self.open()
+      return self.lsn
+
+  def truncate(self, lsn:int):
+    # remove segments holding nothing later than `lsn`, i.e. its successor starts no later than `lsn + 1`
+    segs = self.segments()
+    for (_, fp), (next_lsn, _) in zip(segs, segs[1:]):
+      if next_lsn > lsn + 1: break
+      os.unlink(fp)
+      logger.debug(f'   remove {fp}')
 
 def load_rtdata(env:dict, prefix:str):
   logger.debug('[load_rtdata]')
 
   os.makedirs(hp.DATA_PATH, exist_ok=True)
   try:
+    store = hp.STORAGE_BACKEND == 'sqlite' and sqlite_store(rtdata_db_file(prefix))
     for var in env:
       if var.endswith('_info') and isinstance(env[var], DUMPABLE_TYPES):
+        if store:
+          obj = store.get(var)
+          if obj is not None:
+            env[var] = obj
+            logger.debug(f'   load {var} from {store.fp}')
+          continue
+        snap_fp = os.path.join(hp.DATA_PATH, f'{prefix}-{var}.snap')
+        if f'{prefix}-{var}' in hp.RTDATA_SNAPSHOT_VARS and isinstance(env[var], dict) and os.path.exists(snap_fp):
+          env[var] = LazyDict(MappedSnapshot(snap_fp))
+          logger.debug(f'   map {snap_fp}')
+          continue
         fp = os.path.join(hp.DATA_PATH, f'{prefix}-{var}.pkl')
         if os.path.exists(fp):
           env[var] = load_pkl(fp)
           logger.debug(f'   load {fp}')
+        elif isinstance(env[var], dict) and os.path.exists(snap_fp):
+          # dropped out of RTDATA_SNAPSHOT_VARS since last dump, read it whole once, next dump goes to .pkl
+          env[var] = dict(LazyDict(MappedSnapshot(snap_fp)))
+          logger.debug(f'   load {snap_fp}')
   except:
     logger.fatal(format_exc())
     exit(-1)
 
-def dump_rtdata(env:dict, prefix:str):
+def dump_rtdata(env:dict, prefix:str) -> bool:
   logger.debug('[dump_rtdata]')
 
   try:
+    store = hp.STORAGE_BACKEND == 'sqlite' and sqlite_store(rtdata_db_file(prefix))
     for var in env:
       if var.endswith('_info') and isinstance(env[var], DUMPABLE_TYPES):
-        fp = os.path.join(hp.DATA_PATH, f'{prefix}-{var}.pkl')
-        save_pkl(env[var], fp)
+        if store:
+          store.put(var, env[var])
+          logger.debug(f'   dump {var} to {store.fp}')
+          continue
+        pkl_fp = os.path.join(hp.DATA_PATH, f'{prefix}-{var}.pkl')
+        snap_fp = os.path.join(hp.DATA_PATH, f'{prefix}-{var}.snap')
+        if f'{prefix}-{var}' in hp.RTDATA_SNAPSHOT_VARS and isinstance(env[var], MutableMapping):
+          MappedSnapshot.save(env[var], snap_fp)
+          fp, stale_fp = snap_fp, pkl_fp
+        else:
+          save_pkl(env[var], pkl_fp)
+          fp, stale_fp = pkl_fp, snap_fp
+        if os.path.exists(stale_fp): os.unlink(stale_fp)     # superseded by the other format
         logger.debug(f'   dump {fp}')
+    if store: store.commit()
+    return True
   except:
     logger.error(format_exc())
+    return False
 
 def load_stdata():
   logger.debug('[load_stdata]')
@@ -191,16 +1039,50 @@ def load_stdata():
     logger.fatal(format_exc())
     exit(-1)
 
-def dump_stdata():
+def dump_stdata(mark:Any=None) -> bool:
+  staged = stage_stdata(mark)
+  ok = write_stdata(staged)
+  if ok: settle_stdata(staged)
+  return ok
+
+def stage_stdata(mark:Any=None) -> List[Tuple[type, tuple]]:
+  # under the locks of the records, see `Record.stage()`
+  logger.debug('[stage_stdata]')
+
+  try:
+    return [(rec, rec.stage(mark)) for rec in RecordMeta.objects]
+  except:
+    logger.fatal(format_exc())
+    exit(-1)
+
+def write_stdata(staged:List[Tuple[type, tuple]]) -> bool:
   logger.debug('[dump_stdata]')
-  
+
   try:
-    for rec in RecordMeta.objects:
-      rec.save()
+    return all([rec.write(st) for rec, st in staged])
   except:
     logger.fatal(format_exc())
     exit(-1)
 
+def settle_stdata(staged:List[Tuple[type, tuple]]):
+  # under the locks of the records, once `write_stdata()` succeeded, see `Record.settle()`
+  for rec, st in staged: rec.settle(st)
+
+def run_dump(fn:Callable[[], bool]) -> bool:
+  # run `fn` writing what is frozen already, in a forked child if `DUMP_MODE` is 'fork', otherwise right here
+  # the child works on a copy-on-write image of the process, so the parent goes on without sharing its GIL
+  # NOTE: the child only has the forking thread, sqlite connections and locks of the others are not safe there,
+  #       hence the pickle backend only
+  if hp.DUMP_MODE != 'fork' or hp.STORAGE_BACKEND != 'pickle' or not hasattr(os, 'fork'): return fn()
+
+  pid = os.fork()
+  if pid == 0:
+    try:    ok = fn()
+    except BaseException: ok = False
+    os._exit(0 if ok else 1)
+  _, status = os.waitpid(pid, 0)
+  return os.waitstatus_to_exitcode(status) == 0
+
 # shell execute
 def execute(cmd:str) -> List[str]:
   rs = [ ]  
@@ -210,27 +1092,279 @@ def execute(cmd:str) -> List[str]:
   return rs
 
 
+# metrics
+class Metrics:
+
+  # in-process registry of counters, gauges and fixed-bucket histograms
+  # a series is keyed by `(name, labels)`, labels being the tuple of kwargs items as given,
+  # so a call site SHOULD always pass them in the same order
+  # NOTE: values owned elsewhere (queue depths, cache size, ...) are read at scrape time
+  #       by collectors instead of being pushed on each change
+
+  def __init__(self, buckets:List[float]):
+    self.buckets = tuple(buckets)
+    self.counters: Dict[tuple, float] = { }
+    self.gauges: Dict[tuple, float] = { }
+    self.histograms: Dict[tuple, list] = { }    # key => [counts per bucket and +Inf, sum]
+    self.collectors: List[Callable[[], Iterator[tuple]]] = [ ]
+    self.lock = Lock()
+
+  def inc(self, name:str, value:float=1, **labels):
+    key = (name, tuple(labels.items()))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def set(self, name:str, value:float, **labels):
+    self.gauges[(name, tuple(labels.items()))] = value
+
+  def observe(self, name:str, seconds:float, **labels):
+    key = (name, tuple(labels.items()))
+    i = bisect_left(self.buckets, seconds)
+    with self.lock:
+      hist = self.histograms.get(key)
+      if hist is None: hist = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+      hist[0][i] += 1
+      hist[1] += seconds
+
+  def collector(self, fn:Callable[[], Iterator[tuple]]) -> Callable:
+    # decorator, `fn` yields `(kind, name, labels, value)` with kind in ['counter', 'gauge']
+    self.collectors.append(fn)
+    return fn
+
+  def collect(self) -> Tuple[Dict[tuple, float], Dict[tuple, float], Dict[tuple, list]]:
+    with self.lock:
+      counters, gauges = dict(self.counters), dict(self.gauges)
+      histograms = {key: [list(counts), total] for key, (counts, total) in self.histograms.items()}
+    for fn in self.collectors:
+      try:
+        for kind, name, labels, value in fn():
+          (counters if kind == 'counter' else gauges)[(name, tuple(labels.items()))] = value
+      except: logger.error(format_exc())
+    return counters, gauges, histograms
+
+  def quantile(self, q:float, counts:List[int]) -> Optional[float]:
+    # linear within the bucket it falls in, like `histogram_quantile()` of Prometheus
+    n = sum(counts)
+    if not n: return None
+    rank, seen = q * n, 0
+    for i, c in enumerate(counts):
+      if seen + c >= rank and c:
+        if i == len(self.buckets): return self.buckets[-1]
+        lo = self.buckets[i - 1] if i else 0.0
+        return lo + (self.buckets[i] - lo) * (rank - seen) / c
+      seen += c
+
+  def snapshot(self) -> dict:
+    # JSON friendly, histograms summed up to count/avg/quantiles in ms
+    counters, gauges, histograms = self.collect()
+    res = {'counters': { }, 'gauges': { }, 'histograms': { }}
+    for kind, series in [('counters', counters), ('gauges', gauges)]:
+      for (name, labels), value in sorted(series.items()):
+        res[kind].setdefault(name, [ ]).append({**dict(labels), 'value': value})
+    for (name, labels), (counts, total) in sorted(histograms.items()):
+      n = sum(counts)
+      stat = {**dict(labels), 'count': n, 'avg': n and round(total / n * 1000, 3)}
+      for q in [0.5, 0.9, 0.99]:
+        v = self.quantile(q, counts)
+        stat[f'p{round(q * 100)}'] = v and round(v * 1000, 3)
+      res['histograms'].setdefault(name, [ ]).append(stat)
+    return res
+
+  def render(self) -> str:
+    # Prometheus text exposition format 0.0.4
+    def fmt(labels:tuple, extra:tuple=( )) -> str:
+      items = labels + extra
+      if not items: return ''
+      return '{' + ','.join(f'{k}="{_escape_label(v)}"' for k, v in items) + '}'
+
+    counters, gauges, histograms = self.collect()
+    lines, typed = [ ], set()
+    for kind, series in [('counter', counters), ('gauge', gauges)]:
+      for (name, labels), value in sorted(series.items()):
+        if name not in typed: lines.append(f'# TYPE {name} {kind}'); typed.add(name)
+        lines.append(f'{name}{fmt(labels)} {value}')
+    for (name, labels), (counts, total) in sorted(histograms.items()):
+      if name not in typed: lines.append(f'# TYPE {name} histogram'); typed.add(name)
+      cum = 0
+      for le, c in zip(self.buckets + ('+Inf',), counts):
+        cum += c
+        lines.append(f'{name}_bucket{fmt(labels, (("le", le),))} {cum}')
+      lines.append(f'{name}_sum{fmt(labels)} {total}')
+      lines.append(f'{name}_count{fmt(labels)} {cum}')
+    return '\n'.join(lines) + '\n'
+
+def _escape_label(v:Any) -> str:
+  return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+METRICS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+metrics = Metrics(hp.METRICS_BUCKETS)
+
+
 # decorators
 def perf_timer(fn):
+  # call latency goes to the `sodayo_call_seconds` histogram, and to the log in debug mode
+  name = fn.__name__
   def wrapper(*args, **kwargs):
-    start = time()
-    r = fn(*args, **kwargs)
-    end = time()
-    logger.debug(f'[{fn.__name__}]: perf_timer {end - start:.4f}s')
-    return r
+    start = perf_counter()
+    try:     return fn(*args, **kwargs)
+    finally:
+      elapsed = perf_counter() - start
+      metrics.observe('sodayo_call_seconds', elapsed, fn=name)
+      if hp.DEBUG_MODE: logger.debug(f'[{name}]: perf_timer {elapsed:.4f}s')
+  wrapper.__name__ = name
   return wrapper
 
-def with_lock(lock:RLock):
+def with_lock(lock:RLock, name:str=None):
+  # time waited for `lock` goes to the `sodayo_lock_wait_seconds` histogram, labeled `name` or the function's
+  # NOTE: a StatLock already does so under its own name
   def wrapper(fn):
+    lock_name = name or fn.__name__
+    timed = not isinstance(lock, StatLock)
     def wrapper(*args, **kwargs):
+      start = perf_counter()
       lock.acquire()
-      r = fn(*args, **kwargs)
-      lock.release()
-      return r
+      if timed: metrics.observe('sodayo_lock_wait_seconds', perf_counter() - start, lock=lock_name)
+      try:     return fn(*args, **kwargs)
+      finally: lock.release()
+    wrapper.__name__ = fn.__name__
     return wrapper
   return wrapper
 
 
+# locks
+class StatLock:
+
+  # RLock keeping count of acquisitions, of the contended ones and the time spent waiting,
+  # waits also go to the `sodayo_lock_wait_seconds` histogram labeled `name`
+
+  def __init__(self, name:str='*'):
+    self.name = name
+    self.lock = RLock()
+    self.acquired = self.contended = 0
+    self.wait_total = self.wait_max = 0.0
+
+  def acquire(self, blocking:bool=True, timeout:float=-1) -> bool:
+    if self.lock.acquire(blocking=False):
+      self.acquired += 1
+      metrics.observe('sodayo_lock_wait_seconds', 0.0, lock=self.name)
+      return True
+    if not blocking: return False
+    start = perf_counter()
+    if not self.lock.acquire(timeout=timeout): return False
+    # stats are written holding the lock
+    wait = perf_counter() - start
+    self.acquired += 1
+    self.contended += 1
+    self.wait_total += wait
+    self.wait_max = max(self.wait_max, wait)
+    metrics.observe('sodayo_lock_wait_seconds', wait, lock=self.name)
+    return True
+
+  def release(self):
+    self.lock.release()
+
+  def __enter__(self) -> bool:
+    return self.acquire()
+
+  def __exit__(self, *args):
+    self.release()
+
+  def stats(self) -> dict:
+    return {
+      'acquired': self.acquired,
+      'contended': self.contended,
+      'wait_avg': self.contended and round(self.wait_total / self.contended * 1000, 3),   # in ms
+      'wait_max': round(self.wait_max * 1000, 3),
+    }
+
+
+# cache
+class SizedLRU:
+
+  # LRU mapping bounded by the total byte size of its values, sizes are given on `put`
+
+  def __init__(self, capacity:int):
+    self.capacity = capacity
+    self.size = 0
+    self.items = OrderedDict()      # key => (size, value)
+    self.lock = RLock()
+    self.hits = self.misses = self.evictions = 0
+
+  def get(self, key:Hashable, default=None):
+    with self.lock:
+      if key not in self.items:
+        self.misses += 1
+        return default
+      self.items.move_to_end(key)
+      self.hits += 1
+      return self.items[key][1]
+
+  def put(self, key:Hashable, value, size:int):
+    with self.lock:
+      self.pop(key)
+      if size > self.capacity: return     # never fits
+      self.items[key] = (size, value)
+      self.size += size
+      while self.size > self.capacity:
+        _, (size, _) = self.items.popitem(last=False)
+        self.size -= size
+        self.evictions += 1
+
+  def pop(self, key:Hashable):
+    with self.lock:
+      if key in self.items:
+        size, value = self.items.pop(key)
+        self.size -= size
+        return value
+
+  def invalidate(self, pred:Callable[[Hashable], bool]=None):
+    # drop keys matching `pred`, or all
+    with self.lock:
+      for key in [key for key in self.items if pred is None or pred(key)]:
+        self.pop(key)
+
+  def __len__(self) -> int:
+    return len(self.items)
+
+
+# timers
+class ExpiryHeap:
+
+  # min-heap of (deadline, key), re-pushing a key moves its deadline and leaves the old entry behind,
+  # which is skipped when popped, so popping costs O(expired) amortized
+
+  def __init__(self):
+    self.heap = [ ]
+    self.deadlines = { }      # key => current deadline
+
+  def push(self, key:Hashable, deadline:float):
+    self.deadlines[key] = deadline
+    heappush(self.heap, (deadline, key))
+    # too many left behind, rebuild
+    if len(self.heap) > 2 * len(self.deadlines) + 64:
+      self.heap = [(deadline, key) for key, deadline in self.deadlines.items()]
+      heapify(self.heap)
+
+  def discard(self, key:Hashable):
+    self.deadlines.pop(key, None)
+
+  def pop_expired(self, now:float) -> List[Hashable]:
+    keys = [ ]
+    while self.heap and self.heap[0][0] <= now:
+      deadline, key = heappop(self.heap)
+      if self.deadlines.get(key) == deadline:
+        del self.deadlines[key]
+        keys.append(key)
+    return keys
+
+  def __contains__(self, key:Hashable) -> bool:
+    return key in self.deadlines
+
+  def __len__(self) -> int:
+    return len(self.deadlines)
+
+
 # ugly callback, used by `server.reload_settings`
 def _reload_settings():
   global hp